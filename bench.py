@@ -0,0 +1,1218 @@
+#!/usr/bin/env python
+
+"""
+    bench.py
+    
+    microbenchmarks + parity checks for the hot paths
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import h5py
+import shutil
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+import ujson as json
+import numpy as np
+from time import time
+
+import torch
+from torch.autograd import Variable
+from scipy.sparse import csr_matrix, issparse
+
+from helpers import set_seeds, to_numpy
+from problem import NodeProblem, parse_csr_matrix, ProblemMetrics, MetricAccumulator
+from nn_modules import GenerateQuantumWalkGraphs, QuantumWalkGraphs, QuantumWalkDegree, \
+    QuantumWalkInitAmps, QuantumWalkArcs, QuantumWalkBuckets, QuantumWalkSwapIndex, QuantumWalk, SparseQuantumWalk, \
+    BucketedQuantumWalk, ClosedFormQuantumWalk
+from nn_modules import UniformNeighborSampler, RowUniformNeighborSampler, SparseUniformNeighborSampler, \
+    TorchSparseUniformNeighborSampler
+from nn_modules import sampler_lookup, prep_lookup, aggregator_lookup, walk_lookup, MeanAggregator, FusedMeanAggregator, \
+    AttentionAggregator, MultiHeadAttentionAggregator
+from models import GSSupervised
+from distributed import launch, init_worker, default_threads
+from profiler import profiler, peak_rss_mb
+
+# --
+# Helpers
+
+def random_adj(n_nodes, max_degree):
+    """ dense adjacency in the `UniformNeighborSampler` format (dummy node at the end) """
+    adj = np.random.choice(n_nodes, (n_nodes + 1, max_degree))
+    adj[-1] = n_nodes
+    return torch.LongTensor(adj)
+
+
+def power_law_adj(n_nodes, max_degree, alpha=2.0):
+    """
+        dense adjacency w/ power law degrees + popularity, roughly like reddit
+        
+        node degrees are zipf(alpha) clipped to `max_degree`, neighbors are drawn w/ probability
+        ~ rank ** -alpha / 2, and rows are upsampled w/ replacement like `make_adjacency`
+    """
+    degrees = np.minimum(np.random.zipf(alpha, n_nodes), max_degree)
+    
+    popularity = np.random.permutation(np.arange(1, n_nodes + 1) ** (-alpha / 2.))
+    popularity /= popularity.sum()
+    
+    adj = np.random.choice(n_nodes, (n_nodes + 1, max_degree), p=popularity)
+    upsample = np.random.randint(0, max_degree, adj.shape) % np.hstack([degrees, [1]]).reshape(-1, 1)
+    adj = np.where(np.arange(max_degree).reshape(1, -1) < np.hstack([degrees, [0]]).reshape(-1, 1), adj, adj[np.arange(adj.shape[0]).reshape(-1, 1), upsample])
+    adj[-1] = n_nodes
+    return torch.LongTensor(adj)
+
+
+def random_sparse_adj(n_nodes, max_degree):
+    """ sparse adjacency in the `SparseUniformNeighborSampler` format (dummy node at the start) """
+    degrees = np.random.randint(1, max_degree + 1, n_nodes)
+    rows = np.repeat(np.arange(1, n_nodes + 1), degrees)
+    cols = np.hstack([np.arange(d) for d in degrees])
+    vals = np.random.randint(1, n_nodes + 1, degrees.sum())
+    return csr_matrix((vals, (rows, cols)), shape=(n_nodes + 1, max_degree))
+
+
+def load_sparse_adj(problem_path):
+    """ just the (sparse) `adj` of a problem file, w/o loading the rest of the problem """
+    f = h5py.File(problem_path, 'r')
+    assert 'sparse' in f and f['sparse'].value, 'load_sparse_adj: %s is not sparse' % problem_path
+    adj = parse_csr_matrix(f['adj'].value)
+    f.close()
+    return adj
+
+
+def power_law_edges(n_nodes, alpha=2.0, rng=np.random):
+    """
+        `[n_edges, 2]` edges of a power law (Chung-Lu) graph
+        
+        each node gets zipf(alpha) edges, whose other endpoints are drawn w/ probability
+        proportional to those (expected) degrees
+    """
+    degrees = np.minimum(rng.zipf(alpha, n_nodes), n_nodes - 1)
+    src = np.repeat(np.arange(n_nodes), degrees)
+    trg = rng.choice(n_nodes, src.shape[0], p=degrees / degrees.sum())
+    keep = src != trg
+    return np.column_stack([src[keep], trg[keep]])
+
+
+def edge_lists(edges, n_nodes, sel=None):
+    """ (src, trg, degrees) of the (undirected) edges, sorted by src -- only edges between `sel` nodes """
+    if sel is not None:
+        edges = edges[sel[edges[:,0]] & sel[edges[:,1]]]
+    
+    src, trg = np.hstack([edges[:,0], edges[:,1]]), np.hstack([edges[:,1], edges[:,0]])
+    order = np.argsort(src, kind='mergesort')
+    return src[order], trg[order], np.bincount(src, minlength=n_nodes)
+
+
+def synthetic_dense_adj(edges, n_nodes, max_degree, sel=None, rng=np.random):
+    """ `[n_nodes + 1, max_degree]` adjacency list (neighbors drawn w/ replacement, dummy node at the end) """
+    _, trg, degrees = edge_lists(edges, n_nodes, sel=sel)
+    starts = np.cumsum(degrees) - degrees
+    offsets = (rng.uniform(size=(n_nodes, max_degree)) * degrees.reshape(-1, 1)).astype(np.int64)
+    
+    adj = np.zeros((n_nodes + 1, max_degree), dtype=np.int64) + n_nodes
+    has_neibs = degrees > 0
+    adj[:-1][has_neibs] = trg[(starts.reshape(-1, 1) + offsets)[has_neibs]]
+    return adj
+
+
+def synthetic_sparse_adj(edges, n_nodes, sel=None):
+    """ `[vals, rows, cols]` sparse adjacency, as `parse_csr_matrix` reads it (dummy node at the start, off-by-one) """
+    src, trg, degrees = edge_lists(edges, n_nodes, sel=sel)
+    cols = np.arange(src.shape[0]) - np.repeat(np.cumsum(degrees) - degrees, degrees)
+    return np.vstack([trg + 1, src + 1, cols])
+
+
+def make_synthetic_problem(outpath, n_nodes, max_degree=128, feats_dim=128, n_classes=8, alpha=2.0, sparse=False, seed=123):
+    """
+        writes a synthetic `NodeProblem` HDF5 file:  power law graph, gaussian features,
+        random class labels + an 80/10/10 train/val/test split
+    """
+    rng = np.random.RandomState(seed)
+    edges = power_law_edges(n_nodes, alpha=alpha, rng=rng)
+    folds = rng.choice(['train', 'val', 'test'], n_nodes, p=[0.8, 0.1, 0.1])
+    train_sel = folds == 'train'
+    
+    f = h5py.File(outpath, 'w')
+    f['task'] = 'classification'
+    f['n_classes'] = n_classes
+    f['feats'] = np.vstack([rng.normal(size=(n_nodes, feats_dim)), np.zeros((1, feats_dim))])
+    f['targets'] = np.vstack([rng.randint(0, n_classes, (n_nodes, 1)), np.zeros((1, 1), dtype=np.int64)])
+    f['folds'] = np.hstack([folds, ['dummy']]).astype('S')
+    if sparse:
+        f['sparse'] = True
+        f['adj'] = synthetic_sparse_adj(edges, n_nodes)
+        f['train_adj'] = synthetic_sparse_adj(edges, n_nodes, sel=train_sel)
+    else:
+        f['adj'] = synthetic_dense_adj(edges, n_nodes, max_degree, rng=rng)
+        f['train_adj'] = synthetic_dense_adj(edges, n_nodes, max_degree, sel=train_sel, rng=rng)
+    
+    f.close()
+    return {"n_nodes" : n_nodes, "n_edges" : int(edges.shape[0]), "sparse" : sparse}
+
+
+def load_problem_graph(problem_path):
+    """ (adj, feats) of a problem file -- dense `adj` + `feats` as torch tensors, sparse `adj` as CSR """
+    f = h5py.File(problem_path, 'r')
+    if 'sparse' in f and f['sparse'].value:
+        adj = parse_csr_matrix(f['adj'].value)
+    else:
+        adj = torch.LongTensor(f['adj'].value)
+    
+    feats = torch.FloatTensor(f['feats'].value)
+    f.close()
+    return adj, feats
+
+
+class LegacySparseUniformNeighborSampler(object):
+    """ `SparseUniformNeighborSampler` before it worked directly on the CSR arrays, as a baseline """
+    def __init__(self, adj,):
+        self.adj = adj
+        
+        idx, partial_degrees = np.unique(adj.nonzero()[0], return_counts=True)
+        self.degrees = np.zeros(adj.shape[0]).astype(int)
+        self.degrees[idx] = partial_degrees
+        
+    def __call__(self, ids, n_samples=128):
+        ids = to_numpy(ids)
+        
+        tmp = self.adj[ids]
+        
+        sel = np.random.choice(self.adj.shape[1], (ids.shape[0], n_samples))
+        sel = sel % self.degrees[ids].reshape(-1, 1)
+        tmp = tmp[
+            np.arange(ids.shape[0]).repeat(n_samples).reshape(-1),
+            np.array(sel).reshape(-1)
+        ]
+        tmp = np.asarray(tmp).squeeze() 
+        
+        return Variable(torch.LongTensor(tmp))
+
+
+class LegacyUniformNeighborSampler(object):
+    """ `UniformNeighborSampler` before it only gathered the sampled columns, as a baseline """
+    def __init__(self, adj):
+        self.adj = adj
+    
+    def __call__(self, ids, n_samples=-1, rng=None):
+        tmp = self.adj[ids]
+        if rng is None:
+            perm = torch.randperm(tmp.size(1))
+        else:
+            perm = torch.from_numpy(rng.permutation(tmp.size(1)))
+        
+        if ids.is_cuda:
+            perm = perm.cuda()
+        
+        tmp = tmp[:,perm]
+        tmp = tmp[:,:n_samples]
+        return tmp
+
+
+def timeit(fn, n_iters):
+    times = []
+    for _ in range(n_iters):
+        t = time()
+        out = fn()
+        times.append(time() - t)
+    
+    return out, float(np.median(times))
+
+
+def latency(fn, n_iters, n_warmup=1):
+    """ latency percentiles (seconds) of `fn`, after `n_warmup` untimed calls """
+    for _ in range(n_warmup):
+        _ = fn()
+    
+    times = []
+    for _ in range(n_iters):
+        t = time()
+        _ = fn()
+        times.append(time() - t)
+    
+    return {
+        "p50" : float(np.percentile(times, 50)),
+        "p90" : float(np.percentile(times, 90)),
+        "p99" : float(np.percentile(times, 99)),
+        "mean" : float(np.mean(times)),
+    }
+
+def saved_bytes(fn):
+    """
+        output of `fn` + bytes of the tensors autograd saves for backward while it runs (each
+        storage counted once) -- the measured activation memory of `fn`.  Bytes are `None` on
+        torch versions w/o `saved_tensors_hooks` (< 1.10) or `untyped_storage` (< 2.0)
+    """
+    graph = getattr(torch.autograd, 'graph', None)
+    if not (hasattr(graph, 'saved_tensors_hooks') and hasattr(torch.Tensor, 'untyped_storage')):
+        return fn(), None
+    
+    storages = {}
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+    
+    with graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        out = fn()
+    
+    return out, sum(storages.values())
+
+# --
+# Benchmarks
+
+def bench_quantum_graphs(args):
+    """ batched vs. loop construction of quantum walk graphs -- checks that both agree """
+    adj = random_adj(args.n_nodes, args.max_degree)
+    ids = torch.LongTensor(np.random.choice(args.n_nodes, args.batch_size * args.n_samples))
+    
+    loop_out, loop_time = timeit(lambda: GenerateQuantumWalkGraphs(adj, ids, args.batch_size, args.n_samples, vectorized=False), args.n_iters)
+    vec_out, vec_time = timeit(lambda: GenerateQuantumWalkGraphs(adj, ids, args.batch_size, args.n_samples), args.n_iters)
+    
+    assert loop_out[2] == vec_out[2], 'bench_quantum_graphs: degree mismatch'
+    assert torch.equal(loop_out[1], vec_out[1]), 'bench_quantum_graphs: graphs mismatch'
+    assert torch.equal(loop_out[0].data, vec_out[0].data), 'bench_quantum_graphs: init_amps mismatch'
+    
+    return {
+        "loop_time" : loop_time,
+        "vectorized_time" : vec_time,
+        "speedup" : loop_time / vec_time,
+    }
+
+
+def bench_quantum_walk(args):
+    """ dense vs. arc-indexed (sparse) quantum walk -- checks that both agree """
+    adj = random_adj(args.n_nodes, args.max_degree)
+    ids = torch.LongTensor(np.random.choice(args.n_nodes, args.batch_size * args.n_samples))
+    
+    # Symmetrize, so the dense swap is a permutation
+    graphs = QuantumWalkGraphs(adj, ids, args.batch_size, args.n_samples)
+    graphs = ((graphs + graphs.transpose(1, 2)) > 0).float()
+    degree = QuantumWalkDegree(graphs)
+    
+    x = torch.randn(args.batch_size, args.dim)
+    neibs = torch.randn(args.batch_size * args.n_samples, args.dim)
+    
+    init_amps = QuantumWalkInitAmps(graphs, degree)
+    dense_out, dense_time = timeit(lambda: QuantumWalk()(x, neibs, init_amps, graphs, args.time_steps, degree), args.n_iters)
+    
+    arcs = QuantumWalkArcs(graphs)
+    sparse_out, sparse_time = timeit(lambda: SparseQuantumWalk()(x, neibs, arcs, args.time_steps, degree, args.n_samples), args.n_iters)
+    
+    err = float((dense_out - sparse_out).data.abs().max())
+    assert err < 1e-4, 'bench_quantum_walk: dense/sparse mismatch (%f)' % err
+    
+    return {
+        "degree" : degree,
+        "max_abs_err" : err,
+        "dense_time" : dense_time,
+        "sparse_time" : sparse_time,
+        "dense_state_size" : init_amps.numel(),
+        "sparse_state_size" : (arcs['arc_node'].numel() + arcs['node_degree'].numel()) * args.n_samples,
+    }
+
+
+def bench_quantum_coin(args):
+    """ FLOPs + state size of the padded (dense) vs. degree-bucketed quantum walk, on power law neighborhoods """
+    adj = power_law_adj(args.n_nodes, args.max_degree)
+    roots = torch.LongTensor(np.random.choice(args.n_nodes, args.batch_size))
+    ids = UniformNeighborSampler(adj)(roots, n_samples=args.n_samples).contiguous().view(-1)
+    
+    graphs = QuantumWalkGraphs(adj, ids, args.batch_size, args.n_samples)
+    graphs = ((graphs + graphs.transpose(1, 2)) > 0).float()
+    degree = QuantumWalkDegree(graphs)
+    
+    x = torch.randn(args.batch_size, args.dim)
+    neibs = torch.randn(args.batch_size * args.n_samples, args.dim)
+    
+    init_amps = QuantumWalkInitAmps(graphs, degree)
+    dense_out, dense_time = timeit(lambda: QuantumWalk()(x, neibs, init_amps, graphs, args.time_steps, degree), args.n_iters)
+    
+    buckets = QuantumWalkBuckets(QuantumWalkArcs(graphs))
+    bucketed_out, bucketed_time = timeit(lambda: BucketedQuantumWalk()(x, neibs, buckets, args.time_steps, degree, args.n_samples), args.n_iters)
+    
+    err = float((dense_out - bucketed_out).data.abs().max())
+    assert err < 1e-4, 'bench_quantum_coin: dense/bucketed mismatch (%f)' % err
+    
+    # Coin FLOPs per time step: (slots x slots) @ (slots x graph_size) per node
+    n_nodes, walkers = args.batch_size * args.n_samples, args.n_samples
+    dense_flops = 2 * n_nodes * degree * degree * walkers
+    bucketed_flops = sum([2 * n_k * (k + 1) * (k + 1) * walkers for k, n_k in buckets['sizes']])
+    
+    dense_state = n_nodes * degree * walkers
+    bucketed_state = (buckets['arc_node'].numel() + n_nodes) * walkers
+    
+    return {
+        "degree" : degree,
+        "mean_degree" : float(graphs.sum(2).mean()),
+        "max_abs_err" : err,
+        "dense_time" : dense_time,
+        "bucketed_time" : bucketed_time,
+        "dense_coin_flops" : dense_flops,
+        "bucketed_coin_flops" : bucketed_flops,
+        "flop_ratio" : dense_flops / max(1, bucketed_flops),
+        "dense_state_bytes" : 4 * dense_state,
+        "bucketed_state_bytes" : 4 * bucketed_state,
+        "memory_ratio" : dense_state / max(1, bucketed_state),
+    }
+
+
+def bench_quantum_steps(args):
+    """ step-by-step vs. closed form (composed operator) quantum walk, forward + backward, as `time_steps` grows """
+    adj = random_adj(args.n_nodes, args.max_degree)
+    ids = torch.LongTensor(np.random.choice(args.n_nodes, args.batch_size * args.n_samples))
+    
+    graphs = QuantumWalkGraphs(adj, ids, args.batch_size, args.n_samples)
+    graphs = ((graphs + graphs.transpose(1, 2)) > 0).float()
+    degree = QuantumWalkDegree(graphs)
+    walk = {
+        "init_amps" : QuantumWalkInitAmps(graphs, degree),
+        "graphs" : graphs,
+        "degree" : degree,
+        "swap" : QuantumWalkSwapIndex(graphs, degree),
+    }
+    
+    x = torch.randn(args.batch_size, args.dim)
+    neibs = torch.randn(args.batch_size * args.n_samples, args.dim)
+    
+    def run(walk_layer, time_steps):
+        walk_layer(x, neibs, time_steps=time_steps, **walk).sum().backward()
+    
+    res = {"degree" : degree}
+    for time_steps in (4, 16, 64):
+        for name, walk_class in [('steps', QuantumWalk), ('closed_form', ClosedFormQuantumWalk)]:
+            _, res['%s_time_%d' % (name, time_steps)] = timeit(lambda: run(walk_class(), time_steps), args.n_iters)
+            
+            # Measured: bytes saved for backward by one forward pass
+            walk_layer = walk_class()
+            _, res['%s_saved_bytes_%d' % (name, time_steps)] = saved_bytes(lambda: walk_layer(x, neibs, time_steps=time_steps, **walk))
+    
+    return res
+
+
+def bench_sparse_sampler(args):
+    """ legacy vs. CSR (numpy + torch) `SparseUniformNeighborSampler`, for both GraphSAGE hops """
+    if args.problem_path:
+        adj = load_sparse_adj(args.problem_path)
+    else:
+        adj = random_sparse_adj(args.n_nodes, args.max_degree)
+    
+    # Only sample from nodes that have neighbors, so the legacy sampler doesn't divide by zero
+    has_neibs = np.where(np.diff(adj.indptr) > 0)[0]
+    ids = torch.LongTensor(np.random.choice(has_neibs, args.batch_size))
+    
+    samplers = {
+        "legacy" : LegacySparseUniformNeighborSampler(adj),
+        "csr" : SparseUniformNeighborSampler(adj),
+        "csr_torch" : SparseUniformNeighborSampler(adj, use_torch=True),
+    }
+    
+    res = {"n_nodes" : adj.shape[0], "nnz" : adj.nnz}
+    for name, sampler in samplers.items():
+        def run():
+            hop1 = sampler(ids, n_samples=args.n_samples).contiguous().view(-1)
+            hop2 = sampler(hop1, n_samples=args.n_samples_2).contiguous().view(-1)
+            return hop2
+        
+        _, res['%s_time' % name] = timeit(run, args.n_iters)
+    
+    res['speedup'] = res['legacy_time'] / res['csr_time']
+    res['speedup_torch'] = res['legacy_time'] / res['csr_torch_time']
+    return res
+
+
+def bench_metrics(args):
+    """ incremental (confusion count) metrics vs. `sklearn` on stacked predictions -- checks that both agree """
+    n_classes, n_batches = 41, 20
+    batches = {
+        "classification" : [
+            (torch.LongTensor(np.random.choice(n_classes - 1, (args.batch_size, 1))), torch.randn(args.batch_size, n_classes))
+            for _ in range(n_batches)
+        ],
+        "multilabel_classification" : [
+            (torch.FloatTensor((np.random.rand(args.batch_size, n_classes) < 0.1).astype(float)), torch.randn(args.batch_size, n_classes) - 1)
+            for _ in range(n_batches)
+        ],
+        "regression_mae" : [
+            (torch.randn(args.batch_size, 1), torch.randn(args.batch_size, 1))
+            for _ in range(n_batches)
+        ],
+    }
+    
+    res = {"n_preds" : args.batch_size * n_batches}
+    for task, task_batches in batches.items():
+        def run_sklearn():
+            y_true = np.vstack([to_numpy(t) for t, _ in task_batches])
+            y_pred = np.vstack([to_numpy(p) for _, p in task_batches])
+            return getattr(ProblemMetrics, task)(y_true, y_pred)
+        
+        def run_accumulator():
+            accumulator = MetricAccumulator(task)
+            for t, p in task_batches:
+                accumulator.add(t, p)
+            
+            return accumulator.compute()
+        
+        ref, res['%s_sklearn_time' % task] = timeit(run_sklearn, args.n_iters)
+        out, res['%s_accumulator_time' % task] = timeit(run_accumulator, args.n_iters)
+        
+        ref, out = (ref, out) if isinstance(ref, dict) else ({"mae" : ref}, {"mae" : out})
+        for k in ref.keys():
+            err = abs(ref[k] - out[k])
+            assert err < 1e-6, 'bench_metrics: %s %s mismatch (%f)' % (task, k, err)
+        
+        res['%s_speedup' % task] = res['%s_sklearn_time' % task] / res['%s_accumulator_time' % task]
+    
+    return res
+
+
+def bench_torch_sparse_sampler(args):
+    """ numpy/scipy vs. torch CSR sampler, for both GraphSAGE hops -- on the CPU at 1 and `--n-threads` threads, + on the GPU if available """
+    if args.problem_path:
+        adj = load_sparse_adj(args.problem_path)
+    else:
+        adj = random_sparse_adj(args.n_nodes, args.max_degree)
+    
+    ids = torch.LongTensor(np.random.choice(adj.shape[0], args.batch_size))
+    
+    def run(sampler, ids):
+        hop1 = sampler(ids, n_samples=args.n_samples).contiguous().view(-1)
+        hop2 = sampler(hop1, n_samples=args.n_samples_2).contiguous().view(-1)
+        return hop2
+    
+    n_threads = torch.get_num_threads()
+    res = {"n_nodes" : adj.shape[0], "nnz" : adj.nnz, "n_threads" : args.n_threads}
+    
+    scipy_sampler = SparseUniformNeighborSampler(adj)
+    torch_sampler = TorchSparseUniformNeighborSampler(adj)
+    
+    # Same neighbors from both, given the same random draws
+    scipy_out = scipy_sampler(ids, n_samples=args.n_samples, rng=np.random.RandomState(args.seed))
+    torch_out = torch_sampler(ids, n_samples=args.n_samples, rng=np.random.RandomState(args.seed))
+    assert torch.equal(scipy_out.data, torch_out.data), 'bench_torch_sparse_sampler: scipy/torch mismatch'
+    
+    torch.set_num_threads(1)
+    _, res['scipy_time'] = timeit(lambda: run(scipy_sampler, ids), args.n_iters)
+    _, res['torch_1_thread_time'] = timeit(lambda: run(torch_sampler, ids), args.n_iters)
+    
+    torch.set_num_threads(args.n_threads)
+    _, res['torch_time'] = timeit(lambda: run(torch_sampler, ids), args.n_iters)
+    torch.set_num_threads(n_threads)
+    
+    res['speedup'] = res['scipy_time'] / res['torch_time']
+    
+    if torch.cuda.is_available():
+        cuda_ids = ids.cuda()
+        torch_sampler.cuda()
+        
+        def run_cuda():
+            out = run(torch_sampler, cuda_ids)
+            torch.cuda.synchronize()
+            return out
+        
+        _ = run_cuda() # warmup
+        _, res['cuda_time'] = timeit(run_cuda, args.n_iters)
+        res['cuda_speedup'] = res['scipy_time'] / res['cuda_time']
+    
+    return res
+
+
+def bench_uniform_sampler(args):
+    """ legacy (gather whole rows + permute) vs. column-only gather `UniformNeighborSampler`, for both GraphSAGE hops """
+    adj = random_adj(args.n_nodes, args.max_degree)
+    ids = torch.LongTensor(np.random.choice(args.n_nodes, args.batch_size))
+    
+    samplers = {
+        "legacy" : LegacyUniformNeighborSampler(adj),
+        "batch" : UniformNeighborSampler(adj),
+        "row" : RowUniformNeighborSampler(adj),
+    }
+    
+    # Per-batch sampler picks the same neighbors as the legacy one, given the same permutation
+    legacy_out = samplers['legacy'](ids, n_samples=args.n_samples, rng=np.random.RandomState(args.seed))
+    batch_out = samplers['batch'](ids, n_samples=args.n_samples, rng=np.random.RandomState(args.seed))
+    assert torch.equal(legacy_out, batch_out), 'bench_uniform_sampler: legacy/batch mismatch'
+    
+    # Per-row sampler is w/o replacement + uses every column about equally often
+    # (sample from an adjacency whose entries are their own column index)
+    col_adj = torch.arange(0, adj.size(1)).long().unsqueeze(0).repeat(args.batch_size, 1)
+    col_ids = torch.arange(0, args.batch_size).long()
+    cols = np.vstack([to_numpy(RowUniformNeighborSampler(col_adj)(col_ids, n_samples=args.n_samples)) for _ in range(10)])
+    assert all([len(set(row)) == min(args.n_samples, adj.size(1)) for row in cols]), 'bench_uniform_sampler: row sampler repeats columns'
+    col_freq = np.bincount(cols.ravel(), minlength=adj.size(1)) / float(cols.size)
+    
+    res = {"row_col_freq_max_ratio" : float(col_freq.max() * adj.size(1))}
+    for name, sampler in samplers.items():
+        def run():
+            hop1 = sampler(ids, n_samples=args.n_samples).contiguous().view(-1)
+            hop2 = sampler(hop1, n_samples=args.n_samples_2).contiguous().view(-1)
+            return hop2
+        
+        _, res['%s_time' % name] = timeit(run, args.n_iters)
+    
+    # Bytes read + written by each call, for both hops (int64 ids)
+    n_rows = [args.batch_size, args.batch_size * args.n_samples]
+    n_cols = [args.n_samples, args.n_samples_2]
+    
+    # legacy: gather full rows, permute full rows (read + write), slice + `contiguous` (read + write)
+    res['legacy_bytes'] = sum([8 * r * (2 * adj.size(1) + 2 * adj.size(1) + 2 * c) for r, c in zip(n_rows, n_cols)])
+    # batch: index tensor (write), gather (read + write) -- row: + shift + mod over the index
+    res['batch_bytes'] = sum([8 * r * c * 3 for r, c in zip(n_rows, n_cols)])
+    res['row_bytes'] = sum([8 * r * (c * 5 + 1) for r, c in zip(n_rows, n_cols)])
+    
+    res['speedup'] = res['legacy_time'] / res['batch_time']
+    res['speedup_row'] = res['legacy_time'] / res['row_time']
+    return res
+
+
+def bench_model(args, adj, **kwargs):
+    """ 2 layer `GSSupervised` w/ mean aggregators on a dense `adj` -- `kwargs` override the defaults """
+    params = {
+        "input_dim" : args.dim,
+        "n_nodes" : adj.size(0),
+        "n_classes" : 8,
+        "layer_specs" : [
+            {"n_train_samples" : args.n_samples, "n_val_samples" : args.n_samples, "output_dim" : args.dim, "activation" : torch.nn.functional.relu},
+            {"n_train_samples" : args.n_samples_2, "n_val_samples" : args.n_samples_2, "output_dim" : args.dim, "activation" : lambda x: x},
+        ],
+        "aggregator_class" : MeanAggregator,
+        "prep_class" : prep_lookup['identity'],
+        "sampler_class" : UniformNeighborSampler,
+        "adj" : adj,
+        "train_adj" : adj,
+    }
+    params.update(kwargs)
+    return GSSupervised(**params)
+
+
+def bench_dedupe(args):
+    """ per-position vs. unique-node (`dedupe_neighbors`) feature gather + prep, forward + backward, on power law neighborhoods """
+    adj = power_law_adj(args.n_nodes, args.max_degree)
+    feats = Variable(torch.randn(args.n_nodes + 1, args.dim))
+    ids = Variable(torch.LongTensor(np.random.choice(args.n_nodes, args.batch_size, replace=False)))
+    
+    res = {}
+    for prep_name in ['identity', 'linear', 'node_embedding']:
+        models = {}
+        for dedupe in [False, True]:
+            set_seeds(args.seed)
+            models[dedupe] = bench_model(args, adj, prep_class=prep_lookup[prep_name], dedupe_neighbors=dedupe)
+        
+        samples = models[False].sample(ids, train=False)
+        
+        # Same samples -> same output + gradients
+        outs = {}
+        for dedupe, model in models.items():
+            model.zero_grad()
+            out = model(ids, feats, train=False, samples=samples)
+            out.sum().backward()
+            outs[dedupe] = (to_numpy(out), [to_numpy(p.grad) for p in model.parameters()])
+        
+        assert np.allclose(outs[False][0], outs[True][0], atol=1e-5), 'bench_dedupe: %s output mismatch' % prep_name
+        # (gradients are summed in a different order, so compare relative to their scale)
+        assert all([np.allclose(a, b, atol=1e-4 * max(np.abs(a).max(), 1)) for a, b in zip(outs[False][1], outs[True][1])]), 'bench_dedupe: %s grad mismatch' % prep_name
+        
+        for dedupe, model in models.items():
+            def run():
+                model.zero_grad()
+                out = model(ids, feats, train=False, samples=samples)
+                out.sum().backward()
+                return out
+            
+            _, res['%s_%s_time' % (prep_name, 'dedupe' if dedupe else 'dense')] = timeit(run, args.n_iters)
+        
+        res['%s_speedup' % prep_name] = res['%s_dense_time' % prep_name] / res['%s_dedupe_time' % prep_name]
+    
+    # Rows gathered from `feats` (+ prepped) at each hop
+    res['gather_rows'] = [int(s.size(0)) for s in samples]
+    res['gather_rows_dedupe'] = [int(torch.unique(s.data if isinstance(s, Variable) else s).size(0)) for s in samples]
+    res['gather_ratio'] = sum(res['gather_rows_dedupe']) / sum(res['gather_rows'])
+    return res
+
+
+def bench_history(args):
+    """ full multi-hop expansion vs. historical embeddings (one hop + stored hidden layers), forward + backward per training step """
+    adj = power_law_adj(args.n_nodes, args.max_degree)
+    feats = Variable(torch.randn(args.n_nodes + 1, args.dim))
+    
+    models = {}
+    for historical in [False, True]:
+        set_seeds(args.seed)
+        models[historical] = bench_model(args, adj, prep_class=prep_lookup['linear'],
+            historical_embeddings=historical, history_staleness=args.n_iters * 100)
+    
+    # Warm the history up w/ one pass over the nodes
+    history = models[True].history
+    for chunk in torch.arange(0, args.n_nodes + 1).long().split(args.batch_size):
+        _ = models[True].embed(Variable(chunk), feats, train=True)
+    
+    history.n_checked, history.n_stale = 0, 0
+    
+    res = {}
+    batches = [Variable(torch.LongTensor(np.random.choice(args.n_nodes, args.batch_size, replace=False))) for _ in range(args.n_iters)]
+    for historical, model in models.items():
+        def run():
+            for ids in batches:
+                model.zero_grad()
+                out = model(ids, feats, train=True)
+                out.sum().backward()
+            
+            return out
+        
+        _, res['%s_time' % ('history' if historical else 'full')] = timeit(run, 1)
+        res['%s_sampled_rows' % ('history' if historical else 'full')] = sum([int(s.size(0)) for s in model.sample(batches[0])])
+    
+    res['speedup'] = res['full_time'] / res['history_time']
+    res['history'] = history.stats()
+    return res
+
+
+def bench_profiler(args):
+    """ overhead of the `profiler` timers + counters on a training step, disabled vs. enabled """
+    adj = power_law_adj(args.n_nodes, args.max_degree)
+    feats = Variable(torch.randn(args.n_nodes + 1, args.dim))
+    targets = Variable(torch.LongTensor(np.random.randint(0, 8, args.batch_size)))
+    ids = Variable(torch.LongTensor(np.random.choice(args.n_nodes, args.batch_size, replace=False)))
+    
+    set_seeds(args.seed)
+    model = bench_model(args, adj)
+    loss_fn = torch.nn.functional.cross_entropy
+    
+    def run():
+        return model.train_step(ids, feats, targets, loss_fn)
+    
+    res = {}
+    profiler.disable()
+    _, res['disabled_time'] = timeit(run, args.n_iters)
+    
+    profiler.enable()
+    _, res['enabled_time'] = timeit(run, args.n_iters)
+    res['summary'] = profiler.summary()
+    profiler.disable()
+    
+    # Cost of a disabled timer on its own
+    n_calls = 100000
+    t = time()
+    for _ in range(n_calls):
+        with profiler.timer('noop'):
+            pass
+    
+    res['disabled_timer_us'] = (time() - t) / n_calls * 1e6
+    res['overhead'] = res['enabled_time'] / res['disabled_time'] - 1
+    return res
+
+def _ddp_worker(rank, world_size, port, args, problem_path, results):
+    """ `args.n_steps` data-parallel training steps on a (memory-mapped) problem file -- rank 0 reports the time """
+    sys.stdout = open(os.devnull, 'w') # `NodeProblem` logs to stdout
+    init_worker(rank, world_size, port, n_threads=default_threads(world_size))
+    
+    problem = NodeProblem(problem_path, cuda=False, mmap=True)
+    set_seeds(args.seed)
+    model = bench_model(args, problem.adj)
+    model.distribute(world_size)
+    
+    set_seeds(args.seed + rank)
+    def batches():
+        epoch = 0
+        while True:
+            rng = np.random.RandomState([args.seed, epoch])
+            for ids, targets, _ in problem.iterate('train', batch_size=args.batch_size, shuffle=True, rng=rng, shard=(rank, world_size)):
+                yield ids, targets
+            
+            epoch += 1
+    
+    batches = batches()
+    ids, targets = next(batches)
+    _ = model.train_step(ids, problem.feats, targets, problem.loss_fn) # Warmup
+    
+    torch.distributed.barrier()
+    t = time()
+    for _ in range(args.n_steps):
+        ids, targets = next(batches)
+        _ = model.train_step(ids, problem.feats, targets, problem.loss_fn)
+    
+    torch.distributed.barrier()
+    if rank == 0:
+        results.put({"time" : time() - t, "n_nodes" : world_size * args.n_steps * ids.size(0)})
+
+
+def bench_ddp(args):
+    """
+        data-parallel training throughput (trained nodes / sec) w/ 1 ... `--max-procs` worker processes,
+        on a synthetic problem file that every worker memory-maps
+    """
+    tmpdir = tempfile.mkdtemp()
+    problem_path = os.path.join(tmpdir, 'problem.h5')
+    make_synthetic_problem(problem_path, args.n_nodes, max_degree=args.max_degree, feats_dim=args.dim, alpha=args.alpha, seed=args.seed)
+    
+    n_procs = sorted(set([2 ** i for i in range(int(np.log2(args.max_procs)) + 1)] + [args.max_procs]))
+    
+    res = {"n_cores" : multiprocessing.cpu_count()}
+    for n in n_procs:
+        results = multiprocessing.Queue()
+        launch(_ddp_worker, n, args=(args, problem_path, results))
+        out = results.get()
+        res['throughput_%d' % n] = out['n_nodes'] / out['time']
+        res['efficiency_%d' % n] = res['throughput_%d' % n] / (n * res['throughput_1'])
+    
+    shutil.rmtree(tmpdir)
+    return res
+
+# --
+# Sweeps (each `*_lookup` entry, across `--batch-sizes` x `--sample-counts`)
+
+_sweep_problems = {}
+
+def sweep_problems(args):
+    """
+        {format : (adj, feats)} -- the `--problem-path` graph, or synthetic power law graphs
+        in both formats (written to + read back from `NodeProblem` files).  Cached across benches.
+    """
+    if not _sweep_problems:
+        if args.problem_path:
+            adj, feats = load_problem_graph(args.problem_path)
+            _sweep_problems['sparse' if issparse(adj) else 'dense'] = (adj, feats)
+        else:
+            tmpdir = tempfile.mkdtemp()
+            for fmt in ['dense', 'sparse']:
+                path = os.path.join(tmpdir, '%s-problem.h5' % fmt)
+                make_synthetic_problem(path, args.n_nodes, max_degree=args.max_degree, feats_dim=args.dim,
+                    alpha=args.alpha, sparse=fmt == 'sparse', seed=args.seed)
+                _sweep_problems[fmt] = load_problem_graph(path)
+            
+            shutil.rmtree(tmpdir)
+    
+    return _sweep_problems
+
+
+def sweep_row(name, batch_size, n_samples, res, n_items):
+    res.update({
+        "name" : name,
+        "batch_size" : batch_size,
+        "n_samples" : n_samples,
+        "throughput" : n_items / max(res['p50'], 1e-9),
+    })
+    return res
+
+
+def forward_backward(fn):
+    out = fn()
+    if out.requires_grad:
+        out.sum().backward()
+    
+    return out
+
+
+def bench_samplers(args):
+    """ latency + throughput (sampled ids / sec) of each `sampler_lookup` entry, on the graph of its format """
+    problems = sweep_problems(args)
+    
+    rows = []
+    for name, sampler_class in sorted(sampler_lookup.items()):
+        fmt = 'sparse' if 'sparse' in name else 'dense'
+        if fmt not in problems:
+            continue
+        
+        adj, _ = problems[fmt]
+        sampler = sampler_class(adj=adj)
+        n_nodes, offset = adj.shape[0] - 1, 1 if fmt == 'sparse' else 0 # Skip the dummy node
+        for batch_size in args.batch_sizes:
+            for n_samples in args.sample_counts:
+                ids = torch.LongTensor(np.random.choice(n_nodes, batch_size)) + offset
+                res = latency(lambda: sampler(ids, n_samples=n_samples), args.n_iters)
+                rows.append(sweep_row(name, batch_size, n_samples, res, n_items=batch_size * n_samples))
+    
+    return {"results" : rows, "peak_rss_mb" : peak_rss_mb()}
+
+
+def bench_preps(args):
+    """ latency + throughput (rows / sec) of each `prep_lookup` entry, forward + backward, on one hop's worth of sampled rows """
+    _, feats = list(sweep_problems(args).values())[0]
+    n_nodes = feats.size(0)
+    
+    rows = []
+    for name, prep_class in sorted(prep_lookup.items()):
+        prep = prep_class(input_dim=feats.size(1), n_nodes=n_nodes)
+        for batch_size in args.batch_sizes:
+            for n_samples in args.sample_counts:
+                ids = Variable(torch.LongTensor(np.random.choice(n_nodes - 1, batch_size * n_samples)))
+                res = latency(lambda: forward_backward(lambda: prep(ids, feats[ids], layer_idx=1)), args.n_iters)
+                rows.append(sweep_row(name, batch_size, n_samples, res, n_items=batch_size * n_samples))
+    
+    return {"results" : rows, "peak_rss_mb" : peak_rss_mb()}
+
+
+def bench_aggregators(args):
+    """ latency + throughput (nodes / sec) of each `aggregator_lookup` entry, forward + backward """
+    _, feats = list(sweep_problems(args).values())[0]
+    n_nodes = feats.size(0)
+    
+    rows = []
+    for name, aggregator_class in sorted(aggregator_lookup.items()):
+        agg = aggregator_class(input_dim=feats.size(1), output_dim=args.dim, activation=torch.nn.functional.relu)
+        for batch_size in args.batch_sizes:
+            for n_samples in args.sample_counts:
+                x = Variable(feats[torch.LongTensor(np.random.choice(n_nodes - 1, batch_size))])
+                neibs = Variable(feats[torch.LongTensor(np.random.choice(n_nodes - 1, batch_size * n_samples))])
+                res = latency(lambda: forward_backward(lambda: agg(x, neibs)), args.n_iters)
+                rows.append(sweep_row(name, batch_size, n_samples, res, n_items=batch_size))
+    
+    return {"results" : rows, "peak_rss_mb" : peak_rss_mb()}
+
+
+def bench_fused_mean(args):
+    """
+        `FusedMeanAggregator` vs. `MeanAggregator`: parity (output + gradients, for both orders, w/
+        and w/o `neib_index`), then latency + throughput of each, forward + backward -- the fused
+        aggregator on both per-position neighbor rows and unique rows + `neib_index`
+    """
+    _, feats = list(sweep_problems(args).values())[0]
+    n_nodes = feats.size(0)
+    
+    mean = MeanAggregator(input_dim=feats.size(1), output_dim=args.dim, activation=torch.nn.functional.relu)
+    
+    def run(agg, x, neibs, neib_index=None):
+        """ output + gradients of `(out ** 2).sum()` wrt. `x`, `neibs` + the weights """
+        x, neibs = Variable(x, requires_grad=True), Variable(neibs, requires_grad=True)
+        agg.zero_grad()
+        out = agg(x, neibs) if neib_index is None else agg(x, neibs, neib_index=neib_index)
+        (out ** 2).sum().backward()
+        if isinstance(agg, MeanAggregator):
+            weight_grad = torch.stack([agg.fc_x.weight.grad.data.t(), agg.fc_neib.weight.grad.data.t()])
+        else:
+            weight_grad = agg.weight.grad.data
+        
+        return [to_numpy(out), to_numpy(x.grad), to_numpy(neibs.grad), to_numpy(weight_grad)]
+    
+    # Parity
+    x = feats[torch.LongTensor(np.random.choice(n_nodes - 1, args.batch_size))]
+    neib_ids = torch.LongTensor(np.random.choice(n_nodes - 1, args.batch_size * args.n_samples))
+    uneib_ids, neib_index = torch.unique(neib_ids, return_inverse=True)
+    
+    ref = run(mean, x, feats[neib_ids])
+    
+    # (the gradient of a unique row is the sum over its copies)
+    ref_unique = list(ref)
+    ref_unique[2] = np.zeros((uneib_ids.size(0), feats.size(1)), dtype=ref[2].dtype)
+    np.add.at(ref_unique[2], to_numpy(neib_index), ref[2])
+    
+    max_err = 0.0
+    for order in ['mean_first', 'project_first']:
+        fused = FusedMeanAggregator.from_mean(mean, order=order)
+        for expected, out in [
+            (ref, run(fused, x, feats[neib_ids])),
+            (ref_unique, run(fused, x, feats[uneib_ids], neib_index=neib_index)),
+        ]:
+            for a, b in zip(expected, out):
+                # (summed in a different order, so compare relative to scale)
+                assert np.allclose(a, b, atol=1e-4 * max(np.abs(a).max(), 1)), 'bench_fused_mean: %s mismatch' % order
+                max_err = max(max_err, float(np.abs(a - b).max()))
+    
+    # Latency
+    fused = FusedMeanAggregator.from_mean(mean)
+    rows = []
+    for batch_size in args.batch_sizes:
+        for n_samples in args.sample_counts:
+            x = Variable(feats[torch.LongTensor(np.random.choice(n_nodes - 1, batch_size))])
+            neib_ids = torch.LongTensor(np.random.choice(n_nodes - 1, batch_size * n_samples))
+            uneib_ids, neib_index = torch.unique(neib_ids, return_inverse=True)
+            neibs, uneibs = Variable(feats[neib_ids]), Variable(feats[uneib_ids])
+            
+            cost = fused.cost(batch_size, n_samples, n_rows=uneib_ids.size(0))
+            for name, fn in [
+                ('mean', lambda: mean(x, neibs)),
+                ('fused_mean', lambda: fused(x, neibs)),
+                ('fused_mean_unique', lambda: fused(x, uneibs, neib_index=neib_index)),
+            ]:
+                res = latency(lambda: forward_backward(fn), args.n_iters)
+                row = sweep_row(name, batch_size, n_samples, res, n_items=batch_size)
+                if name == 'fused_mean_unique':
+                    row['order'] = 'mean_first' if cost['mean_first'] <= cost['project_first'] else 'project_first'
+                    row['unique_ratio'] = uneib_ids.size(0) / neib_ids.size(0)
+                
+                rows.append(row)
+    
+    return {"max_err" : max_err, "results" : rows, "peak_rss_mb" : peak_rss_mb()}
+
+
+def attention_reference(agg, x, neibs):
+    """ the original (single head, unmasked) `AttentionAggregator.forward` -- `att` over `x` + all neighbors, w/ an explicit softmax dim """
+    neib_att = agg.att(neibs)
+    x_att = agg.att(x)
+    neib_att = neib_att.view(x.size(0), -1, neib_att.size(1))
+    x_att = x_att.view(x_att.size(0), x_att.size(1), 1)
+    ws = torch.nn.functional.softmax(torch.bmm(neib_att, x_att).squeeze(2), dim=1)
+    
+    agg_neib = neibs.view(x.size(0), -1, neibs.size(1))
+    agg_neib = torch.sum(agg_neib * ws.unsqueeze(-1), dim=1)
+    
+    out = agg.combine_fn([agg.fc_x(x), agg.fc_neib(agg_neib)])
+    if agg.activation:
+        out = agg.activation(out)
+    
+    return out
+
+
+def bench_attention(args):
+    """
+        `AttentionAggregator`: latency + throughput of `attention_reference`, of 1 head + of 4 heads,
+        forward + backward.  Parity + masking are checked in `tests/test_aggregators.py`
+        
+        `neib_floats` is the size of the per-neighbor intermediates (attention MLP outputs + the
+        weighted neighbor copies) of each, in floats.
+    """
+    _, feats = list(sweep_problems(args).values())[0]
+    n_nodes = feats.size(0)
+    relu = torch.nn.functional.relu
+    
+    agg = AttentionAggregator(input_dim=feats.size(1), output_dim=args.dim, activation=relu)
+    multi = MultiHeadAttentionAggregator(input_dim=feats.size(1), output_dim=args.dim, activation=relu)
+    
+    # Latency
+    rows = []
+    for batch_size in args.batch_sizes:
+        for n_samples in args.sample_counts:
+            x = Variable(feats[torch.LongTensor(np.random.choice(n_nodes - 1, batch_size))])
+            neibs = Variable(feats[torch.LongTensor(np.random.choice(n_nodes - 1, batch_size * n_samples))])
+            mask = neibs.data.new(batch_size * n_samples).fill_(1).long()
+            
+            n_neibs = batch_size * n_samples
+            for name, fn, neib_floats in [
+                ('reference', lambda: attention_reference(agg, x, neibs), n_neibs * (2 * agg.hidden_dim + 1 + feats.size(1))),
+                ('attention', lambda: agg(x, neibs), n_neibs * (agg.hidden_dim + agg.n_heads)),
+                ('attention_masked', lambda: agg(x, neibs, mask=mask), n_neibs * (agg.hidden_dim + agg.n_heads)),
+                ('multihead_attention', lambda: multi(x, neibs), n_neibs * (multi.hidden_dim + multi.n_heads)),
+            ]:
+                res = latency(lambda: forward_backward(fn), args.n_iters)
+                row = sweep_row(name, batch_size, n_samples, res, n_items=batch_size)
+                row['neib_floats'] = neib_floats
+                rows.append(row)
+    
+    return {"results" : rows, "peak_rss_mb" : peak_rss_mb()}
+
+
+def symmetric_walk(adj, ids, batch_size, n_samples):
+    """ `QuantumWalk` inputs for the symmetrized neighborhoods of `ids` """
+    graphs = QuantumWalkGraphs(adj, ids, batch_size, n_samples)
+    graphs = ((graphs + graphs.transpose(1, 2)) > 0).float()
+    degree = QuantumWalkDegree(graphs)
+    return {
+        "init_amps" : QuantumWalkInitAmps(graphs, degree),
+        "graphs" : graphs,
+        "degree" : degree,
+        "swap" : QuantumWalkSwapIndex(graphs, degree),
+    }
+
+
+def bench_walks(args):
+    """
+        latency + throughput (graphs / sec) of `GenerateQuantumWalkGraphs` + of each `walk_lookup`
+        entry (`prepare`, then the walk forward), on neighborhoods sampled from the dense graph
+    """
+    problems = sweep_problems(args)
+    if 'dense' not in problems:
+        return {"results" : [], "peak_rss_mb" : peak_rss_mb()}
+    
+    adj, _ = problems['dense']
+    sampler = UniformNeighborSampler(adj)
+    
+    rows = []
+    for batch_size in args.batch_sizes:
+        for n_samples in args.sample_counts:
+            roots = torch.LongTensor(np.random.choice(adj.shape[0] - 1, batch_size))
+            ids = sampler(roots, n_samples=n_samples).contiguous().view(-1)
+            x = Variable(torch.randn(batch_size, args.dim))
+            neibs = Variable(torch.randn(batch_size * n_samples, args.dim))
+            
+            res = latency(lambda: GenerateQuantumWalkGraphs(adj, ids, batch_size, n_samples), args.n_iters)
+            rows.append(sweep_row('generate_graphs', batch_size, n_samples, res, n_items=batch_size))
+            
+            for mode, walk_class in sorted(walk_lookup.items()):
+                walk_layer = walk_class()
+                try:
+                    res = latency(lambda: walk_layer.prepare(adj, ids, batch_size, n_samples), args.n_iters)
+                    rows.append(sweep_row('prepare_%s' % mode, batch_size, n_samples, res, n_items=batch_size))
+                    walk, name = walk_layer.prepare(adj, ids, batch_size, n_samples), 'walk_%s' % mode
+                except AssertionError as e:
+                    # The dense + closed form walks need symmetric neighborhoods -- time them on symmetrized ones
+                    rows.append({"name" : 'prepare_%s' % mode, "batch_size" : batch_size, "n_samples" : n_samples, "error" : str(e)})
+                    walk, name = symmetric_walk(adj, ids, batch_size, n_samples), 'walk_%s_symmetrized' % mode
+                
+                res = latency(lambda: walk_layer(x, neibs, time_steps=args.time_steps, **walk), args.n_iters)
+                rows.append(sweep_row(name, batch_size, n_samples, res, n_items=batch_size))
+    
+    return {"results" : rows, "peak_rss_mb" : peak_rss_mb()}
+
+
+bench_lookup = {
+    "quantum_graphs" : bench_quantum_graphs,
+    "quantum_walk" : bench_quantum_walk,
+    "quantum_coin" : bench_quantum_coin,
+    "quantum_steps" : bench_quantum_steps,
+    "sparse_sampler" : bench_sparse_sampler,
+    "metrics" : bench_metrics,
+    "uniform_sampler" : bench_uniform_sampler,
+    "torch_sparse_sampler" : bench_torch_sparse_sampler,
+    "dedupe" : bench_dedupe,
+    "history" : bench_history,
+    "profiler" : bench_profiler,
+    "ddp" : bench_ddp,
+    "samplers" : bench_samplers,
+    "preps" : bench_preps,
+    "aggregators" : bench_aggregators,
+    "fused_mean" : bench_fused_mean,
+    "attention" : bench_attention,
+    "walks" : bench_walks,
+}
+
+# --
+# Results
+
+def run_isolated(bench, argv):
+    """
+        result of one bench, run in a fresh interpreter (w/ the same args) -- `peak_rss_mb` is
+        `ru_maxrss`, which only ever grows, so in a shared process every bench would report the
+        largest peak of the benches before it.  Here it's the peak of a process (imports included)
+        that only ran `bench`.
+        
+        A failing bench (its traceback is on stderr) is reported as `{"bench" : bench, "error" : ...}`,
+        so the rest of the run still happens + gets written.
+    """
+    try:
+        out = subprocess.check_output([sys.executable, os.path.abspath(__file__)] + argv + ['--bench', bench, '--child'])
+    except subprocess.CalledProcessError as e:
+        return {"bench" : bench, "error" : "exit status %d" % e.returncode}
+    
+    return json.loads(out.decode().strip().split('\n')[-1])
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(results, baseline, threshold):
+    """ p50 ratio (current / baseline) of every sweep row that's in both runs -- rows over `threshold` are regressions """
+    def row_key(bench, row):
+        return '%s/%s/%d/%d' % (bench, row['name'], row['batch_size'], row['n_samples'])
+    
+    base = {}
+    for res in baseline['results']:
+        for row in res.get('results', []):
+            if 'p50' in row:
+                base[row_key(res['bench'], row)] = row
+    
+    ratios = {}
+    for res in results:
+        for row in res.get('results', []):
+            key = row_key(res['bench'], row)
+            if key in base and 'p50' in row:
+                ratios[key] = row['p50'] / max(base[key]['p50'], 1e-9)
+    
+    return {
+        "baseline_commit" : baseline['meta'].get('commit'),
+        "n_compared" : len(ratios),
+        "median_ratio" : float(np.median(list(ratios.values()))) if ratios else None,
+        "regressions" : dict([(k, v) for k, v in ratios.items() if v > threshold]),
+    }
+
+# --
+# Args
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    
+    parser.add_argument('--bench', type=str, default=','.join(sorted(bench_lookup.keys())))
+    parser.add_argument('--problem-path', type=str)
+    
+    parser.add_argument('--n-nodes', type=int, default=10000)
+    parser.add_argument('--max-degree', type=int, default=128)
+    parser.add_argument('--batch-size', type=int, default=512)
+    parser.add_argument('--n-samples', type=int, default=25)
+    parser.add_argument('--n-samples-2', type=int, default=10)
+    parser.add_argument('--dim', type=int, default=128)
+    parser.add_argument('--time-steps', type=int, default=4)
+    parser.add_argument('--n-iters', type=int, default=3)
+    parser.add_argument('--n-threads', type=int, default=torch.get_num_threads())
+    parser.add_argument('--n-steps', type=int, default=20) # training steps per `ddp` run
+    parser.add_argument('--max-procs', type=int, default=multiprocessing.cpu_count())
+    
+    # Sweeps
+    parser.add_argument('--batch-sizes', type=str, default='64,256,1024')
+    parser.add_argument('--sample-counts', type=str, default='10,25')
+    parser.add_argument('--alpha', type=float, default=2.0) # power law exponent of synthetic graphs
+    
+    # Synthetic problem
+    parser.add_argument('--make-problem', type=str) # write a synthetic problem here + exit
+    parser.add_argument('--sparse', action="store_true")
+    
+    # Results
+    parser.add_argument('--outpath', type=str) # all results + run metadata, as JSON
+    parser.add_argument('--baseline', type=str) # `--outpath` of an earlier run, to compare against
+    parser.add_argument('--regression-threshold', type=float, default=1.2)
+    
+    parser.add_argument('--seed', default=123, type=int)
+    parser.add_argument('--child', action="store_true") # set by `run_isolated` -- just print the result
+    
+    args = parser.parse_args()
+    args.bench = args.bench.split(',')
+    for b in args.bench:
+        assert b in bench_lookup, 'parse_args: bench not in %s' % str(bench_lookup.keys())
+    
+    args.batch_sizes = list(map(int, args.batch_sizes.split(',')))
+    args.sample_counts = list(map(int, args.sample_counts.split(',')))
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    
+    if args.make_problem:
+        res = make_synthetic_problem(args.make_problem, args.n_nodes, max_degree=args.max_degree,
+            feats_dim=args.dim, alpha=args.alpha, sparse=args.sparse, seed=args.seed)
+        res.update({"outpath" : args.make_problem})
+        print(json.dumps(res))
+        sys.exit(0)
+    
+    results = []
+    for b in args.bench:
+        if len(args.bench) > 1:
+            res = run_isolated(b, sys.argv[1:])
+        else:
+            set_seeds(args.seed)
+            res = bench_lookup[b](args)
+            res.update({"bench" : b})
+        
+        print(json.dumps(res, double_precision=5))
+        sys.stdout.flush()
+        results.append(res)
+    
+    if args.child:
+        sys.exit(0)
+    
+    run = {
+        "meta" : {
+            "commit" : git_commit(),
+            "torch_version" : torch.__version__,
+            "n_threads" : torch.get_num_threads(),
+            "peak_rss_mb" : peak_rss_mb(),
+            "args" : vars(args),
+        },
+        "results" : results,
+    }
+    
+    if args.outpath:
+        json.dump(run, open(args.outpath, 'w'), double_precision=5)
+    
+    if args.baseline:
+        res = compare_results(results, json.load(open(args.baseline)), args.regression_threshold)
+        res.update({"bench" : "compare"})
+        print(json.dumps(res, double_precision=5))
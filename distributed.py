@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+"""
+    distributed.py
+    
+    Data-parallel training across local CPU processes, w/ `torch.distributed` + gloo
+    
+    Each worker trains a full copy of the model on its shard of the training nodes
+    (see `NodeProblem.chunks(..., shard=...)`).  Gradients are summed across workers
+    after every `backward` -- packed into one flat buffer, so it's one all-reduce per
+    step -- and then averaged, so every replica takes the same optimizer step.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import socket
+from datetime import timedelta
+from multiprocessing import Process, cpu_count
+
+import torch
+import torch.distributed as dist
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def default_threads(world_size):
+    """ split the cores evenly between workers """
+    return max(1, cpu_count() // world_size)
+
+
+def init_worker(rank, world_size, port, backend='gloo', n_threads=None, timeout_minutes=None):
+    """
+        join the process group (+ limit intra-op threads, so workers don't oversubscribe the cores)
+        
+        `timeout_minutes` bounds how long a collective (all-reduce, barrier) waits for the
+        other workers -- default is torch's (30 min for gloo)
+    """
+    if n_threads is not None:
+        torch.set_num_threads(n_threads)
+    
+    kwargs = {"timeout" : timedelta(minutes=timeout_minutes)} if timeout_minutes is not None else {}
+    dist.init_process_group(backend, init_method='tcp://127.0.0.1:%d' % port, rank=rank, world_size=world_size, **kwargs)
+
+
+def launch(fn, world_size, args=(), port=None):
+    """
+        run `fn(rank, world_size, port, *args)` in `world_size` forked processes + wait for them
+        
+        Fails if any worker fails.  Forked, so workers share whatever the parent has
+        already loaded (copy-on-write).
+    """
+    port = port or free_port()
+    procs = [Process(target=fn, args=(rank, world_size, port) + tuple(args)) for rank in range(world_size)]
+    for p in procs:
+        p.start()
+    
+    for p in procs:
+        p.join()
+    
+    exitcodes = [p.exitcode for p in procs]
+    assert all([e == 0 for e in exitcodes]), 'launch: workers failed w/ exit codes %s' % str(exitcodes)
+
+
+def broadcast_params(params, src=0):
+    """ copy `src`'s parameters to every worker """
+    for p in params:
+        dist.broadcast(p.data, src)
+
+
+def allreduce_grads(params, world_size):
+    """
+        average the gradients of `params` across workers
+        
+        Missing gradients count as zero -- params w/o a gradient on any worker keep
+        `grad=None`, so the optimizer still skips them.
+    """
+    params = [p for p in params if p.requires_grad]
+    grads = [p.grad.data if p.grad is not None else p.data.new(p.size()).zero_() for p in params]
+    has_grad = params[0].data.new([float(p.grad is not None) for p in params])
+    
+    flat = torch.cat([g.contiguous().view(-1) for g in grads] + [has_grad])
+    dist.all_reduce(flat)
+    flat /= world_size
+    
+    offset = 0
+    for p, has_grad in zip(params, flat[-len(params):].tolist()):
+        if has_grad > 0:
+            if p.grad is None:
+                p.grad = torch.autograd.Variable(p.data.new(p.size()).zero_())
+            
+            p.grad.data.copy_(flat[offset:offset + p.numel()].view_as(p.grad.data))
+        
+        offset += p.numel()
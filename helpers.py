@@ -6,7 +6,14 @@
 
 from __future__ import print_function
 
+import sys
 import numpy as np
+import ujson as json
+from threading import Thread
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
 
 import torch
 from torch.autograd import Variable
@@ -20,7 +27,41 @@ def set_seeds(seed=0):
 
 def to_numpy(x):
     if isinstance(x, Variable):
-        return to_numpy(x.data)
+        x = x.data
     
     return x.cpu().numpy() if x.is_cuda else x.numpy()
 
+
+class AsyncLogger(object):
+    """
+        Writes JSON lines from a background thread, so `json.dumps` + `flush` don't
+        stall the train loop.  Records are written in order; the stream is flushed
+        whenever the queue runs dry.
+    """
+    def __init__(self, stream=sys.stdout, double_precision=5):
+        self.stream = stream
+        self.double_precision = double_precision
+        self.queue = Queue()
+        
+        self.thread = Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def log(self, record):
+        self.queue.put(record)
+    
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            
+            print(json.dumps(record, double_precision=self.double_precision), file=self.stream)
+            if self.queue.empty():
+                self.stream.flush()
+        
+        self.stream.flush()
+    
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
@@ -11,10 +11,13 @@ from functools import partial
 
 import torch
 from torch import nn
+from torch.autograd import Variable
 from torch.nn import functional as F
 
 from lr import LRSchedule
-from nn_modules import GenerateQuantumWalkGraphs, QuantumWalk
+from profiler import profiler
+from distributed import broadcast_params, allreduce_grads
+from nn_modules import aggregator_lookup, prep_lookup, sampler_lookup, walk_lookup, QuantumWalkCache, HistoricalEmbeddings
 
 # --
 # Model
@@ -32,6 +35,15 @@ class GSSupervised(nn.Module):
         weight_decay=0.0,
         lr_schedule='constant',
         quantum_walk=False,
+        quantum_walk_mode='dense',
+        quantum_walk_cache_mb=256,
+        quantum_walk_steps=4,
+        dedupe_neighbors=False,
+        mask_dummy_neighbors=False,
+        historical_embeddings=False,
+        history_staleness=100,
+        history_mb=1024,
+        history_refresh=1024,
         epochs=10):
         
         super(GSSupervised, self).__init__()
@@ -44,6 +56,8 @@ class GSSupervised(nn.Module):
         self.val_sampler = sampler_class(adj=adj)
         self.train_sample_fns = [partial(self.train_sampler, n_samples=s['n_train_samples']) for s in layer_specs]
         self.val_sample_fns = [partial(self.val_sampler, n_samples=s['n_val_samples']) for s in layer_specs]
+        self.n_val_samples = [s['n_val_samples'] for s in layer_specs]
+        self.n_nodes = n_nodes
 
         # Make graphs if using the quantum walk aggregator
         #if aggregator_class == "QWAggregator":
@@ -52,22 +66,23 @@ class GSSupervised(nn.Module):
 
         # Prep
         self.prep = prep_class(input_dim=input_dim, n_nodes=n_nodes)
+        self.dedupe_neighbors = dedupe_neighbors
         input_dim = self.prep.output_dim
 
         #self.aggregator_class = aggregator_class
         self.quantum_walk = quantum_walk
-        self.quantum_neighbors = False
         if self.quantum_walk:
-            self.quantum_neighbors = True
             self.adj = adj
             self.train_adj = train_adj
-            self.time_steps = 4
-            self.walk_layer = QuantumWalk()
-            self.all_amps = []
-            self.all_graphs = []
-            self.max_degrees = []
+            self.time_steps = quantum_walk_steps
+            self.walk_layer = walk_lookup[quantum_walk_mode]()
+            self.walk_cache = QuantumWalkCache(max_bytes=int(quantum_walk_cache_mb * 2 ** 20)) if quantum_walk_cache_mb > 0 else None
         
         # Network
+        assert not mask_dummy_neighbors or getattr(aggregator_class, 'accepts_mask', False), \
+            'GSSupervised: mask_dummy_neighbors not supported by %s' % aggregator_class.__name__
+        
+        self.mask_dummy_neighbors = mask_dummy_neighbors
         agg_layers = []
         for spec in layer_specs:
             agg = aggregator_class(
@@ -81,59 +96,356 @@ class GSSupervised(nn.Module):
         self.agg_layers = nn.Sequential(*agg_layers)
         self.fc = nn.Linear(input_dim, n_classes, bias=True)
         
+        # Historical embeddings of the hidden layers (training only)
+        self.history = None
+        if historical_embeddings:
+            assert not quantum_walk, 'GSSupervised: historical_embeddings not supported w/ quantum_walk'
+            assert len(agg_layers) > 1, 'GSSupervised: historical_embeddings needs > 1 layer'
+            self.history = HistoricalEmbeddings(
+                n_nodes=n_nodes,
+                dims=[agg.output_dim for agg in agg_layers[:-1]],
+                max_staleness=history_staleness,
+                max_bytes=int(history_mb * 2 ** 20),
+            )
+            self.history_refresh = history_refresh
+        
         # --
         # Define optimizer
         
+        self.world_size = 1
         self.lr_scheduler = partial(getattr(LRSchedule, lr_schedule), lr_init=lr_init)
         self.lr = self.lr_scheduler(0.0)
         self.optimizer = torch.optim.Adam(self.parameters(), lr=self.lr, weight_decay=weight_decay)
     
-    def forward(self, ids, feats, train=True):
-        # Sample neighbors
+    def sample(self, ids, train=True, rng=None, n_hops=None, hop=0):
+        """
+            flat ids of the sampled neighbors at each layer -- can run ahead of `forward`, eg in a loader
+            
+            Samples the first `n_hops` layers -- by default all of them, or only the first when
+            training w/ historical embeddings (deeper hops come from `self.history`).  `ids` sit
+            at `hop`, so the samples use the sizes of hops `hop + 1, ...`.
+        """
         sample_fns = self.train_sample_fns if train else self.val_sample_fns
+        if n_hops is None and train and self.history is not None:
+            n_hops = 1
+        
+        sample_fns = sample_fns[hop:][:n_hops]
+        
+        samples = []
+        for hop, sampler_fn in enumerate(sample_fns, hop):
+            with profiler.timer('sample_%d' % (hop + 1)):
+                ids = sampler_fn(ids=ids, rng=rng).contiguous().view(-1)
+            
+            samples.append(ids)
+        
+        return samples
+    
+    def forward(self, ids, feats, train=True, samples=None):
+        with profiler.timer('forward'):
+            return self.fc(self.embed(ids, feats, train=train, samples=samples))
+    
+    def embed(self, ids, feats, train=True, samples=None):
+        """ (normalized) output of the last aggregator layer -- the input to `fc` """
+        if train and self.history is not None:
+            out = self._embed_historical(ids, feats, samples=samples)
+        else:
+            out = self._embed_layers(ids, feats, train=train, samples=samples)[-1]
+        
+        return F.normalize(out, dim=1) # ?? Do we actually want this? ... Sometimes ...
+    
+    def _embed_layers(self, ids, feats, train=True, samples=None, hop=0):
+        """
+            output of each aggregator layer for `ids`, from their full sampled neighborhoods
+            
+            W/ `hop > 0`, `ids` are embedded as they are at that hop of `forward` (same preps +
+            sample sizes), so only the first `len(self.agg_layers) - hop` layers are computed.
+        """
+        n_layers = len(self.agg_layers) - hop
+        
+        # Sample neighbors
+        if samples is None:
+            samples = self.sample(ids, train=train, n_hops=n_layers, hop=hop)
+        
         if self.quantum_walk:
             adj = self.train_adj if train else self.adj
 
-        has_feats = feats is not None
-        tmp_feats = feats[ids] if has_feats else None
-        all_feats = [self.prep(ids, tmp_feats, layer_idx=0)]
+        all_feats = [self._gather_prep(ids, feats, hop=hop)]
+        all_index = [None]
 
         original_id_len = len(ids)
-        for layer_idx, sampler_fn in enumerate(sample_fns):
-            ids = sampler_fn(ids=ids).contiguous().view(-1)
-            if self.quantum_neighbors:
-                amps, graphs, max_degree = GenerateQuantumWalkGraphs(adj, ids, int(original_id_len), int(len(ids)/original_id_len))
-                self.all_amps.append(amps)
-                self.all_graphs.append(graphs)
-                self.max_degrees.append(max_degree)
+        all_walks = []
+        for layer_idx, ids in enumerate(samples):
+            if self.quantum_walk:
+                with profiler.timer('walk_graphs_%d' % (hop + layer_idx + 1)):
+                    all_walks.append(self.walk_layer.prepare(adj, ids, int(original_id_len), int(len(ids)/original_id_len), cache=self.walk_cache))
             
-            tmp_feats = feats[ids] if has_feats else None
-            all_feats.append(self.prep(ids, tmp_feats, layer_idx=layer_idx + 1))
+            if self.dedupe_neighbors:
+                # Gather + prep each unique node once (expanded back to the sampled positions below)
+                with profiler.timer('unique_%d' % (hop + layer_idx + 1)):
+                    uids, inverse = torch.unique(ids, return_inverse=True)
+                
+                profiler.observe('unique_ratio_%d' % (hop + layer_idx + 1), uids.size(0) / ids.size(0))
+                all_feats.append(self._gather_prep(uids, feats, hop=hop + layer_idx + 1))
+                all_index.append(inverse)
+            else:
+                if profiler.enabled:
+                    profiler.observe('unique_ratio_%d' % (hop + layer_idx + 1), torch.unique(ids.data).size(0) / ids.size(0))
+                
+                all_feats.append(self._gather_prep(ids, feats, hop=hop + layer_idx + 1))
+                all_index.append(None)
+        
+        # Aggregators that take `neib_index` (eg `FusedMeanAggregator`) read unique neighbor rows directly
+        first_layer = next(self.agg_layers.children())
+        pass_index = getattr(first_layer, 'accepts_neib_index', False) and not self.quantum_walk
+        expand = lambda f, index: f[index] if index is not None else f
+        if not pass_index:
+            all_feats = [expand(f, index) for f, index in zip(all_feats, all_index)]
+        
+        masks = [self._neib_mask(s, train=train) if self.mask_dummy_neighbors else None for s in samples]
         
-        if self.quantum_walk:
-            self.quantum_neighbors = False
         # Sequentially apply layers, per original (little weird, IMO)
         # Each iteration reduces length of array by one
-        for agg_layer in self.agg_layers.children():
+        layers = []
+        for layer_idx, agg_layer in enumerate(list(self.agg_layers.children())[:n_layers]):
             # the quantum walk layer returns the modified neighbors
             if self.quantum_walk:
-                all_feats = [agg_layer(all_feats[k], self.walk_layer(all_feats[k], all_feats[k + 1], self.all_amps[k], self.all_graphs[k], self.time_steps, self.max_degrees[k])) for k in range(len(all_feats) - 1)]
+                with profiler.timer('walk_%d' % layer_idx):
+                    neib_feats = [self.walk_layer(all_feats[k], all_feats[k + 1], time_steps=self.time_steps, **all_walks[k]) for k in range(len(all_feats) - 1)]
             else:
-                all_feats = [agg_layer(all_feats[k], all_feats[k + 1]) for k in range(len(all_feats) - 1)]
+                neib_feats = all_feats[1:]
+            
+            with profiler.timer('aggregate_%d' % layer_idx):
+                if pass_index and layer_idx == 0:
+                    all_feats = [agg_layer(expand(all_feats[k], all_index[k]), neib_feats[k], neib_index=all_index[k + 1]) for k in range(len(all_feats) - 1)]
+                else:
+                    all_feats = [self._call_agg(agg_layer, all_feats[k], neib_feats[k], mask=masks[k]) for k in range(len(all_feats) - 1)]
+            
+            layers.append(all_feats[0])
+        
         assert len(all_feats) == 1, "len(all_feats) != 1"
-        out = F.normalize(all_feats[0], dim=1) # ?? Do we actually want this? ... Sometimes ...
-        return self.fc(out)
+        return layers
+    
+    def _embed_historical(self, ids, feats, samples=None):
+        """
+            output of the last aggregator layer for `ids`, w/ one hop of sampled neighbors
+            
+            The first layer is computed exactly.  Later layers read the neighbors' hidden
+            embeddings from `self.history` (w/o gradient).  Stale ones are recomputed first,
+            as the neighbors are embedded at hop 1 of `forward` -- at most `history_refresh`
+            per step, oldest first, so rows that are never computed yet may read as zeros
+            for a few steps.  The hidden embeddings of `ids` are then pushed back to
+            `self.history`, unless the prep depends on the hop (they'd be hop 0 embeddings).
+        """
+        neibs = samples[0] if samples is not None else self.sample(ids, train=True)[0]
+        uneibs, inverse = torch.unique(neibs.data if isinstance(neibs, Variable) else neibs, return_inverse=True)
+        
+        n_stale = self.history.n_stale
+        stale = self.history.stale(uneibs, limit=self.history_refresh if self.history_refresh > 0 else None).nonzero().view(-1)
+        profiler.count('history_stale', self.history.n_stale - n_stale)
+        profiler.count('history_refreshed', stale.numel())
+        if stale.numel() > 0:
+            with torch.no_grad(), profiler.timer('history_refresh'):
+                stale_ids = uneibs[stale]
+                self.history.push(stale_ids, self._embed_layers(stale_ids, feats, train=True, hop=1))
+        
+        hist = self.history.pull(uneibs)
+        mask = self._neib_mask(neibs, train=True) if self.mask_dummy_neighbors else None
+        
+        x, neib_feats = self._gather_prep(ids, feats, hop=0), self._gather_prep(neibs, feats, hop=1)
+        with profiler.timer('aggregate_0'):
+            x = self._call_agg(self.agg_layers[0], x, neib_feats, mask=mask)
+        
+        layers = [x]
+        for layer_idx in range(1, len(self.agg_layers)):
+            with profiler.timer('aggregate_%d' % layer_idx):
+                x = self._call_agg(self.agg_layers[layer_idx], x, hist[layer_idx - 1][inverse], mask=mask)
+            
+            layers.append(x)
+        
+        if not getattr(self.prep, 'hop_dependent', False):
+            self.history.push(ids, [layer.detach() for layer in layers[:-1]])
+        
+        self.history.tick()
+        return x
+    
+    def _neib_mask(self, neibs, train=True):
+        """ nonzero where the sampled `neibs` aren't the sampler's dummy node """
+        sampler = self.train_sampler if train else self.val_sampler
+        return neibs != sampler.dummy_id
+    
+    def _call_agg(self, agg_layer, x, neib_feats, mask=None):
+        return agg_layer(x, neib_feats) if mask is None else agg_layer(x, neib_feats, mask=mask)
+    
+    def _prep_feats(self, ids, feats, layer_idx):
+        return self.prep(ids, feats[ids] if feats is not None else None, layer_idx=layer_idx)
+    
+    def _gather_prep(self, ids, feats, hop):
+        """ `_prep_feats`, timed + w/ gathered bytes counted per hop """
+        with profiler.timer('gather_%d' % hop):
+            tmp_feats = feats[ids] if feats is not None else None
+        
+        if tmp_feats is not None:
+            profiler.count('gather_bytes_%d' % hop, tmp_feats.numel() * 4)
+        
+        with profiler.timer('prep_%d' % hop):
+            return self.prep(ids, tmp_feats, layer_idx=hop)
+    
+    def _aggregate(self, layer_idx, x, neibs, neib_feats):
+        """ apply one aggregator layer to `x`, w/ (flat) sampled neighbors `neibs` """
+        if self.quantum_walk:
+            walk = self.walk_layer.prepare(self.adj, neibs, int(x.size(0)), int(neibs.size(0) / x.size(0)), cache=self.walk_cache)
+            neib_feats = self.walk_layer(x, neib_feats, time_steps=self.time_steps, **walk)
+        
+        mask = self._neib_mask(neibs, train=False) if self.mask_dummy_neighbors else None
+        return self._call_agg(self.agg_layers[layer_idx], x, neib_feats, mask=mask)
+    
+    def infer(self, ids, feats, chunk_size=8192):
+        """
+            Layerwise full-graph inference, for evaluation.
+            
+            Computes each hidden layer's embedding for every node once (in chunks of
+            `chunk_size`, w/ `val_sampler`), then the output layer for `ids` from those --
+            linear in n_nodes * n_samples per layer, instead of re-embedding the sampled
+            neighborhood of every batch.
+            
+            Matches `forward(train=False)` in distribution:  layer `l` embeddings of neighbors
+            use the sample size of the hop they sit at in `forward` (`n_val_samples[L - l]`),
+            and `ids` use one `n_val_samples[0]` sample for all layers.  (Except w/ the
+            quantum walk, where each node's own neighbors make up its walk graph.)
+        """
+        n_layers = len(self.agg_layers)
+        all_ids = Variable(torch.arange(0, self.n_nodes).long())
+        if ids.is_cuda:
+            all_ids = all_ids.cuda()
+        
+        with torch.no_grad():
+            # Hidden layers, for every node (as a neighbor)
+            tables = []
+            for layer_idx in range(n_layers - 1):
+                depth = n_layers - 1 - layer_idx
+                
+                table = []
+                for chunk in all_ids.split(chunk_size):
+                    neibs = self.val_sampler(chunk, n_samples=self.n_val_samples[depth]).contiguous().view(-1)
+                    if layer_idx == 0:
+                        x, neib_feats = self._prep_feats(chunk, feats, depth), self._prep_feats(neibs, feats, depth + 1)
+                    else:
+                        x, neib_feats = tables[-1][chunk], tables[-1][neibs]
+                    
+                    table.append(self._aggregate(layer_idx, x, neibs, neib_feats))
+                
+                tables.append(torch.cat(table))
+            
+            # All layers, for `ids`
+            preds = []
+            for chunk in ids.split(chunk_size):
+                neibs = self.val_sampler(chunk, n_samples=self.n_val_samples[0]).contiguous().view(-1)
+                x = self._prep_feats(chunk, feats, 0)
+                for layer_idx in range(n_layers):
+                    neib_feats = self._prep_feats(neibs, feats, 1) if layer_idx == 0 else tables[layer_idx - 1][neibs]
+                    x = self._aggregate(layer_idx, x, neibs, neib_feats)
+                
+                preds.append(self.fc(F.normalize(x, dim=1)))
+        
+        return torch.cat(preds)
+    
+    def distribute(self, world_size):
+        """ data-parallel training w/ `world_size` workers (see `distributed.py`) -- syncs the weights from rank 0 """
+        assert not (self.quantum_walk and hasattr(self.walk_layer, 'coins')), \
+            'GSSupervised.distribute: lazily created quantum walk coins can differ between workers'
+        
+        self.world_size = world_size
+        if world_size > 1:
+            broadcast_params(self.parameters())
     
     def set_progress(self, progress):
         self.lr = self.lr_scheduler(progress)
         LRSchedule.set_lr(self.optimizer, self.lr)
     
-    def train_step(self, ids, feats, targets, loss_fn):
+    def train_step(self, ids, feats, targets, loss_fn, samples=None):
         self.optimizer.zero_grad()
-        preds = self(ids, feats, train=True)
+        preds = self(ids, feats, train=True, samples=samples)
         loss = loss_fn(preds, targets.squeeze())
-        loss.backward()
-        torch.nn.utils.clip_grad_norm(self.parameters(), 5)
-        self.optimizer.step()
+        with profiler.timer('backward'):
+            loss.backward()
+        
+        if self.world_size > 1:
+            with profiler.timer('allreduce'):
+                allreduce_grads(self.parameters(), self.world_size)
+        
+        with profiler.timer('optimizer'):
+            torch.nn.utils.clip_grad_norm(self.parameters(), 5)
+            self.optimizer.step()
+        
         return preds
+    
+    def load_state_dict(self, state_dict, strict=True):
+        # Dense quantum walk coins are created on the first forward pass -- make them first
+        if self.quantum_walk and hasattr(self.walk_layer, 'coins'):
+            n_coins = len([k for k in state_dict.keys() if k.startswith('walk_layer.coins.')])
+            for i in range(len(self.walk_layer.coins), n_coins):
+                self.walk_layer.coins.append(nn.Parameter(state_dict['walk_layer.coins.%d' % i].clone()))
+        
+        return super(GSSupervised, self).load_state_dict(state_dict, strict=strict)
+
+# --
+# Checkpoints
 
+def build_model(config, adj, train_adj):
+    """
+        `GSSupervised` from a plain config -- lookup keys instead of classes, so that
+        it can be saved w/ the weights.  Hidden layers use relu, the last layer is linear.
+    """
+    n_layers = len(config['output_dims'])
+    return GSSupervised(**{
+        "sampler_class" : sampler_lookup[config['sampler_class']],
+        "adj" : adj,
+        "train_adj" : train_adj,
+        
+        "prep_class" : prep_lookup[config['prep_class']],
+        "aggregator_class" : aggregator_lookup[config['aggregator_class']],
+        
+        "input_dim" : config['input_dim'],
+        "n_nodes"   : config['n_nodes'],
+        "n_classes" : config['n_classes'],
+        "layer_specs" : [
+            {
+                "n_train_samples" : config['n_train_samples'][i],
+                "n_val_samples" : config['n_val_samples'][i],
+                "output_dim" : config['output_dims'][i],
+                "activation" : F.relu if i < n_layers - 1 else (lambda x: x),
+            } for i in range(n_layers)
+        ],
+        
+        "lr_init" : config['lr_init'],
+        "lr_schedule" : config['lr_schedule'],
+        "weight_decay" : config['weight_decay'],
+        "quantum_walk" : config['quantum_walk'],
+        "quantum_walk_mode" : config['quantum_walk_mode'],
+        "quantum_walk_cache_mb" : config['quantum_walk_cache_mb'],
+        "quantum_walk_steps" : config['quantum_walk_steps'],
+        "dedupe_neighbors" : config.get('dedupe_neighbors', False),
+        "mask_dummy_neighbors" : config.get('mask_dummy_neighbors', False),
+        "historical_embeddings" : config.get('historical_embeddings', False),
+        "history_staleness" : config.get('history_staleness', 100),
+        "history_mb" : config.get('history_mb', 1024),
+        "history_refresh" : config.get('history_refresh', 1024),
+    })
+
+
+def save_checkpoint(model, config, path):
+    torch.save({
+        "config" : config,
+        "state_dict" : model.state_dict(),
+    }, path)
+
+
+def load_checkpoint(path, adj, train_adj, cuda=False):
+    """ rebuild a model saved w/ `save_checkpoint` -- `adj`/`train_adj` come from the problem """
+    checkpoint = torch.load(path, map_location=lambda storage, loc: storage)
+    model = build_model(checkpoint['config'], adj=adj, train_adj=train_adj)
+    model.load_state_dict(checkpoint['state_dict'])
+    if cuda:
+        model = model.cuda()
+    
+    return model, checkpoint['config']
@@ -11,6 +11,7 @@ from torch.autograd import Variable
 
 import numpy as np
 from scipy import sparse
+from collections import OrderedDict
 from helpers import to_numpy
 
 # --
@@ -34,21 +35,55 @@ class UniformNeighborSampler(object):
         
         This seems like a "definitely wrong" thing to do -- but it runs pretty fast, and
         I don't know what kind of degradation it causes in practice.
+        
+        All samplers take an optional `rng` (np.random.RandomState) -- if it's not
+        given, they use the global numpy/torch RNGs -- and have a `dummy_id`, the id
+        of the dummy node that pads neighborhoods.
+        
+        Picks one random set of `n_samples` columns per batch, and only gathers those
+        columns (instead of the whole `[len(ids), max_degree]` block).  W/ `per_row=True`,
+        each row gets its own independent set of columns instead -- the `n_samples`
+        smallest of `max_degree` uniform keys, still w/o replacement.
     """
     
-    def __init__(self, adj):
+    def __init__(self, adj, per_row=False):
         self.adj = adj
+        self.per_row = per_row
+        self.dummy_id = adj.size(0) - 1
     
-    def __call__(self, ids, n_samples=-1):
-        tmp = self.adj[ids]
-        perm = torch.randperm(tmp.size(1))
-        if ids.is_cuda:
-            perm = perm.cuda()
+    def __call__(self, ids, n_samples=-1, rng=None):
+        max_degree = self.adj.size(1)
+        n_cols = len(range(max_degree)[:n_samples])
         
-        tmp = tmp[:,perm]
-        tmp = tmp[:,:n_samples]
+        if self.per_row:
+            if rng is None:
+                keys = ids.data.float().new(ids.size(0), max_degree).uniform_()
+            else:
+                keys = torch.from_numpy(rng.random_sample((ids.size(0), max_degree)))
+                if ids.is_cuda:
+                    keys = keys.cuda()
+            
+            cols = keys.topk(n_cols, dim=1, largest=False)[1]
+        else:
+            if rng is None:
+                perm = torch.randperm(max_degree)
+            else:
+                perm = torch.from_numpy(rng.permutation(max_degree))
+            
+            if ids.is_cuda:
+                perm = perm.cuda()
+            
+            cols = perm[:n_cols].unsqueeze(0)
+        
+        # Flat gather of just the sampled `[len(ids), n_samples]` entries
+        idx = ids.unsqueeze(1) * max_degree + cols
+        return self.adj.take(idx)
 
-        return tmp
+
+class RowUniformNeighborSampler(UniformNeighborSampler):
+    """ `UniformNeighborSampler` w/ an independent sample of columns for each row """
+    def __init__(self, adj):
+        super(RowUniformNeighborSampler, self).__init__(adj, per_row=True)
 
 
 
@@ -69,34 +104,48 @@ class SparseUniformNeighborSampler(object):
         Have to increment/decrement by 1 in a couple of places.  In the regular
         uniform sampler, this "dummy node" is at the end.
         
-        Ideally, obviously, we'd be doing this sampling on the GPU.  But it does not
-        appear that torch.sparse.LongTensor can support this ATM.
+        Sampling works directly on the CSR arrays: the neighbors of node i are
+        `adj.data[adj.indptr[i]:adj.indptr[i + 1]]`, so a sample is one gather at
+        `indptr[ids] + randint(degree)`.  Nodes w/o neighbors get the dummy node.
+        
+        `use_torch=True` does the gather w/ torch ops instead of numpy (on the CPU) --
+        see `TorchSparseUniformNeighborSampler` for sampling on the GPU.
     """
-    def __init__(self, adj,):
+    def __init__(self, adj, use_torch=False):
         assert sparse.issparse(adj), "SparseUniformNeighborSampler: not sparse.issparse(adj)"
+        adj = adj.tocsr()
         self.adj = adj
+        self.dummy_id = 0
         
-        idx, partial_degrees = np.unique(adj.nonzero()[0], return_counts=True)
-        self.degrees = np.zeros(adj.shape[0]).astype(int)
-        self.degrees[idx] = partial_degrees
+        self.indptr = adj.indptr.astype(np.int64)
+        self.neibs = adj.data.astype(np.int64)
+        self.degrees = np.diff(self.indptr)
         
-    def __call__(self, ids, n_samples=128):
+        self.use_torch = use_torch
+        if use_torch:
+            self.torch_indptr = torch.from_numpy(self.indptr)
+            self.torch_neibs = torch.from_numpy(self.neibs)
+    
+    def __call__(self, ids, n_samples=128, rng=None):
         assert n_samples > 0, 'SparseUniformNeighborSampler: n_samples must be set explicitly'
         is_cuda = ids.is_cuda
         
-        ids = to_numpy(ids)
-        
-        tmp = self.adj[ids]
-        
-        sel = np.random.choice(self.adj.shape[1], (ids.shape[0], n_samples))
-        sel = sel % self.degrees[ids].reshape(-1, 1)
-        tmp = tmp[
-            np.arange(ids.shape[0]).repeat(n_samples).reshape(-1),
-            np.array(sel).reshape(-1)
-        ]
-        tmp = np.asarray(tmp).squeeze() 
+        if self.use_torch:
+            ids = ids.data if isinstance(ids, Variable) else ids
+            tmp = _sample_csr(self.torch_indptr, self.torch_neibs, ids.cpu(), n_samples, rng=rng)
+        else:
+            ids = to_numpy(ids)
+            rng = rng if rng is not None else np.random
+            
+            degrees = self.degrees[ids].reshape(-1, 1)
+            offsets = (rng.random_sample((ids.shape[0], n_samples)) * degrees).astype(np.int64)
+            offsets = np.minimum(offsets, np.maximum(degrees - 1, 0))
+            
+            sel = np.minimum(self.indptr[ids].reshape(-1, 1) + offsets, max(self.neibs.shape[0] - 1, 0))
+            tmp = np.where(degrees > 0, self.neibs[sel], 0)
+            tmp = torch.from_numpy(tmp)
         
-        tmp = Variable(torch.LongTensor(tmp))
+        tmp = Variable(tmp)
         
         if is_cuda:
             tmp = tmp.cuda()
@@ -104,9 +153,67 @@ class SparseUniformNeighborSampler(object):
         return tmp
 
 
+class TorchSparseUniformNeighborSampler(object):
+    """
+        Same sampling as `SparseUniformNeighborSampler`, but the CSR `indptr` + neighbor
+        arrays are torch tensors that live on the same device as the ids (moved to the
+        GPU on the first CUDA call).  Degree lookup, random offsets + the gather are all
+        torch ops, so there's no round trip through numpy/scipy per layer.
+    """
+    def __init__(self, adj):
+        assert sparse.issparse(adj), "TorchSparseUniformNeighborSampler: not sparse.issparse(adj)"
+        adj = adj.tocsr()
+        self.dummy_id = 0
+        
+        self.indptr = torch.from_numpy(adj.indptr.astype(np.int64))
+        self.neibs = torch.from_numpy(adj.data.astype(np.int64))
+    
+    def cuda(self):
+        self.indptr = self.indptr.cuda()
+        self.neibs = self.neibs.cuda()
+        return self
+    
+    def __call__(self, ids, n_samples=128, rng=None):
+        assert n_samples > 0, 'TorchSparseUniformNeighborSampler: n_samples must be set explicitly'
+        ids = ids.data if isinstance(ids, Variable) else ids
+        if ids.is_cuda and not self.indptr.is_cuda:
+            self.cuda()
+        
+        return Variable(_sample_csr(self.indptr, self.neibs, ids, n_samples, rng=rng))
+
+
+def _sample_csr(indptr, neibs, ids, n_samples, rng=None):
+    """
+        `n_samples` uniform w/ replacement neighbors of each id, from CSR `indptr` + neighbor arrays (torch)
+        
+        Runs on whatever device `indptr`/`neibs`/`ids` are on -- random offsets are drawn there too,
+        unless they come from `rng`.
+    """
+    starts = indptr[ids]
+    degrees = (indptr[ids + 1] - starts).unsqueeze(1)
+    
+    if rng is None:
+        rand = degrees.double().new(ids.size(0), n_samples).uniform_()
+    else:
+        rand = torch.from_numpy(rng.random_sample((ids.size(0), n_samples)))
+        if ids.is_cuda:
+            rand = rand.cuda()
+    
+    offsets = (rand * degrees.double()).long()
+    offsets = torch.min(offsets, (degrees - 1).clamp(min=0))
+    
+    sel = (starts.unsqueeze(1) + offsets).clamp(max=max(neibs.size(0) - 1, 0))
+    
+    # `take` is a flat gather -- much faster than advanced indexing here
+    out = neibs.take(sel)
+    return out.masked_fill_((degrees == 0).expand_as(out), 0)
+
+
 sampler_lookup = {
     "uniform_neighbor_sampler" : UniformNeighborSampler,
+    "row_uniform_neighbor_sampler" : RowUniformNeighborSampler,
     "sparse_uniform_neighbor_sampler" : SparseUniformNeighborSampler,
+    "torch_sparse_uniform_neighbor_sampler" : TorchSparseUniformNeighborSampler,
 }
 
 # --
@@ -127,6 +234,8 @@ class IdentityPrep(nn.Module):
 
 
 class NodeEmbeddingPrep(nn.Module):
+    hop_dependent = True # nodes at hop 0 don't see their own embedding
+    
     def __init__(self, input_dim, n_nodes, embedding_dim=64):
         """ adds node embedding """
         super(NodeEmbeddingPrep, self).__init__()
@@ -175,6 +284,91 @@ prep_lookup = {
     "linear" : LinearPrep,
 }
 
+# --
+# Historical embeddings
+
+class HistoricalEmbeddings(object):
+    """
+        Node-indexed store of each hidden layer's output, for training w/o expanding every hop
+        
+        `push` overwrites the rows of the given nodes (+ stamps them w/ the current step),
+        `pull` reads them back.  Rows that were never pushed, or were last pushed more than
+        `max_staleness` steps ago, are reported by `stale` so that they can be recomputed.
+        
+        Tables are float32 if they fit in `max_bytes`, otherwise float16.  They're moved to
+        the GPU on the first CUDA call.
+    """
+    def __init__(self, n_nodes, dims, max_staleness=100, max_bytes=2 ** 30):
+        n_bytes = 4 * n_nodes * sum(dims)
+        assert n_bytes // 2 <= max_bytes, \
+            "HistoricalEmbeddings: %d nodes x %d dims doesn't fit in %d bytes" % (n_nodes, sum(dims), max_bytes)
+        
+        self.half = n_bytes > max_bytes
+        self.tables = [torch.zeros(n_nodes, dim) for dim in dims]
+        if self.half:
+            self.tables = [table.half() for table in self.tables]
+        
+        self.updated = torch.LongTensor(n_nodes).fill_(-1)
+        self.max_staleness = max_staleness
+        self.step = 0
+        
+        self.n_checked = 0
+        self.n_stale = 0
+    
+    def cuda(self):
+        self.tables = [table.cuda() for table in self.tables]
+        self.updated = self.updated.cuda()
+        return self
+    
+    def _check_device(self, ids):
+        ids = ids.data if isinstance(ids, Variable) else ids
+        if ids.is_cuda and not self.updated.is_cuda:
+            self.cuda()
+        
+        return ids
+    
+    def stale(self, ids, limit=None):
+        """ mask of the `ids` whose rows need recomputing -- w/ `limit`, only the (at most) `limit` oldest of them """
+        ids = self._check_device(ids)
+        updated = self.updated[ids]
+        stale = (updated < 0) | (self.step - updated > self.max_staleness)
+        
+        n_stale = int(stale.long().sum())
+        self.n_checked += ids.size(0)
+        self.n_stale += n_stale
+        
+        if limit is not None and n_stale > limit:
+            age = updated.masked_fill(stale == 0, self.step + 1) # never pushed (-1) first, fresh rows last
+            oldest = age.sort()[1][:limit]
+            stale = stale.new(stale.size()).zero_()
+            stale[oldest] = 1
+        
+        return stale
+    
+    def push(self, ids, embs):
+        ids = self._check_device(ids)
+        for table, emb in zip(self.tables, embs):
+            emb = emb.data if isinstance(emb, Variable) else emb
+            table[ids] = emb.half() if self.half else emb.float()
+        
+        self.updated[ids] = self.step
+    
+    def pull(self, ids):
+        ids = self._check_device(ids)
+        return [Variable(table[ids].float()) for table in self.tables]
+    
+    def tick(self):
+        self.step += 1
+    
+    def stats(self):
+        return {
+            "step" : self.step,
+            "n_checked" : self.n_checked,
+            "n_stale" : self.n_stale,
+            "stale_rate" : self.n_stale / float(self.n_checked) if self.n_checked > 0 else 0.0,
+            "n_bytes" : sum([table.numel() * (2 if self.half else 4) for table in self.tables]),
+        }
+
 # --
 # Aggregators
 
@@ -206,6 +400,82 @@ class MeanAggregator(nn.Module, AggregatorMixin):
         return out
 
 
+class FusedMeanAggregator(nn.Module, AggregatorMixin):
+    """
+        `MeanAggregator` w/ `fc_x` + `fc_neib` stacked into one `[2, input_dim, output_dim]`
+        weight, applied w/ one batched GEMM (instead of two GEMMs + `torch.cat`)
+        
+        The mean commutes w/ the neighbor projection, so it's applied either first
+        (`mean_first`: mean the `k` neighbors of each node, then project `batch` rows) or
+        last (`project_first`: project the neighbor rows, then mean) -- whichever `cost`
+        says takes fewer FLOPs.  Projecting first only pays off when the neighbor rows are
+        shared, ie passed as unique rows + `neib_index` (the row of each sampled neighbor).
+        
+        Computes the same function as `MeanAggregator` (w/ the default `combine_fn`) --
+        `from_mean` copies the weights over.  `order` forces one of the two orders.
+    """
+    accepts_neib_index = True
+    
+    def __init__(self, input_dim, output_dim, activation, order=None):
+        super(FusedMeanAggregator, self).__init__()
+        assert order in [None, 'mean_first', 'project_first'], 'FusedMeanAggregator: unknown order %s' % order
+        
+        # Same init as `nn.Linear`
+        stdv = 1. / np.sqrt(input_dim)
+        self.weight = nn.Parameter(torch.FloatTensor(2, input_dim, output_dim).uniform_(-stdv, stdv))
+        
+        self.output_dim_ = output_dim
+        self.activation = activation
+        self.combine_fn = lambda x: torch.cat(x, dim=1)
+        self.order = order
+    
+    @classmethod
+    def from_mean(cls, agg, order=None):
+        """ `FusedMeanAggregator` w/ the weights of a `MeanAggregator` """
+        fused = cls(input_dim=agg.fc_x.in_features, output_dim=agg.fc_x.out_features, activation=agg.activation, order=order)
+        fused.weight.data.copy_(torch.stack([agg.fc_x.weight.data.t(), agg.fc_neib.weight.data.t()]))
+        return fused
+    
+    def cost(self, batch_size, n_samples, n_rows=None):
+        """ FLOPs of each order, for `batch_size` nodes w/ `n_samples` neighbors each, in `n_rows` neighbor rows """
+        input_dim, output_dim = self.weight.size(1), self.weight.size(2)
+        n_neibs = batch_size * n_samples
+        n_rows = n_rows if n_rows is not None else n_neibs
+        return {
+            "mean_first" : n_neibs * input_dim + 2 * 2 * batch_size * input_dim * output_dim,
+            "project_first" : 2 * (n_rows + batch_size) * input_dim * output_dim + n_neibs * output_dim,
+        }
+    
+    def forward(self, x, neibs, neib_index=None):
+        batch_size = x.size(0)
+        order = self.order
+        if order is None:
+            n_neibs = neib_index.size(0) if neib_index is not None else neibs.size(0)
+            cost = self.cost(batch_size, n_neibs // batch_size, n_rows=neibs.size(0))
+            order = 'mean_first' if cost['mean_first'] <= cost['project_first'] else 'project_first'
+        
+        if order == 'mean_first':
+            if neib_index is not None:
+                neibs = neibs[neib_index]
+            
+            agg_neib = neibs.view(batch_size, -1, neibs.size(1)).mean(dim=1)
+            out = torch.bmm(torch.stack([x, agg_neib]), self.weight)
+        else:
+            h_neibs = neibs.mm(self.weight[1])
+            if neib_index is not None:
+                h_neibs = h_neibs[neib_index]
+            
+            agg_neib = h_neibs.view(batch_size, -1, h_neibs.size(1)).mean(dim=1)
+            out = torch.stack([x.mm(self.weight[0]), agg_neib])
+        
+        # [2, batch, output_dim] -> [batch, 2 * output_dim], in `MeanAggregator`'s column order
+        out = out.transpose(0, 1).contiguous().view(batch_size, -1)
+        if self.activation:
+            out = self.activation(out)
+        
+        return out
+
+
 class PoolAggregator(nn.Module, AggregatorMixin):
     def __init__(self, input_dim, output_dim, pool_fn, activation, hidden_dim=512, combine_fn=lambda x: torch.cat(x, dim=1)):
         super(PoolAggregator, self).__init__()
@@ -289,32 +559,60 @@ class LSTMAggregator(nn.Module, AggregatorMixin):
 
 
 class AttentionAggregator(nn.Module, AggregatorMixin):
-    def __init__(self, input_dim, output_dim, activation, hidden_dim=32, combine_fn=lambda x: torch.cat(x, dim=1)):
+    """
+        Weighted average of the neighbors, w/ weights `softmax_k(att(neib_k) . att(x))` --
+        `att` is a 2 layer MLP, w/ one `hidden_dim` slice of its output per head.  The
+        weighted averages of the heads are concatenated before `fc_neib`.
+        
+        `att(neib) . att(x) = tanh(W1 neib) . (W2^T W2 tanh(W1 x))`, so the second layer
+        of `att` is only applied to `x` -- the scores are one `bmm` of the neighbors' hidden
+        layer w/ `[batch, n_heads, hidden_dim]` queries, w/o an `[n_neibs, n_heads * hidden_dim]`
+        intermediate.  The weighted averages are one more `bmm`.
+        
+        `mask` (`[batch * n_samples]`, nonzero for real neighbors) drops padding/dummy
+        neighbors from the softmax -- nodes w/o any real neighbors get a zero average.
+    """
+    accepts_mask = True
+    
+    def __init__(self, input_dim, output_dim, activation, hidden_dim=32, n_heads=1, combine_fn=lambda x: torch.cat(x, dim=1)):
         super(AttentionAggregator, self).__init__()
         
         self.att = nn.Sequential(*[
             nn.Linear(input_dim, hidden_dim, bias=False),
             nn.Tanh(),
-            nn.Linear(hidden_dim, hidden_dim, bias=False),
+            nn.Linear(hidden_dim, hidden_dim * n_heads, bias=False),
         ])
         self.fc_x = nn.Linear(input_dim, output_dim, bias=False)
-        self.fc_neib = nn.Linear(input_dim, output_dim, bias=False)
+        self.fc_neib = nn.Linear(input_dim * n_heads, output_dim, bias=False)
         
+        self.hidden_dim = hidden_dim
+        self.n_heads = n_heads
         self.output_dim_ = output_dim
         self.activation = activation
         self.combine_fn = combine_fn
     
-    def forward(self, x, neibs):
-        # Compute attention weights
-        neib_att = self.att(neibs)
-        x_att    = self.att(x)
-        neib_att = neib_att.view(x.size(0), -1, neib_att.size(1))
-        x_att    = x_att.view(x_att.size(0), x_att.size(1), 1)
-        ws       = F.softmax(torch.bmm(neib_att, x_att).squeeze())
-        
-        # Weighted average of neighbors
-        agg_neib = neibs.view(x.size(0), -1, neibs.size(1))
-        agg_neib = torch.sum(agg_neib * ws.unsqueeze(-1), dim=1)
+    def forward(self, x, neibs, mask=None):
+        batch_size, hidden_dim, n_heads = x.size(0), self.hidden_dim, self.n_heads
+        
+        # Queries: W2^T W2 tanh(W1 x), per head -> [batch, hidden_dim, n_heads]
+        w2 = self.att[2].weight.view(n_heads, hidden_dim, hidden_dim)
+        x_att = self.att(x).view(batch_size, n_heads, hidden_dim).transpose(0, 1)
+        query = torch.bmm(x_att, w2).permute(1, 2, 0)
+        
+        # Scores: tanh(W1 neib) . query -> [batch, n_samples, n_heads]
+        neib_att = self.att[1](self.att[0](neibs)).view(batch_size, -1, hidden_dim)
+        scores = torch.bmm(neib_att, query)
+        if mask is not None:
+            mask = mask.view(batch_size, -1, 1)
+            scores = scores.masked_fill(mask == 0, -1e9)
+        
+        ws = F.softmax(scores, dim=1)
+        if mask is not None:
+            ws = ws * mask.type_as(ws) # (all-dummy neighborhoods)
+        
+        # Weighted average of neighbors, per head -> [batch, n_heads * input_dim]
+        agg_neib = torch.bmm(ws.transpose(1, 2), neibs.view(batch_size, -1, neibs.size(1)))
+        agg_neib = agg_neib.view(batch_size, -1)
         
         out = self.combine_fn([self.fc_x(x), self.fc_neib(agg_neib)])
         if self.activation:
@@ -323,12 +621,26 @@ class AttentionAggregator(nn.Module, AggregatorMixin):
         return out
 
 
+class MultiHeadAttentionAggregator(AttentionAggregator):
+    def __init__(self, input_dim, output_dim, activation, hidden_dim=32, n_heads=4, combine_fn=lambda x: torch.cat(x, dim=1)):
+        super(MultiHeadAttentionAggregator, self).__init__(**{
+            "input_dim" : input_dim,
+            "output_dim" : output_dim,
+            "activation" : activation,
+            "hidden_dim" : hidden_dim,
+            "n_heads" : n_heads,
+            "combine_fn" : combine_fn,
+        })
+
+
 aggregator_lookup = {
     "mean" : MeanAggregator,
+    "fused_mean" : FusedMeanAggregator,
     "max_pool" : MaxPoolAggregator,
     "mean_pool" : MeanPoolAggregator,
     "lstm" : LSTMAggregator,
     "attention" : AttentionAggregator,
+    "multihead_attention" : MultiHeadAttentionAggregator,
 }
 
 class QuantumWalk(nn.Module):
@@ -336,53 +648,59 @@ class QuantumWalk(nn.Module):
         super(QuantumWalk, self).__init__()
         self.coins = nn.ParameterList()
     
-    def forward(self, x, neibs, init_amps, graphs, time_steps, degree):
+    def prepare(self, adj, ids, batch_size, graph_size, cache=None):
+        graphs, degree, pairs = QuantumWalkGraphPairs(adj, ids, batch_size, graph_size, cache=cache)
+        
+        init_amps = nn.Parameter(QuantumWalkInitAmps(graphs, degree))
+        if ids.is_cuda:
+            init_amps = init_amps.cuda()
+        
+        return {
+            "init_amps" : init_amps,
+            "graphs" : graphs,
+            "degree" : degree,
+            "swap" : QuantumWalkSwapIndex(graphs, degree, pairs=pairs),
+        }
+    
+    def step_coins(self, time_steps, degree):
+        """
+            coin of each time step, for a `degree` sized coin space
+        
+            `self.coins` holds `time_steps` coins per degree seen so far, in the order the
+            degrees were first seen -- a new degree gets fresh Grover coins.  The coins of a
+            degree are found by their size, so the layout round trips through `state_dict`.
+        """
+        for offset in range(0, len(self.coins), time_steps):
+            if self.coins[offset].size(0) == degree:
+                return [self.coins[offset + t] for t in range(time_steps)]
+        
+        coins = []
+        for t in range(time_steps):
+            coin = torch.FloatTensor(groverDiffusion(degree)) if degree > 0 else torch.FloatTensor(0, 0)
+            coins.append(nn.Parameter(coin))
+            self.coins.append(coins[-1])
+        
+        return coins
+    
+    def forward(self, x, neibs, init_amps, graphs, time_steps, degree, swap=None):
 
         amps = init_amps
+        coins = self.step_coins(time_steps, degree)
 
-        # Need to make coins for two different sized matrices
-        if len(self.coins) == 0:
-            for t in range(time_steps):
-                self.coins.append(nn.Parameter(torch.FloatTensor(
-                    groverDiffusion(degree))))
-        elif len(self.coins) == time_steps:
-            for t in range(time_steps):
-                self.coins.append(nn.Parameter(torch.FloatTensor(
-                    groverDiffusion(degree))))
-
+        # Swap operator only depends on `graphs`, so build it once for all time steps
+        if swap is None:
+            swap = QuantumWalkSwapIndex(graphs, degree)
+        
+        if init_amps.is_cuda:
+            swap = swap.cuda()
+        
         for t in range(time_steps):
             # Coin Operator
-            # Need to make sure we are matmul with the right coin
-            if len(self.coins[0]) == degree:
-                a=torch.matmul(amps.permute(0,1,3,2), self.coins[t]).permute(0,1,3,2)
-            else:
-                a=torch.matmul(amps.permute(0,1,3,2), self.coins[t+time_steps]).permute(0,1,3,2)
-
-            #Swap Operator: The loop is a workaround to allow for permuting elements without destroying the gradient
-            app = []
-            for i in range(amps.size()[0]):
-                ai=a[i]
-
-                # Moving the creation of the swap operator here to decrease the size of memory needed, will slow computation down though - trade off
-                swap_a, swap_b = [], []
-                inds=np.zeros(graphs.shape[1])
-                for j in range(graphs.shape[1]):
-                    neighbors=np.argwhere(graphs[i][j].numpy()==1).flatten()
-                    for n in range(degree):
-                        if n < len(neighbors):
-                            swap_a.append(neighbors[n])
-                            swap_b.append(int(inds[neighbors[n]]))
-                            inds[neighbors[n]]+=1
-                        else:
-                            swap_a.append(j)
-                            swap_b.append(n)
-                swap_a = torch.LongTensor(swap_a)
-                swap_b = torch.LongTensor(swap_b)
-                #if x.is_cuda:
-                #    swap_a, swap_b = swap_a.cuda(), swap_b.cuda()
-
-                app.append(ai[swap_a, swap_b].view((1,)+init_amps.size()[1:]))
-            amps=torch.cat(app,0)
+            a=torch.matmul(coins[t].t(), amps)
+            
+            # Swap Operator: one gather over the (batch, node, coin slot) rows of the whole batch
+            amps = a.view(-1, a.size(3))[swap].view(init_amps.size())
+        
         d = torch.sum(amps*amps,dim=2)
         quant_neibs = torch.matmul(torch.transpose(d,1,2),neibs.view(torch.transpose(d,1,2).shape[0], -1, x.shape[1]))
 
@@ -390,8 +708,537 @@ class QuantumWalk(nn.Module):
 
         return quant_neibs.view(-1, quant_neibs.shape[2])
 
-def GenerateQuantumWalkGraphs(adj, tmp, batch_size, graph_size):
+class ClosedFormQuantumWalk(QuantumWalk):
+    """
+        Dense quantum walk that composes the per-step operators before touching the amplitudes
+        
+        One step is `U_t = P (I kron C_t^T)` on the `graph_size * degree` (node, coin slot) states
+        of a graph, where P is the swap permutation.  When every step uses the same coin the
+        walk operator is `U ** time_steps`, computed by repeated squaring (log2(time_steps) bmm's),
+        otherwise the steps are multiplied together.  The result is applied to `init_amps` in a
+        single contraction.
+        
+        The composed operator is `[batch, states, states]` and is rebuilt on every call -- nothing
+        is kept between steps -- so this pays off for small neighborhoods + many time steps.
+    """
+    def step_operator(self, coin, swap):
+        """ `[batch, states, states]` matrix of a single coin + swap step """
+        degree = coin.size(0)
+        n_states = swap.size(1)
+        
+        graph_size = n_states // degree
+        eye = torch.eye(graph_size).type_as(coin).view(graph_size, 1, graph_size, 1)
+        coin_op = (eye * coin.t().contiguous().view(1, degree, 1, degree)).view(n_states, n_states)
+        
+        return coin_op[swap.view(-1)].view(swap.size(0), n_states, n_states)
+    
+    def evolution_operator(self, coins, swap):
+        if all([torch.equal(coin.data, coins[0].data) for coin in coins[1:]]):
+            step, power, op = self.step_operator(coins[0], swap), len(coins), None
+            while power > 0:
+                if power % 2:
+                    op = step if op is None else torch.bmm(step, op)
+                
+                power //= 2
+                if power > 0:
+                    step = torch.bmm(step, step)
+        else:
+            op = self.step_operator(coins[0], swap)
+            for coin in coins[1:]:
+                op = torch.bmm(self.step_operator(coin, swap), op)
+        
+        return op
+    
+    def forward(self, x, neibs, init_amps, graphs, time_steps, degree, swap=None):
+        if degree == 0:
+            # No coin space to build an operator on
+            return super(ClosedFormQuantumWalk, self).forward(x, neibs, init_amps, graphs, time_steps, degree, swap=swap)
+        
+        batch_size = init_amps.size(0)
+        n_states = init_amps.size(1) * init_amps.size(2)
+        
+        if swap is None:
+            swap = QuantumWalkSwapIndex(graphs, degree)
+        
+        coins = self.step_coins(time_steps, degree)
+        
+        # Swap index is flat over the batch -- make it local to each graph
+        local_swap = swap.view(batch_size, n_states) - (torch.arange(batch_size).long() * n_states).view(-1, 1)
+        if init_amps.is_cuda:
+            local_swap = local_swap.cuda()
+        
+        op = self.evolution_operator(coins, local_swap)
+        amps = torch.bmm(op, init_amps.view(batch_size, n_states, -1)).view(init_amps.size())
+        
+        d = torch.sum(amps*amps,dim=2)
+        quant_neibs = torch.matmul(torch.transpose(d,1,2),neibs.view(torch.transpose(d,1,2).shape[0], -1, x.shape[1]))
+        
+        return quant_neibs.view(-1, quant_neibs.shape[2])
+
+
+class SparseQuantumWalk(nn.Module):
+    """
+        Quantum walk that only stores amplitudes on real (node, coin slot) arcs
+        
+        The dense walk pads every node to `degree` coin slots.  Under the Grover coin the
+        padded slots of a node always hold the same value, so here they are collapsed into
+        a single "pad" state per node w/ multiplicity `degree - node_degree`.  The state is
+        a `[n_arcs + n_nodes, graph_size]` matrix (one column per walker) for the whole batch,
+        the coin is a segment sum over the arcs of each node and the shift is a gather.
+        
+        Memory is O((n_arcs + n_nodes) * graph_size) instead of O(n_nodes * degree * graph_size),
+        and `quant_neibs` matches `QuantumWalk` w/ its initial (Grover) coins.
+    """
+    def prepare(self, adj, ids, batch_size, graph_size, cache=None):
+        graphs, degree, pairs = QuantumWalkGraphPairs(adj, ids, batch_size, graph_size, cache=cache)
+        
+        arcs = QuantumWalkArcs(graphs, pairs=pairs)
+        if ids.is_cuda:
+            arcs = dict([(k, v.cuda()) for k, v in arcs.items()])
+        
+        return {
+            "arcs" : arcs,
+            "degree" : degree,
+            "graph_size" : graph_size,
+        }
+    
+    def forward(self, x, neibs, arcs, time_steps, degree, graph_size):
+        arc_node, arc_src, node_degree = arcs['arc_node'], arcs['arc_src'], arcs['node_degree']
+        n_arcs, n_nodes = arc_node.size(0), node_degree.size(0)
+        
+        # Initial amps: walker j starts uniformly on the arcs of node j
+        coef = node_degree.double()
+        coef = torch.where(coef > 0, 1. / coef.sqrt(), torch.zeros_like(coef)).float()
+        amps = neibs.new(n_arcs, graph_size).zero_()
+        amps[torch.arange(n_arcs).type_as(arc_node), arc_node % graph_size] = coef[arc_node]
+        pads = neibs.new(n_nodes, graph_size).zero_()
+        
+        pad_mult = (degree - node_degree).float().unsqueeze(1)
+        scale = 2. / degree if degree > 0 else 0.
+        for t in range(time_steps):
+            # Coin Operator (Grover): 2/degree * sum(slots) - slot
+            total = neibs.new(n_nodes, graph_size).zero_().index_add(0, arc_node, amps) + pad_mult * pads
+            total = total * scale
+            amps = total[arc_node] - amps
+            pads = total - pads
+            
+            # Swap Operator: arcs read another arc (or another node's pad state), pads stay put
+            amps = torch.cat([amps, pads], 0)[arc_src]
+        
+        d = neibs.new(n_nodes, graph_size).zero_().index_add(0, arc_node, amps * amps) + pad_mult * pads * pads
+        d = d.view(-1, graph_size, graph_size)
+        quant_neibs = torch.matmul(torch.transpose(d,1,2),neibs.view(d.shape[0], -1, x.shape[1]))
+        
+        return quant_neibs.view(-1, quant_neibs.shape[2])
+
+
+class BucketedQuantumWalk(nn.Module):
+    """
+        Quantum walk w/ nodes grouped by their actual degree
+        
+        Same arc layout as `SparseQuantumWalk`, but nodes are sorted by degree so that the arcs
+        of each degree bucket form a `[n_nodes_k, k, graph_size]` block.  The coin is applied per
+        bucket as a right-sized `(k + 1) x (k + 1)` matmul -- the k real slots plus the pad state
+        that stands in for the `degree - k` padded slots of the Grover coin.
+    """
+    def prepare(self, adj, ids, batch_size, graph_size, cache=None):
+        graphs, degree, pairs = QuantumWalkGraphPairs(adj, ids, batch_size, graph_size, cache=cache)
+        
+        buckets = QuantumWalkBuckets(QuantumWalkArcs(graphs, pairs=pairs))
+        if ids.is_cuda:
+            buckets = dict([(k, v.cuda() if torch.is_tensor(v) else v) for k, v in buckets.items()])
+        
+        return {
+            "buckets" : buckets,
+            "degree" : degree,
+            "graph_size" : graph_size,
+        }
+    
+    @staticmethod
+    def bucket_coin(k, degree):
+        """ Grover coin on k real slots + 1 pad state w/ multiplicity `degree - k` """
+        coin = np.ones((k + 1, k + 1)) * 2. / degree
+        coin[:,k] *= degree - k
+        coin[np.arange(k + 1), np.arange(k + 1)] -= 1
+        return torch.FloatTensor(coin)
+    
+    def forward(self, x, neibs, buckets, time_steps, degree, graph_size):
+        arc_node, arc_src = buckets['arc_node'], buckets['arc_src']
+        node_degree, node_order, node_rank = buckets['node_degree'], buckets['node_order'], buckets['node_rank']
+        n_arcs, n_nodes = arc_node.size(0), node_degree.size(0)
+        
+        # Initial amps: walker j starts uniformly on the arcs of node j
+        coef = node_degree.double()
+        coef = torch.where(coef > 0, 1. / coef.sqrt(), torch.zeros_like(coef)).float()
+        amps = neibs.new(n_arcs, graph_size).zero_()
+        amps[torch.arange(n_arcs).type_as(arc_node), arc_node % graph_size] = coef[arc_node]
+        pads = neibs.new(n_nodes, graph_size).zero_()
+        
+        # Nodes w/o arcs only have a pad state, which the coin leaves alone
+        sizes = buckets['sizes']
+        coins = [self.bucket_coin(k, degree).type_as(neibs) if k > 0 else None for k, _ in sizes]
+        
+        for t in range(time_steps):
+            # Coin Operator, one matmul per degree bucket
+            new_amps, new_pads = [], []
+            arc_offset, node_offset = 0, 0
+            for (k, n_k), coin in zip(sizes, coins):
+                if coin is None:
+                    new_pads.append(pads[node_offset:node_offset + n_k])
+                    node_offset += n_k
+                    continue
+                
+                block = amps[arc_offset:arc_offset + n_k * k].view(n_k, k, graph_size)
+                pad = pads[node_offset:node_offset + n_k].unsqueeze(1)
+                out = torch.matmul(coin, torch.cat([block, pad], 1))
+                new_amps.append(out[:,:k].contiguous().view(-1, graph_size))
+                new_pads.append(out[:,k])
+                arc_offset += n_k * k
+                node_offset += n_k
+            
+            amps = torch.cat(new_amps, 0) if new_amps else amps
+            pads = torch.cat(new_pads, 0)
+            
+            # Swap Operator
+            amps = torch.cat([amps, pads], 0)[arc_src]
+        
+        d, arc_offset, node_offset = [], 0, 0
+        for k, n_k in sizes:
+            block = amps[arc_offset:arc_offset + n_k * k].view(n_k, k, graph_size)
+            pad = pads[node_offset:node_offset + n_k]
+            d.append((block * block).sum(1) + (degree - k) * pad * pad)
+            arc_offset += n_k * k
+            node_offset += n_k
+        
+        d = torch.cat(d, 0)[node_rank].view(-1, graph_size, graph_size)
+        quant_neibs = torch.matmul(torch.transpose(d,1,2),neibs.view(d.shape[0], -1, x.shape[1]))
+        
+        return quant_neibs.view(-1, quant_neibs.shape[2])
+
+
+walk_lookup = {
+    "dense" : QuantumWalk,
+    "closed_form" : ClosedFormQuantumWalk,
+    "sparse" : SparseQuantumWalk,
+    "bucketed" : BucketedQuantumWalk,
+}
+
+
+def QuantumWalkArcs(graphs, pairs=None):
+    """
+        Arc-indexed layout of a batch of graphs, as used by `SparseQuantumWalk`
+        
+            arc_node    : node (batch * graph_size + j) that owns each arc, arcs of a node are contiguous
+            arc_src     : state each arc reads after the swap -- an arc index, or `n_arcs + node` for a pad state
+            node_degree : number of arcs of each node
+        
+        Same shift as `QuantumWalkSwapIndex`, but w/o materializing the unused coin slots.
+    """
+    graph_size = graphs.size(1)
+    if pairs is None:
+        pairs = QuantumWalkSwapPairs(graphs)
+    
+    node_degree = graphs.sum(2).long().view(-1)
+    node_start = node_degree.cumsum(0) - node_degree
+    
+    if pairs.numel() == 0:
+        empty = torch.LongTensor(0)
+        return {"arc_node" : empty, "arc_src" : empty, "node_degree" : node_degree}
+    
+    b, j, v, src_slot = pairs[:,0], pairs[:,1], pairs[:,3], pairs[:,4]
+    arc_node = b * graph_size + j
+    src_node = b * graph_size + v
+    
+    n_arcs = arc_node.size(0)
+    arc_src = torch.where(
+        src_slot < node_degree[src_node],
+        node_start[src_node] + src_slot,
+        src_node + n_arcs,
+    )
+    
+    return {
+        "arc_node" : arc_node,
+        "arc_src" : arc_src,
+        "node_degree" : node_degree,
+    }
 
+
+def QuantumWalkBuckets(arcs):
+    """
+        Reorders the output of `QuantumWalkArcs` so that nodes are sorted by degree
+        
+            arc_node    : original node of each (reordered) arc
+            arc_src     : swap source of each arc, in the reordered arc / pad state layout
+            node_degree : number of arcs of each original node
+            node_order  : original node at each sorted position
+            node_rank   : sorted position of each original node
+            sizes       : [(k, number of nodes w/ degree k), ...] in sorted order
+    """
+    arc_node, arc_src, node_degree = [to_numpy(arcs[k]) for k in ('arc_node', 'arc_src', 'node_degree')]
+    n_arcs, n_nodes = arc_node.shape[0], node_degree.shape[0]
+    
+    node_order = np.argsort(node_degree, kind='mergesort')
+    node_rank = np.empty_like(node_order)
+    node_rank[node_order] = np.arange(n_nodes)
+    
+    node_start = np.cumsum(node_degree) - node_degree
+    sorted_degree = node_degree[node_order]
+    sorted_start = np.cumsum(sorted_degree) - sorted_degree
+    
+    # Position of each original arc in the sorted layout
+    arc_pos = sorted_start[node_rank[arc_node]] + (np.arange(n_arcs) - node_start[arc_node])
+    
+    new_arc_node = np.empty_like(arc_node)
+    new_arc_node[arc_pos] = arc_node
+    
+    is_arc = arc_src < n_arcs
+    new_arc_src = np.empty_like(arc_src)
+    new_arc_src[arc_pos] = np.where(is_arc, arc_pos[np.where(is_arc, arc_src, 0)], n_arcs + node_rank[np.maximum(arc_src - n_arcs, 0)])
+    
+    ks, counts = np.unique(sorted_degree, return_counts=True)
+    
+    return {
+        "arc_node" : torch.LongTensor(new_arc_node),
+        "arc_src" : torch.LongTensor(new_arc_src),
+        "node_degree" : torch.LongTensor(node_degree),
+        "node_order" : torch.LongTensor(node_order),
+        "node_rank" : torch.LongTensor(node_rank),
+        "sizes" : list(zip(ks.tolist(), counts.tolist())),
+    }
+
+
+def QuantumWalkSwapPairs(graphs):
+    """
+        Edges of a batch of graphs, in row major order, as a `[n_edges, 5]` LongTensor of
+        
+            (b, j, n, v, s) : v is the n'th neighbor of j, and j is the s'th node w/ v as a neighbor
+        
+        This is everything the swap operator needs, and does not depend on the batch `degree`.
+    """
+    nz = (graphs > 0).nonzero()
+    if nz.numel() == 0:
+        return torch.LongTensor(0, 5)
+    
+    row_slot = graphs.cumsum(2).long() - 1 # slot of v in the coin space of j
+    col_slot = graphs.cumsum(1).long() - 1 # slot of j in the coin space of v
+    
+    b, j, v = nz[:,0], nz[:,1], nz[:,2]
+    return torch.stack([b, j, row_slot[b, j, v], v, col_slot[b, j, v]], 1)
+
+
+def QuantumWalkSwapIndex(graphs, degree, pairs=None):
+    """
+        Flat gather index of the swap (shift) operator, for amps of shape `[batch, graph_size, degree, graph_size]`
+        
+        Coin slot n of node j holds the n'th neighbor v of j.  After the swap it reads
+        the amplitude of node v at slot s, where s counts how many nodes before j have v
+        as a neighbor.  Unused coin slots map to themselves.
+    """
+    batch_size, graph_size = graphs.size(0), graphs.size(1)
+    if pairs is None:
+        pairs = QuantumWalkSwapPairs(graphs)
+    
+    src_node = torch.arange(graph_size).long().view(1, -1, 1).repeat(batch_size, 1, degree)
+    src_slot = torch.arange(degree).long().view(1, 1, -1).repeat(batch_size, graph_size, 1)
+    
+    if pairs.numel() > 0:
+        b, j, n, v, s = [pairs[:,i] for i in range(5)]
+        assert int(s.max()) < degree, 'QuantumWalkSwapIndex: in-degree > degree'
+        src_node[b, j, n] = v
+        src_slot[b, j, n] = s
+    
+    offsets = torch.arange(batch_size).long().view(-1, 1, 1) * graph_size
+    return ((offsets + src_node) * degree + src_slot).view(-1)
+
+
+def QuantumWalkGraphPairs(adj, ids, batch_size, graph_size, cache=None):
+    """ graphs, max degree + swap pairs for a batch, optionally through a `QuantumWalkCache` """
+    if cache is not None:
+        return cache.build(adj, ids, batch_size, graph_size)
+    
+    graphs = QuantumWalkGraphs(adj, ids, batch_size, graph_size)
+    return graphs, QuantumWalkDegree(graphs), QuantumWalkSwapPairs(graphs)
+
+
+class QuantumWalkCache(object):
+    """
+        LRU cache of quantum walk neighborhoods, keyed on the sampled id block of each graph
+        
+        Each entry holds the graph (as bytes), its max degree and its swap pairs (see
+        `QuantumWalkSwapPairs`).  The batch-level swap index / arcs depend on the max degree
+        of the whole batch, so they're cheaply re-assembled from the cached pairs.
+        
+        Entries are evicted (least recently used first) once `max_bytes` is exceeded.
+    """
+    def __init__(self, max_bytes=2 ** 28):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.n_bytes = 0
+        
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def get(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        
+        self.entries[key] = entry
+        self.hits += 1
+        return entry[0]
+    
+    def put(self, key, value, n_bytes):
+        if n_bytes > self.max_bytes:
+            return
+        
+        if key in self.entries:
+            self.n_bytes -= self.entries.pop(key)[1]
+        
+        while self.entries and self.n_bytes + n_bytes > self.max_bytes:
+            _, (_, evicted_bytes) = self.entries.popitem(last=False)
+            self.n_bytes -= evicted_bytes
+            self.evictions += 1
+        
+        self.entries[key] = (value, n_bytes)
+        self.n_bytes += n_bytes
+    
+    def stats(self):
+        n_lookups = self.hits + self.misses
+        return {
+            "hits" : self.hits,
+            "misses" : self.misses,
+            "evictions" : self.evictions,
+            "hit_rate" : self.hits / float(n_lookups) if n_lookups > 0 else 0.0,
+            "n_entries" : len(self.entries),
+            "n_bytes" : self.n_bytes,
+        }
+    
+    def build(self, adj, ids, batch_size, graph_size):
+        ids_block = to_numpy(ids).reshape(batch_size, graph_size)
+        keys = [(id(adj), ids_block[b].tobytes()) for b in range(batch_size)]
+        entries = [self.get(key) for key in keys]
+        
+        missed = [b for b, entry in enumerate(entries) if entry is None]
+        if missed:
+            sel = torch.LongTensor(missed)
+            if ids.is_cuda:
+                sel = sel.cuda()
+            
+            miss_ids = ids.contiguous().view(batch_size, graph_size)[sel].view(-1)
+            miss_graphs = QuantumWalkGraphs(adj, miss_ids, len(missed), graph_size)
+            miss_pairs = QuantumWalkSwapPairs(miss_graphs)
+            
+            n_edges = miss_graphs.view(len(missed), -1).sum(1).long().tolist()
+            offsets = np.cumsum([0] + n_edges)
+            for i, b in enumerate(missed):
+                graph = miss_graphs[i].byte().clone()
+                pairs = miss_pairs[offsets[i]:offsets[i + 1], 1:].clone()
+                degree = int(graph.sum(1).max()) if graph.numel() > 0 else 0
+                
+                entries[b] = (graph, degree, pairs)
+                self.put(keys[b], entries[b], graph.numel() + 8 * pairs.numel() + len(keys[b][1]))
+        
+        graphs = torch.stack([entry[0] for entry in entries]).float()
+        degree = max([entry[1] for entry in entries])
+        pairs = torch.cat([
+            torch.cat([torch.LongTensor(entry[2].size(0), 1).fill_(b), entry[2]], 1)
+            for b, entry in enumerate(entries)
+        ], 0)
+        
+        return graphs, degree, pairs
+
+
+def GenerateQuantumWalkGraphs(adj, tmp, batch_size, graph_size, vectorized=True):
+    """
+        Builds one `graph_size x graph_size` graph per batch element from the
+        flat sampled ids in `tmp`, plus the initial amplitudes of the walk.
+        
+        `vectorized=False` runs the original per-node loop, which is kept around
+        as a reference implementation.
+    """
+    if not vectorized:
+        return _loop_quantum_walk_graphs(adj, tmp, batch_size, graph_size)
+    
+    graphs = QuantumWalkGraphs(adj, tmp, batch_size, graph_size)
+    degree = QuantumWalkDegree(graphs)
+    
+    all_amps = nn.Parameter(QuantumWalkInitAmps(graphs, degree))
+    if tmp.is_cuda:
+        all_amps = all_amps.cuda()
+    
+    return all_amps, graphs, degree
+
+
+def QuantumWalkDegree(graphs):
+    """ max degree over the whole batch -- size of the (padded) coin space """
+    return int(graphs.sum(2).max()) if graphs.numel() > 0 else 0
+
+
+def QuantumWalkInitAmps(graphs, degree):
+    """ Initial amps: uniform over the first `jdegree` coin slots of node j, on walker j """
+    graph_size = graphs.size(1)
+    degrees = graphs.sum(2)
+    
+    coef = degrees.double()
+    coef = torch.where(coef > 0, 1. / coef.sqrt(), torch.zeros_like(coef)).float()
+    slots = (torch.arange(degree).type_as(degrees).view(1, 1, -1) < degrees.unsqueeze(-1)).float()
+    eye = torch.eye(graph_size).view(1, graph_size, 1, graph_size)
+    return (slots * coef.unsqueeze(-1)).unsqueeze(-1) * eye
+
+
+def QuantumWalkGraphs(adj, tmp, batch_size, graph_size, max_elements=2 ** 26):
+    """
+        Batched adjacency block: graphs[b, i, j] = 1 iff tmp[b, j] is a neighbor of tmp[b, i]
+        
+        Neighbors are gathered into a padded `[batch, graph_size, max_degree]` block
+        and compared against the ids of the graph.  The compare is chunked over the batch
+        so that at most `max_elements` booleans are alive at once.
+    """
+    ids = tmp.data if isinstance(tmp, Variable) else tmp
+    ids = ids.contiguous().view(batch_size, graph_size)
+    
+    neibs = _padded_neighbors(adj, ids)
+    
+    chunk_size = max(1, max_elements // max(1, graph_size * graph_size * neibs.size(2)))
+    graphs = []
+    for chunk_start in range(0, batch_size, chunk_size):
+        chunk_neibs = neibs[chunk_start:chunk_start + chunk_size].unsqueeze(3)
+        chunk_ids = ids[chunk_start:chunk_start + chunk_size].unsqueeze(1).unsqueeze(2)
+        graphs.append((chunk_neibs == chunk_ids).max(2)[0])
+    
+    return torch.cat(graphs, 0).float().cpu()
+
+
+def _padded_neighbors(adj, ids):
+    """ neighbors of each id, as a `ids.size() + (max_degree,)` LongTensor padded w/ -1 """
+    if not sparse.issparse(adj):
+        adj = adj.data if isinstance(adj, Variable) else adj
+        return adj[ids.view(-1)].view(ids.size() + (adj.size(1),))
+    
+    flat_ids = to_numpy(ids).reshape(-1)
+    starts = adj.indptr[flat_ids]
+    degrees = adj.indptr[flat_ids + 1] - starts
+    width = max(1, int(degrees.max()) if degrees.shape[0] else 1)
+    
+    offsets = np.arange(width)
+    valid = offsets.reshape(1, -1) < degrees.reshape(-1, 1)
+    sel = np.where(valid, starts.reshape(-1, 1) + offsets, 0)
+    neibs = np.where(valid, adj.data[sel] if adj.data.shape[0] else 0, -1)
+    
+    neibs = torch.LongTensor(neibs.astype(np.int64)).view(ids.size() + (width,))
+    if ids.is_cuda:
+        neibs = neibs.cuda()
+    
+    return neibs
+
+
+def _loop_quantum_walk_graphs(adj, tmp, batch_size, graph_size):
+    
     # Create graphs
     graphs = torch.zeros([batch_size, graph_size, graph_size])
     init_amps = torch.zeros([batch_size, graph_size, graph_size])
@@ -401,13 +1248,13 @@ def GenerateQuantumWalkGraphs(adj, tmp, batch_size, graph_size):
         new_graph = torch.zeros((graph_size, graph_size))
         for i in range(len(graph_ids)):
             new_graph[i, :] = torch.from_numpy((np.isin(graph_ids.data, adj[graph_ids[i]].data)).astype(int))
-        graphs[edgelist/graph_size] = new_graph
+        graphs[edgelist // graph_size] = new_graph
 
     # Calculate max degree in each graph
     nodes=[graph_size]*batch_size
     degree = 0
     for g in graphs:
-        d = np.int(np.max(np.sum(g.numpy(), 1)))
+        d = int(np.max(np.sum(g.numpy(), 1)))
         if d > degree:
             degree = d
     degrees=[degree]*batch_size
@@ -417,12 +1264,12 @@ def GenerateQuantumWalkGraphs(adj, tmp, batch_size, graph_size):
     for i in range(len(graphs)):
         amps=np.zeros((len(graphs[i]),degrees[i],len(graphs[i])))
         for j in range(len(amps)): #Put initial amps only on atom locations
-            jdegree=np.int(np.sum(graphs[i][j].numpy()))
+            jdegree=int(np.sum(graphs[i][j].numpy()))
             if jdegree==0:
                 continue
             amps[j, :jdegree, j] = 1. / np.sqrt(jdegree)
         all_amps.append(np.array(amps))
-    all_amps = nn.Parameter(torch.FloatTensor(all_amps))
+    all_amps = nn.Parameter(torch.FloatTensor(np.array(all_amps)))
 
     if tmp.is_cuda:
             all_amps = all_amps.cuda()
@@ -10,8 +10,11 @@ from __future__ import print_function
 import os
 import sys
 import h5py
-import cPickle
 import numpy as np
+from collections import deque
+from functools import partial
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from scipy import sparse
 from sklearn import metrics
 from scipy.sparse import csr_matrix
@@ -20,6 +23,9 @@ import torch
 from torch.autograd import Variable
 from torch.nn import functional as F
 
+from helpers import to_numpy
+from profiler import profiler
+
 # --
 # Helper classes
 
@@ -64,6 +70,84 @@ class ProblemMetrics:
         return float(np.abs(y_true - y_pred).mean())
 
 
+class MetricAccumulator(object):
+    """
+        Same metrics as `ProblemMetrics`, computed incrementally from per-class confusion
+        counts (or, for regression, a running sum of errors) that are updated on the device
+        every batch.  Only `compute` syncs w/ the CPU, and memory is O(n_classes) no matter
+        how many predictions go in.
+        
+        Macro F1 follows `sklearn`:  classification averages over classes that appear in
+        targets or preds, multilabel over all labels (w/ 0/0 -> 0).
+    """
+    def __init__(self, task):
+        assert task in ['classification', 'multilabel_classification', 'regression_mae'], \
+            'MetricAccumulator: unknown task: %s' % task
+        
+        self.task = task
+        self.reset()
+    
+    def reset(self):
+        self.counts = None
+    
+    def add(self, targets, preds):
+        targets, preds = targets.detach(), preds.detach()
+        
+        if self.task == 'regression_mae':
+            err = (targets.view(preds.size()) - preds).abs().double().sum()
+            if self.counts is None:
+                self.counts = {"err" : err, "n" : 0}
+            else:
+                self.counts['err'] += err
+            
+            self.counts['n'] += preds.numel()
+            return
+        
+        if self.counts is None:
+            zeros = lambda: preds.new(preds.size(1)).long().zero_()
+            self.counts = {"tp" : zeros(), "n_pred" : zeros(), "n_true" : zeros()}
+        
+        if self.task == 'classification':
+            y_true = targets.view(-1).long()
+            y_pred = preds.max(1)[1]
+            ones = y_pred.new(y_pred.size(0)).fill_(1)
+            hit = (y_pred == y_true)
+            
+            self.counts['tp'].index_add_(0, y_true[hit], ones[hit])
+            self.counts['n_pred'].index_add_(0, y_pred, ones)
+            self.counts['n_true'].index_add_(0, y_true, ones)
+        
+        elif self.task == 'multilabel_classification':
+            y_true = (targets > 0.5).long()
+            y_pred = (preds > 0).long()
+            
+            self.counts['tp'] += (y_true * y_pred).sum(0)
+            self.counts['n_pred'] += y_pred.sum(0)
+            self.counts['n_true'] += y_true.sum(0)
+    
+    def compute(self):
+        if self.counts is None:
+            return None
+        
+        counts = dict([(k, v.cpu().double() if torch.is_tensor(v) else v) for k, v in self.counts.items()])
+        self.reset()
+        
+        if self.task == 'regression_mae':
+            return float(counts['err'] / counts['n'])
+        
+        # F1 = 2 * tp / (2 * tp + fp + fn) = 2 * tp / (n_pred + n_true)
+        tp, support = counts['tp'], counts['n_pred'] + counts['n_true']
+        f1 = 2 * tp / support.clamp(min=1)
+        
+        if self.task == 'classification':
+            f1 = f1[support > 0]
+        
+        return {
+            "micro" : float(2 * tp.sum() / max(float(support.sum()), 1)),
+            "macro" : float(f1.mean()) if f1.numel() > 0 else 0.0,
+        }
+
+
 # --
 # Problem definition
 
@@ -71,29 +155,83 @@ def parse_csr_matrix(x):
     v, r, c = x
     return csr_matrix((v, (r, c)))
 
+
+def decode_strings(x):
+    """ h5py reads strings back as bytes on py3 -- decode them (+ arrays of them) to `str` """
+    if str is bytes:
+        return x
+    elif isinstance(x, np.ndarray) and x.dtype.kind in 'SO':
+        return x.astype('U')
+    elif isinstance(x, bytes):
+        return x.decode('utf-8')
+    else:
+        return x
+
+
+def mmap_dataset(f, key):
+    """
+        Zero-copy, read-only view of a contiguous + uncompressed HDF5 dataset (the
+        default for `f[k] = v` in `utils/convert.py`).  Falls back to reading the
+        whole thing w/ `.value` if the dataset is chunked/compressed/non-numeric.
+        
+        Mapped copy-on-write, so `torch.from_numpy` can share the buffer.
+    """
+    ds = f[key]
+    offset = ds.id.get_offset()
+    if (offset is None) or (ds.chunks is not None) or (ds.dtype.kind not in 'biuf'):
+        print('NodeProblem: cannot mmap %s -- loading into memory' % key, file=sys.stderr)
+        return ds.value
+    
+    return np.memmap(f.filename, mode='c', dtype=ds.dtype, shape=ds.shape, offset=offset)
+
+
+class MmapFeats(object):
+    """
+        Features that stay on disk (page cache) -- rows are gathered on the CPU for
+        each batch and moved to the GPU, instead of putting the whole matrix there.
+        
+        Drop-in for `problem.feats` -- models only ever do `feats[ids]`.
+    """
+    def __init__(self, feats, cuda=True):
+        self.feats = feats
+        self.shape = feats.shape
+        self.cuda  = cuda
+    
+    def __getitem__(self, ids):
+        out = torch.from_numpy(np.asarray(self.feats[to_numpy(ids)], dtype=np.float32))
+        if self.cuda:
+            out = out.cuda()
+        
+        return Variable(out)
+
+
 class NodeProblem(object):
-    def __init__(self, problem_path, cuda=True):
+    def __init__(self, problem_path, cuda=True, mmap=False):
         
         print('NodeProblem: loading started')
         
-        f = h5py.File(problem_path)
-        self.task      = f['task'].value
+        load = mmap_dataset if mmap else (lambda f, key: f[key].value)
+        
+        f = h5py.File(problem_path, 'r')
+        self.task      = decode_strings(f['task'].value)
         self.n_classes = f['n_classes'].value if 'n_classes' in f else 1 # !!
-        self.feats     = f['feats'].value if 'feats' in f else None
-        self.folds     = f['folds'].value
-        self.targets   = f['targets'].value
+        self.feats     = load(f, 'feats') if 'feats' in f else None
+        self.folds     = decode_strings(f['folds'].value)
+        self.targets   = load(f, 'targets')
         if 'sparse' in f and f['sparse'].value:
+            # CSR has to be built in memory either way
             self.adj = parse_csr_matrix(f['adj'].value)
             self.train_adj = parse_csr_matrix(f['train_adj'].value)
         else:
-            self.adj = f['adj'].value
-            self.train_adj = f['train_adj'].value
+            self.adj = load(f, 'adj')
+            self.train_adj = load(f, 'train_adj')
             
         f.close()
         
         self.feats_dim = self.feats.shape[1] if self.feats is not None else None
         self.n_nodes   = self.adj.shape[0]
         self.cuda      = cuda
+        self.mmap      = mmap
         self.__to_torch()
         
         self.nodes = {
@@ -109,13 +247,21 @@ class NodeProblem(object):
     
     def __to_torch(self):
         if not sparse.issparse(self.adj):
-            self.adj = Variable(torch.LongTensor(self.adj))
-            self.train_adj = Variable(torch.LongTensor(self.train_adj))
+            if self.mmap:
+                # shares the mapped buffer, unless the file isn't int64
+                self.adj = Variable(torch.from_numpy(self.adj.astype(np.int64, copy=False)))
+                self.train_adj = Variable(torch.from_numpy(self.train_adj.astype(np.int64, copy=False)))
+            else:
+                self.adj = Variable(torch.LongTensor(self.adj))
+                self.train_adj = Variable(torch.LongTensor(self.train_adj))
+            
             if self.cuda:
                 self.adj = self.adj.cuda()
                 self.train_adj = self.train_adj.cuda()
         
-        if self.feats is not None:
+        if self.feats is not None and self.mmap:
+            self.feats = MmapFeats(self.feats, cuda=self.cuda)
+        elif self.feats is not None:
             self.feats = Variable(torch.FloatTensor(self.feats))
             if self.cuda:
                 self.feats = self.feats.cuda()
@@ -138,16 +284,124 @@ class NodeProblem(object):
         
         return mids, targets
     
-    def iterate(self, mode, batch_size=512, shuffle=False):
+    def batch(self, mids):
+        """ torch ids + targets for a chunk of node ids """
+        return self.__batch_to_torch(mids, self.targets[mids])
+    
+    def chunks(self, mode, batch_size=512, shuffle=False, rng=None, shard=None):
+        """
+            (chunk_id, n_chunks, node ids) for each batch in an epoch
+            
+            `shard=(rank, world_size)` yields only the `rank`th of `world_size` equal slices of
+            the (shuffled) nodes -- the remainder is dropped, so every worker runs the same number
+            of steps.  Workers have to pass identically seeded `rng`s.
+        """
         nodes = self.nodes[mode]
         
         idx = np.arange(nodes.shape[0])
         if shuffle:
-            idx = np.random.permutation(idx)
+            idx = (rng if rng is not None else np.random).permutation(idx)
+        
+        if shard is not None:
+            rank, world_size = shard
+            shard_size = idx.shape[0] // world_size
+            idx = idx[rank * shard_size:(rank + 1) * shard_size]
         
         n_chunks = idx.shape[0] // batch_size + 1
         for chunk_id, chunk in enumerate(np.array_split(idx, n_chunks)):
-            mids = nodes[chunk]
-            targets = self.targets[mids]
-            mids, targets = self.__batch_to_torch(mids, targets)
+            yield chunk_id, n_chunks, nodes[chunk]
+    
+    def iterate(self, mode, batch_size=512, shuffle=False, rng=None, shard=None):
+        for chunk_id, n_chunks, mids in self.chunks(mode, batch_size=batch_size, shuffle=shuffle, rng=rng, shard=shard):
+            with profiler.timer('batch'):
+                mids, targets = self.batch(mids)
+            
             yield mids, targets, chunk_id / n_chunks
+
+
+# --
+# Prefetching loader
+
+_prefetch_state = {} # Only ever set in worker processes -- each has its own copy
+
+def _prefetch_init(problem, sample_fn):
+    """ `Pool` initializer -- `problem` + `sample_fn` for the batches this worker process builds """
+    _prefetch_state.update({"problem" : problem, "sample_fn" : sample_fn})
+
+def _prefetch_batch(args, problem=None, sample_fn=None):
+    """
+        build one fully sampled batch -- runs in a worker thread/process.  Threads get
+        `problem` + `sample_fn` bound by their loader, processes read them from `_prefetch_state`
+    """
+    chunk_id, n_chunks, mids, seed = args
+    if problem is None:
+        problem, sample_fn = _prefetch_state['problem'], _prefetch_state['sample_fn']
+    
+    mids, targets = problem.batch(mids)
+    samples = sample_fn(mids, rng=np.random.RandomState(seed))
+    return mids, targets, chunk_id / n_chunks, samples
+
+
+class PrefetchLoader(object):
+    """
+        Produces fully sampled minibatches (ids, targets, progress, per-layer neighbor ids)
+        ahead of the training loop, w/ `n_workers` threads (or processes) and at most
+        `queue_size` batches in flight.
+        
+        Every batch is sampled w/ its own RandomState seeded by (seed, epoch, chunk_id),
+        and the shuffle by (seed, epoch), so results don't depend on `n_workers` or on
+        scheduling.  Batches are yielded in order.
+        
+        `processes=True` forks workers, so `problem` + `sample_fn` are inherited rather
+        than pickled -- only works for CPU problems.
+        
+        `shard=(rank, world_size)` is passed through to `NodeProblem.chunks`, + the rank is
+        added to the sampling seeds.
+    """
+    def __init__(self, problem, sample_fn, n_workers=2, queue_size=4, processes=False, seed=123, shard=None):
+        assert n_workers > 0, 'PrefetchLoader: n_workers must be > 0'
+        assert queue_size > 0, 'PrefetchLoader: queue_size must be > 0'
+        assert not (processes and problem.cuda), 'PrefetchLoader: processes=True requires a CPU problem'
+        
+        self.problem    = problem
+        self.sample_fn  = sample_fn
+        self.queue_size = queue_size
+        self.seed       = seed
+        self.shard      = shard
+        self.epoch      = 0
+        
+        if processes:
+            self.pool = Pool(n_workers, initializer=_prefetch_init, initargs=(problem, sample_fn))
+            self.prefetch_fn = _prefetch_batch
+        else:
+            self.pool = ThreadPool(n_workers)
+            self.prefetch_fn = partial(_prefetch_batch, problem=problem, sample_fn=sample_fn)
+    
+    def iterate(self, mode, batch_size=512, shuffle=False):
+        rng = np.random.RandomState([self.seed, self.epoch])
+        chunks = self.problem.chunks(mode, batch_size=batch_size, shuffle=shuffle, rng=rng, shard=self.shard)
+        jobs = (
+            (chunk_id, n_chunks, mids, [self.seed, self.epoch, chunk_id] + ([self.shard[0]] if self.shard else []))
+            for chunk_id, n_chunks, mids in chunks
+        )
+        
+        queue = deque()
+        for job in jobs:
+            queue.append(self.pool.apply_async(self.prefetch_fn, (job,)))
+            if len(queue) >= self.queue_size:
+                with profiler.timer('loader_wait'):
+                    batch = queue.popleft().get()
+                
+                yield batch
+        
+        while queue:
+            with profiler.timer('loader_wait'):
+                batch = queue.popleft().get()
+            
+            yield batch
+        
+        self.epoch += 1
+    
+    def close(self):
+        self.pool.close()
+        self.pool.join()
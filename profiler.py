@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+"""
+    profiler.py
+    
+    Opt-in named timers + counters for the train loop.  Disabled by default, in
+    which case `profiler.timer(name)` returns a shared no-op context manager and
+    `count`/`observe` return immediately.
+    
+    Usage:
+    
+        from profiler import profiler
+        
+        with profiler.timer('sample_1'):
+            ...
+        
+        profiler.count('gather_bytes_1', n_bytes)
+        profiler.observe('unique_ratio_1', ratio)
+        
+        profiler.summary() # totals since the last summary (+ resets)
+    
+    Timers are wall clock -- CUDA kernels run asynchronously, so use
+    `enable(cuda_sync=True)` to attribute GPU time to the right stage.
+    Worker *processes* (eg `PrefetchLoader(processes=True)`) have their own copy
+    of `profiler`, so their timings aren't collected.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import resource
+from time import time
+from threading import Lock
+
+import torch
+
+def peak_rss_mb():
+    """ peak resident set size of this process so far (`ru_maxrss` is in KB on linux, bytes on OSX) """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2 ** (20 if sys.platform == 'darwin' else 10)
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        return False
+
+_null_timer = _NullTimer()
+
+
+class _Timer(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+    
+    def __enter__(self):
+        if self.profiler.cuda_sync:
+            torch.cuda.synchronize()
+        
+        self.start = time()
+        return self
+    
+    def __exit__(self, *exc):
+        if self.profiler.cuda_sync:
+            torch.cuda.synchronize()
+        
+        self.profiler.add_time(self.name, time() - self.start)
+        return False
+
+
+class Profiler(object):
+    """
+        Accumulates, per name:
+        
+            timers   -- total seconds + number of calls
+            counters -- sums (eg bytes gathered)
+            means    -- averages of observed values (eg unique-node ratio)
+        
+        Thread safe, so timings from `PrefetchLoader` worker threads are included.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.cuda_sync = False
+        self.lock = Lock()
+        self.reset()
+    
+    def enable(self, cuda_sync=False):
+        self.enabled = True
+        self.cuda_sync = cuda_sync and torch.cuda.is_available()
+        self.reset()
+    
+    def disable(self):
+        self.enabled = False
+        self.cuda_sync = False
+    
+    def reset(self):
+        self.times = {}
+        self.calls = {}
+        self.counters = {}
+        self.observed = {}
+    
+    def timer(self, name):
+        return _Timer(self, name) if self.enabled else _null_timer
+    
+    def add_time(self, name, elapsed):
+        with self.lock:
+            self.times[name] = self.times.get(name, 0.0) + elapsed
+            self.calls[name] = self.calls.get(name, 0) + 1
+    
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+    
+    def observe(self, name, value):
+        if not self.enabled:
+            return
+        
+        with self.lock:
+            total, n = self.observed.get(name, (0.0, 0))
+            self.observed[name] = (total + value, n + 1)
+    
+    def summary(self, reset=True):
+        """ totals since the last `summary` (or `reset`), as a JSON-able dict """
+        with self.lock:
+            out = {
+                "time" : dict(self.times),
+                "calls" : dict(self.calls),
+                "counters" : dict(self.counters),
+                "means" : dict([(k, total / n) for k, (total, n) in self.observed.items()]),
+                "peak_rss_mb" : peak_rss_mb(),
+            }
+            if torch.cuda.is_available():
+                out['cuda_max_allocated_mb'] = torch.cuda.max_memory_allocated() / 2 ** 20
+            
+            if reset:
+                self.reset()
+        
+        return out
+
+
+profiler = Profiler()
@@ -21,6 +21,17 @@ time python ./train.py \
     --aggregator-class mean \
     --sampler-class sparse_uniform_neighbor_sampler
 
+# Sampler microbenchmark (legacy vs CSR)
+python ./bench.py --bench sparse_sampler --problem-path ./data/reddit/sparse-problem.h5
+
+# Sampler / prep / aggregator / quantum walk sweeps on synthetic power law graphs
+# (compare against an earlier run w/ `--baseline`)
+python ./bench.py --bench samplers,preps,aggregators,walks --n-nodes 100000 --outpath ./results/bench.json
+python ./bench.py --bench samplers,preps,aggregators,walks --n-nodes 100000 --baseline ./results/bench.json
+
+# Synthetic problem, for `train.py`
+python ./bench.py --make-problem ./data/synthetic/problem.h5 --n-nodes 100000
+
 # <<
 
 time ./train.py \
@@ -43,8 +54,53 @@ time ./train.py \
     --sampler-class sparse_uniform_neighbor_sampler \
     --epochs 3
 
+python ./bench.py --bench sparse_sampler --problem-path ./data/pokec/sparse-problem.h5
+
 # <<
 
 python ./train.py \
     --problem-path ./data/example_data/problem.h5 \
     --aggregator-class mean
+
+# Data-parallel training on 8 CPU worker processes (gloo), + its scaling from 1 to 8 processes
+python ./train.py \
+    --problem-path ./data/reddit/problem.h5 \
+    --aggregator-class mean \
+    --no-cuda \
+    --n-procs 8
+
+python ./bench.py --bench ddp --n-nodes 100000 --max-procs 8
+
+# Fused mean aggregator (one GEMM), reading unique neighbor rows directly + its parity check / microbenchmark
+python ./train.py \
+    --problem-path ./data/reddit/problem.h5 \
+    --aggregator-class fused_mean \
+    --dedupe-neighbors
+
+python ./bench.py --bench fused_mean --n-nodes 100000
+
+# Multi-head attention aggregator, w/ the dummy (padding) node masked out of the attention + its parity check / microbenchmark
+python ./train.py \
+    --problem-path ./data/reddit/problem.h5 \
+    --aggregator-class multihead_attention \
+    --mask-dummy-neighbors
+
+python ./bench.py --bench attention --n-nodes 100000
+
+# Per-stage timers (sampling, gather, prep, walk, aggregation, backward, ...) in the log
+python ./train.py \
+    --problem-path ./data/reddit/problem.h5 \
+    --aggregator-class mean \
+    --profile --profile-cuda-sync
+
+# Save a checkpoint + score all nodes w/ it
+python ./train.py \
+    --problem-path ./data/reddit/problem.h5 \
+    --aggregator-class mean \
+    --save-path ./models/reddit-mean.pt
+
+python ./score.py \
+    --problem-path ./data/reddit/problem.h5 \
+    --checkpoint ./models/reddit-mean.pt \
+    --outpath ./results/reddit-mean-embeddings.npy \
+    --output embeddings
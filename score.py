@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+"""
+    score.py
+    
+    Score nodes w/ a model saved by `train.py --save-path`
+    
+    Writes logits (or the penultimate-layer embeddings) for each node id, in order,
+    to a `.npy` (memory-mapped) or `.h5` file.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import h5py
+import argparse
+import numpy as np
+import ujson as json
+from time import time
+from scipy import sparse
+
+import torch
+from torch.autograd import Variable
+
+from models import load_checkpoint
+from problem import NodeProblem
+from helpers import set_seeds, to_numpy
+
+# --
+# Helpers
+
+def iterate_ids(args, n_nodes, is_sparse=False):
+    """ (n_ids, generator of id chunks) -- from a `.npy`/text file, or a `lo:hi` range """
+    if args.ids_path and args.ids_path.endswith('.npy'):
+        ids = np.load(args.ids_path, mmap_mode='r').reshape(-1)
+        chunks = (np.asarray(ids[i:i + args.batch_size]) for i in range(0, ids.shape[0], args.batch_size))
+        return ids.shape[0], chunks
+    
+    elif args.ids_path:
+        n_ids = sum(1 for line in open(args.ids_path) if line.strip())
+        
+        def chunks():
+            chunk = []
+            for line in open(args.ids_path):
+                if line.strip():
+                    chunk.append(int(line))
+                
+                if len(chunk) == args.batch_size:
+                    yield np.array(chunk)
+                    chunk = []
+            
+            if len(chunk):
+                yield np.array(chunk)
+        
+        return n_ids, chunks()
+    
+    else:
+        # Skip dummy node (last row for dense adjacency, first for sparse)
+        lo, hi = args.id_range.split(':') if args.id_range else ((1, n_nodes) if is_sparse else (0, n_nodes - 1))
+        lo, hi = int(lo), int(hi)
+        assert 0 <= lo <= hi <= n_nodes, 'iterate_ids: bad id range %s' % args.id_range
+        chunks = (np.arange(i, min(i + args.batch_size, hi)) for i in range(lo, hi, args.batch_size))
+        return hi - lo, chunks
+
+
+class ScoreWriter(object):
+    """ writes `[n_ids, dim]` rows in order to a `.npy` memmap or a chunked `.h5` dataset """
+    def __init__(self, path, n_ids, dim, chunk_size):
+        self.path = path
+        self.offset = 0
+        if path.endswith('.npy'):
+            self.f = None
+            self.out = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(n_ids, dim))
+        elif path.endswith('.h5'):
+            self.f = h5py.File(path, 'w')
+            self.out = self.f.create_dataset('scores', shape=(n_ids, dim), dtype=np.float32,
+                chunks=(max(1, min(chunk_size, n_ids)), dim))
+            self.ids = self.f.create_dataset('ids', shape=(n_ids,), dtype=np.int64)
+        else:
+            raise Exception('ScoreWriter: unknown output format: %s' % path)
+    
+    def write(self, ids, scores):
+        self.out[self.offset:self.offset + scores.shape[0]] = scores
+        if self.f is not None:
+            self.ids[self.offset:self.offset + scores.shape[0]] = ids
+        
+        self.offset += scores.shape[0]
+    
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+        else:
+            self.out.flush()
+
+# --
+# Args
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    
+    parser.add_argument('--problem-path', type=str, required=True)
+    parser.add_argument('--checkpoint', type=str, required=True)
+    parser.add_argument('--outpath', type=str, required=True) # .npy or .h5
+    parser.add_argument('--no-cuda', action="store_true")
+    parser.add_argument('--mmap', action="store_true")
+    
+    # Which nodes
+    parser.add_argument('--ids-path', type=str) # .npy, or text w/ one id per line
+    parser.add_argument('--id-range', type=str) # lo:hi -- default is all nodes
+    
+    parser.add_argument('--output', type=str, default='logits')
+    parser.add_argument('--batch-size', type=int, default=8192)
+    parser.add_argument('--log-interval', type=int, default=10)
+    parser.add_argument('--seed', default=123, type=int)
+    
+    args = parser.parse_args()
+    args.cuda = not args.no_cuda
+    assert args.output in ['logits', 'embeddings'], 'parse_args: output must be logits or embeddings'
+    assert not (args.ids_path and args.id_range), 'parse_args: set at most one of ids_path and id_range'
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    set_seeds(args.seed)
+    
+    problem = NodeProblem(problem_path=args.problem_path, cuda=args.cuda, mmap=args.mmap)
+    model, config = load_checkpoint(args.checkpoint, adj=problem.adj, train_adj=problem.train_adj, cuda=args.cuda)
+    _ = model.eval()
+    
+    n_ids, chunks = iterate_ids(args, problem.n_nodes, is_sparse=sparse.issparse(problem.adj))
+    dim = config['n_classes'] if args.output == 'logits' else model.fc.in_features
+    writer = ScoreWriter(args.outpath, n_ids, dim, chunk_size=args.batch_size)
+    
+    start_time = time()
+    with torch.no_grad():
+        for batch_idx, chunk in enumerate(chunks):
+            ids = Variable(torch.LongTensor(chunk))
+            if args.cuda:
+                ids = ids.cuda()
+            
+            if args.output == 'logits':
+                scores = model(ids, problem.feats, train=False)
+            else:
+                scores = model.embed(ids, problem.feats, train=False)
+            
+            writer.write(chunk, to_numpy(scores))
+            
+            if (batch_idx + 1) % args.log_interval == 0:
+                elapsed = time() - start_time
+                print(json.dumps({
+                    "n_scored" : writer.offset,
+                    "progress" : writer.offset / max(n_ids, 1),
+                    "nodes_per_sec" : writer.offset / elapsed,
+                }, double_precision=5), file=sys.stderr)
+    
+    writer.close()
+    elapsed = time() - start_time
+    print(json.dumps({
+        "outpath" : args.outpath,
+        "n_scored" : writer.offset,
+        "time" : elapsed,
+        "nodes_per_sec" : writer.offset / max(elapsed, 1e-9),
+    }, double_precision=5))
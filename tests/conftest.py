@@ -0,0 +1,10 @@
+"""
+    tests/conftest.py
+    
+    the modules live at the top of the repo -- make them importable from the tests
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+"""
+    tests/test_aggregators.py
+"""
+
+from __future__ import division
+
+import numpy as np
+import torch
+from torch.autograd import Variable
+from torch.nn import functional as F
+
+from nn_modules import MeanAggregator, FusedMeanAggregator, AttentionAggregator, MultiHeadAttentionAggregator
+from bench import attention_reference
+
+# --
+# Helpers
+
+def run(agg, x, neibs, **kwargs):
+    """ output + gradients of `(out ** 2).sum()` wrt. `x`, `neibs` + the weights """
+    x, neibs = Variable(x.clone(), requires_grad=True), Variable(neibs.clone(), requires_grad=True)
+    agg.zero_grad()
+    out = agg(x, neibs, **kwargs)
+    (out ** 2).sum().backward()
+    
+    if isinstance(agg, FusedMeanAggregator):
+        w_grads = [agg.weight.grad[0].t(), agg.weight.grad[1].t()]
+    else:
+        w_grads = [agg.fc_x.weight.grad, agg.fc_neib.weight.grad]
+    
+    return [t.data.numpy() for t in [out, x.grad, neibs.grad] + w_grads]
+
+
+def run_attention(fn, agg, x, neibs):
+    """ output of `fn(agg, x, neibs)` + gradients of `(out ** 2).sum()` wrt. `x`, `neibs` + every parameter """
+    x, neibs = Variable(x.clone(), requires_grad=True), Variable(neibs.clone(), requires_grad=True)
+    agg.zero_grad()
+    out = fn(agg, x, neibs)
+    (out ** 2).sum().backward()
+    return [t.data.numpy() for t in [out, x.grad, neibs.grad] + [p.grad for p in agg.parameters()]]
+
+
+def masked_inputs(batch_size, n_samples, input_dim, seed):
+    """
+        `x`, `neibs`, `mask` w/ about half of the neighbors masked -- all of the first row's --
+        + `noisy`, a copy of `neibs` w/ different masked neighbors
+    """
+    rng = np.random.RandomState(seed)
+    x = torch.FloatTensor(rng.normal(size=(batch_size, input_dim)))
+    neibs = torch.FloatTensor(rng.normal(size=(batch_size * n_samples, input_dim)))
+    mask = torch.LongTensor(rng.randint(0, 2, batch_size * n_samples))
+    mask[:n_samples] = 0
+    
+    noisy = neibs.clone()
+    noisy[mask == 0] = torch.FloatTensor(rng.normal(size=(int((mask == 0).sum()), input_dim)))
+    return x, neibs, mask, noisy
+
+# --
+# Tests
+
+def test_fused_mean_matches_mean():
+    torch.manual_seed(123)
+    batch_size, n_samples, input_dim, output_dim = 7, 5, 6, 4
+    x, neibs = torch.randn(batch_size, input_dim), torch.randn(batch_size * n_samples, input_dim)
+    
+    mean = MeanAggregator(input_dim=input_dim, output_dim=output_dim, activation=F.relu)
+    ref = run(mean, x, neibs)
+    for order in [None, 'mean_first', 'project_first']:
+        fused = FusedMeanAggregator.from_mean(mean, order=order)
+        for a, b in zip(run(fused, x, neibs), ref):
+            assert np.allclose(a, b, atol=1e-5), order
+
+
+def test_fused_mean_w_neib_index_matches_mean():
+    torch.manual_seed(456)
+    batch_size, n_samples, input_dim, output_dim = 7, 5, 6, 4
+    x = torch.randn(batch_size, input_dim)
+    uneibs = torch.randn(9, input_dim)
+    neib_index = torch.LongTensor(np.random.RandomState(456).randint(0, 9, batch_size * n_samples))
+    
+    mean = MeanAggregator(input_dim=input_dim, output_dim=output_dim, activation=F.relu)
+    ref = run(mean, x, uneibs[neib_index])
+    for order in [None, 'mean_first', 'project_first']:
+        fused = FusedMeanAggregator.from_mean(mean, order=order)
+        out = run(fused, x, uneibs, neib_index=neib_index)
+        
+        # Gradients wrt. the unique rows are the sums over the positions that read them
+        neib_grad = np.zeros_like(out[2])
+        np.add.at(neib_grad, neib_index.numpy(), ref[2])
+        for a, b in zip(out, ref[:2] + [neib_grad] + ref[3:]):
+            assert np.allclose(a, b, atol=1e-5), order
+
+
+def test_fused_mean_cost_picks_cheaper_order():
+    fused = FusedMeanAggregator(input_dim=64, output_dim=64, activation=None)
+    
+    cost = fused.cost(batch_size=100, n_samples=25)
+    assert cost['mean_first'] < cost['project_first'] # every position is its own row
+    
+    cost = fused.cost(batch_size=100, n_samples=25, n_rows=10)
+    assert cost['project_first'] < cost['mean_first'] # a few rows shared by every node
+
+
+def test_attention_matches_reference():
+    torch.manual_seed(123)
+    n_samples, input_dim, output_dim = 5, 6, 4
+    agg = AttentionAggregator(input_dim=input_dim, output_dim=output_dim, activation=F.relu)
+    for batch_size in [1, 7]:
+        x, neibs = torch.randn(batch_size, input_dim), torch.randn(batch_size * n_samples, input_dim)
+        ref = run_attention(attention_reference, agg, x, neibs)
+        out = run_attention(lambda agg, x, neibs: agg(x, neibs), agg, x, neibs)
+        for a, b in zip(out, ref):
+            assert np.allclose(a, b, atol=1e-5), batch_size
+
+
+def test_attention_ignores_masked_neighbors():
+    torch.manual_seed(456)
+    batch_size, n_samples, input_dim, output_dim = 7, 5, 6, 4
+    x, neibs, mask, noisy = masked_inputs(batch_size, n_samples, input_dim, seed=456)
+    for agg in [
+        AttentionAggregator(input_dim=input_dim, output_dim=output_dim, activation=F.relu),
+        MultiHeadAttentionAggregator(input_dim=input_dim, output_dim=output_dim, activation=F.relu),
+    ]:
+        out = agg(Variable(x), Variable(neibs), mask=mask)
+        assert np.allclose(out.data.numpy(), agg(Variable(x), Variable(noisy), mask=mask).data.numpy(), atol=1e-5), agg.n_heads
+
+
+def test_attention_all_dummy_row_only_sees_x():
+    torch.manual_seed(789)
+    batch_size, n_samples, input_dim, output_dim = 7, 5, 6, 4
+    x, neibs, mask, _ = masked_inputs(batch_size, n_samples, input_dim, seed=789)
+    for agg in [
+        AttentionAggregator(input_dim=input_dim, output_dim=output_dim, activation=F.relu),
+        MultiHeadAttentionAggregator(input_dim=input_dim, output_dim=output_dim, activation=F.relu),
+    ]:
+        out = agg(Variable(x), Variable(neibs), mask=mask)
+        
+        # The first row has no real neighbors -- its `fc_neib` half is zero
+        only_x = F.relu(agg.combine_fn([agg.fc_x(Variable(x[:1])), Variable(torch.zeros(1, output_dim))]))
+        assert np.allclose(out[:1].data.numpy(), only_x.data.numpy(), atol=1e-5), agg.n_heads
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+"""
+    tests/test_history.py
+"""
+
+from __future__ import division
+
+import numpy as np
+import torch
+from torch.nn import functional as F
+
+from models import GSSupervised
+from nn_modules import UniformNeighborSampler, MeanAggregator, IdentityPrep, NodeEmbeddingPrep
+
+# --
+# Helpers
+
+def make_model(prep_class, adj, n_nodes, max_degree, history_refresh):
+    """
+        3 layer model where every node samples all `max_degree` of its neighbors -- w/ a mean
+        aggregator, the sampled neighborhoods (and so the exact output) are deterministic
+    """
+    torch.manual_seed(123)
+    return GSSupervised(**{
+        "input_dim" : 5,
+        "n_nodes" : n_nodes,
+        "n_classes" : 3,
+        "layer_specs" : [
+            {"n_train_samples" : max_degree, "n_val_samples" : max_degree, "output_dim" : 8, "activation" : F.relu},
+            {"n_train_samples" : max_degree, "n_val_samples" : max_degree, "output_dim" : 8, "activation" : F.relu},
+            {"n_train_samples" : max_degree, "n_val_samples" : max_degree, "output_dim" : 8, "activation" : lambda x: x},
+        ],
+        "aggregator_class" : MeanAggregator,
+        "prep_class" : prep_class,
+        "sampler_class" : UniformNeighborSampler,
+        "adj" : adj,
+        "train_adj" : adj,
+        "historical_embeddings" : True,
+        "history_staleness" : 1000,
+        "history_refresh" : history_refresh,
+    })
+
+# --
+# Tests
+
+def test_fresh_history_matches_forward():
+    rng = np.random.RandomState(123)
+    n_nodes, max_degree = 30, 4
+    adj = torch.LongTensor(np.vstack([rng.randint(0, n_nodes, (n_nodes, max_degree)), np.zeros((1, max_degree)) + n_nodes]))
+    feats = torch.randn(n_nodes + 1, 5)
+    ids = torch.LongTensor(rng.choice(n_nodes, 6, replace=False))
+    
+    for prep_class in [IdentityPrep, NodeEmbeddingPrep]:
+        for history_refresh in [0, 3]:
+            model = make_model(prep_class, adj, n_nodes, max_degree, history_refresh)
+            exact = model(ids, feats, train=False).data.numpy()
+            
+            # W/ a capped refresh, it takes a few steps for every neighbor to be computed
+            for _ in range(n_nodes):
+                out = model(ids, feats, train=True).data.numpy()
+                if not model.history.stale(torch.from_numpy(np.unique(adj[ids].numpy()))).any():
+                    break
+            
+            out = model(ids, feats, train=True).data.numpy()
+            assert np.allclose(out, exact, atol=1e-5), (prep_class.__name__, history_refresh)
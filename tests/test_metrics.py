@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+"""
+    tests/test_metrics.py
+"""
+
+from __future__ import division
+
+import numpy as np
+import torch
+
+from problem import ProblemMetrics, MetricAccumulator
+
+# --
+# Helpers
+
+def accumulate(task, batches):
+    acc = MetricAccumulator(task)
+    for targets, preds in batches:
+        acc.add(torch.from_numpy(targets), torch.from_numpy(preds))
+    
+    return acc
+
+# --
+# Tests
+
+def test_classification_matches_sklearn():
+    rng = np.random.RandomState(123)
+    n_classes = 6
+    
+    # Class 5 never shows up in targets + preds only ever pick from the first 5 (sklearn's macro skips it)
+    batches = []
+    for batch_size in [32, 17, 50]:
+        targets = rng.randint(0, n_classes - 1, (batch_size, 1))
+        preds = rng.normal(size=(batch_size, n_classes)).astype(np.float32)
+        preds[:,-1] = -10
+        batches.append((targets, preds))
+    
+    acc = accumulate('classification', batches)
+    ref = ProblemMetrics.classification(np.vstack([b[0] for b in batches]).squeeze(), np.vstack([b[1] for b in batches]))
+    res = acc.compute()
+    
+    assert np.isclose(res['micro'], ref['micro'])
+    assert np.isclose(res['macro'], ref['macro'])
+
+
+def test_multilabel_matches_sklearn():
+    rng = np.random.RandomState(456)
+    n_labels = 7
+    
+    batches = []
+    for batch_size in [20, 33]:
+        targets = (rng.uniform(size=(batch_size, n_labels)) < 0.3).astype(np.float32)
+        targets[:,0] = 0 # Label w/o any positives
+        preds = rng.normal(size=(batch_size, n_labels)).astype(np.float32)
+        batches.append((targets, preds))
+    
+    acc = accumulate('multilabel_classification', batches)
+    ref = ProblemMetrics.multilabel_classification(np.vstack([b[0] for b in batches]), np.vstack([b[1] for b in batches]))
+    res = acc.compute()
+    
+    assert np.isclose(res['micro'], ref['micro'])
+    assert np.isclose(res['macro'], ref['macro'])
+
+
+def test_regression_matches_mae():
+    rng = np.random.RandomState(789)
+    batches = [(rng.normal(size=(n, 1)), rng.normal(size=(n, 1))) for n in [10, 25, 3]]
+    
+    acc = accumulate('regression_mae', batches)
+    ref = ProblemMetrics.regression_mae(np.vstack([b[0] for b in batches]), np.vstack([b[1] for b in batches]))
+    assert np.isclose(acc.compute(), ref)
+
+
+def test_compute_resets():
+    rng = np.random.RandomState(0)
+    targets, preds = rng.randint(0, 3, (10, 1)), rng.normal(size=(10, 3)).astype(np.float32)
+    
+    acc = accumulate('classification', [(targets, preds)])
+    first = acc.compute()
+    assert acc.compute() is None
+    
+    acc.add(torch.from_numpy(targets), torch.from_numpy(preds))
+    assert acc.compute() == first
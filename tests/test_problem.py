@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+"""
+    tests/test_problem.py
+"""
+
+from __future__ import division
+
+import os
+import sys
+import json
+import h5py
+import shutil
+import tempfile
+import subprocess
+import numpy as np
+import pytest
+
+from problem import NodeProblem, PrefetchLoader
+
+# --
+# Helpers
+
+class StubProblem(object):
+    """ just the parts of `NodeProblem` that `PrefetchLoader` uses """
+    cuda = False
+    
+    def __init__(self, n_nodes):
+        self.nodes = {"train" : np.arange(n_nodes)}
+    
+    chunks = NodeProblem.__dict__['chunks']
+    
+    def batch(self, mids):
+        return mids, mids
+
+
+def tagged_sample_fn(tag):
+    return lambda mids, rng: [tag] * len(mids)
+
+
+def write_graphsage_dir(inpath, n_nodes, n_edges, seed=123):
+    """ small random graph in the GraphSAGE input format that `utils/convert*.py` read """
+    rng = np.random.RandomState(seed)
+    folds = rng.choice(['train', 'val', 'test'], n_nodes)
+    edges = rng.choice(n_nodes, (n_edges, 2))
+    
+    G = {
+        "nodes" : [{"id" : 'n%d' % i, "val" : fold == 'val', "test" : fold == 'test'} for i, fold in enumerate(folds)],
+        "links" : [{"source" : int(src), "target" : int(trg)} for src, trg in edges],
+    }
+    json.dump(G, open(os.path.join(inpath, 'G.json'), 'w'))
+    json.dump(dict(('n%d' % i, i) for i in range(n_nodes)), open(os.path.join(inpath, 'id_map.json'), 'w'))
+    json.dump(dict(('n%d' % i, int(rng.randint(3))) for i in range(n_nodes)), open(os.path.join(inpath, 'class_map.json'), 'w'))
+    np.save(os.path.join(inpath, 'feats.npy'), rng.normal(size=(n_nodes, 4)))
+    return folds
+
+# --
+# Tests
+
+def test_prefetch_loaders_dont_share_state():
+    """ a second loader (threads or processes) mustn't redirect the first loader's workers """
+    for processes in [False, True]:
+        problem = StubProblem(n_nodes=40)
+        first = PrefetchLoader(problem, tagged_sample_fn('first'), n_workers=2, queue_size=2, processes=processes)
+        batches = first.iterate('train', batch_size=4)
+        _ = next(batches)
+        
+        second = PrefetchLoader(problem, tagged_sample_fn('second'), n_workers=2, queue_size=2, processes=processes)
+        
+        first_tags = set(tag for _, _, _, samples in batches for tag in samples)
+        second_tags = set(tag for _, _, _, samples in second.iterate('train', batch_size=4) for tag in samples)
+        assert first_tags == set(['first'])
+        assert second_tags == set(['second'])
+        
+        first.close()
+        second.close()
+
+
+@pytest.mark.skipif(not hasattr(h5py.Dataset, 'value'), reason='NodeProblem reads w/ `Dataset.value` (h5py < 3)')
+def test_convert_stream_round_trip():
+    """ a `utils/convert-stream.py` file loads into `NodeProblem` w/ the right (non-empty) splits """
+    inpath = tempfile.mkdtemp()
+    try:
+        folds = write_graphsage_dir(inpath, n_nodes=100, n_edges=500)
+        outpath = os.path.join(inpath, 'problem.h5')
+        script = os.path.join(os.path.dirname(__file__), '..', 'utils', 'convert-stream.py')
+        subprocess.check_call([sys.executable, script, '--inpath', inpath, '--outpath', outpath, '--max-degree', '8'])
+        
+        problem = NodeProblem(outpath, cuda=False)
+        assert problem.task == 'classification'
+        assert problem.nodes['train'].shape[0] > 0
+        for mode in ['train', 'val', 'test']:
+            assert (problem.nodes[mode] == np.where(folds == mode)[0]).all()
+    finally:
+        shutil.rmtree(inpath)
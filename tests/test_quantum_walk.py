@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+"""
+    tests/test_quantum_walk.py
+"""
+
+from __future__ import division
+
+import numpy as np
+import torch
+from torch.nn import functional as F
+
+from models import GSSupervised
+from nn_modules import GenerateQuantumWalkGraphs, QuantumWalkGraphs, SparseQuantumWalk, BucketedQuantumWalk, \
+    QuantumWalkDegree, UniformNeighborSampler, IdentityPrep, MeanAggregator, walk_lookup
+
+# --
+# Helpers
+
+def circulant_adj(n_nodes, offsets=(1, -1, 2, -2, 5, -5)):
+    """
+        dense adjacency (dummy node at the end) where node i's neighbors are `i + offsets` --
+        symmetric, so every sampled walk graph is too
+    """
+    offsets = np.array(offsets)
+    adj = (np.arange(n_nodes).reshape(-1, 1) + offsets) % n_nodes
+    adj = np.vstack([adj, np.zeros((1, offsets.shape[0]), dtype=adj.dtype) + n_nodes])
+    return torch.LongTensor(adj)
+
+# --
+# Tests
+
+def test_graphs_match_loop():
+    rng = np.random.RandomState(123)
+    n_nodes, batch_size, graph_size = 50, 8, 6
+    adj = torch.LongTensor(rng.randint(0, n_nodes, (n_nodes + 1, 8)))
+    
+    for ids in [
+        torch.LongTensor(rng.randint(0, n_nodes, batch_size * graph_size)),
+        adj[torch.LongTensor(rng.randint(0, n_nodes, batch_size)), :graph_size].contiguous().view(-1),
+        circulant_adj(n_nodes)[torch.LongTensor(rng.randint(0, n_nodes, batch_size))].contiguous().view(-1),
+    ]:
+        ref_amps, ref_graphs, ref_degree = GenerateQuantumWalkGraphs(adj, ids, batch_size, graph_size, vectorized=False)
+        amps, graphs, degree = GenerateQuantumWalkGraphs(adj, ids, batch_size, graph_size)
+        
+        assert degree == ref_degree
+        assert torch.equal(graphs, ref_graphs)
+        assert torch.equal(amps.data, ref_amps.data)
+
+
+def test_graphs_match_loop_chunked():
+    rng = np.random.RandomState(456)
+    n_nodes, batch_size, graph_size = 30, 16, 10
+    adj = torch.LongTensor(rng.randint(0, n_nodes, (n_nodes + 1, 10)))
+    ids = torch.LongTensor(rng.randint(0, n_nodes, batch_size * graph_size))
+    
+    _, ref_graphs, _ = GenerateQuantumWalkGraphs(adj, ids, batch_size, graph_size, vectorized=False)
+    
+    graphs = QuantumWalkGraphs(adj, ids, batch_size, graph_size, max_elements=graph_size * graph_size * 10 * 3)
+    assert torch.equal(graphs, ref_graphs)
+
+
+def test_bucketed_matches_sparse_w_isolated_nodes():
+    rng = np.random.RandomState(789)
+    n_nodes, batch_size, graph_size, dim = 40, 4, 4, 5
+    adj = circulant_adj(n_nodes)
+    
+    for ids in [
+        adj[torch.LongTensor(rng.randint(0, n_nodes, batch_size))][:,[0, 2, 4, 5]].contiguous().view(-1), # some isolated nodes
+        torch.LongTensor(np.repeat(np.arange(batch_size) * 10, graph_size)),                             # no edges at all
+    ]:
+        x, neibs = torch.randn(batch_size, dim), torch.randn(batch_size * graph_size, dim)
+        
+        sparse_walk, bucketed_walk = SparseQuantumWalk(), BucketedQuantumWalk()
+        ref = sparse_walk(x, neibs, time_steps=4, **sparse_walk.prepare(adj, ids, batch_size, graph_size))
+        out = bucketed_walk(x, neibs, time_steps=4, **bucketed_walk.prepare(adj, ids, batch_size, graph_size))
+        assert np.allclose(out.numpy(), ref.numpy(), atol=1e-5)
+
+
+def test_walk_modes_across_batches():
+    """ every `walk_lookup` mode, on batches w/ different degrees, matches the sparse walk (w/ the initial Grover coins) """
+    rng = np.random.RandomState(321)
+    n_nodes, batch_size, graph_size, dim = 40, 3, 4, 5
+    adj = circulant_adj(n_nodes)
+    
+    walks = dict([(mode, walk_class()) for mode, walk_class in walk_lookup.items()])
+    degrees = set()
+    for _ in range(10):
+        cols = torch.LongTensor(rng.permutation(adj.size(1))[:graph_size])
+        ids = adj[torch.LongTensor(rng.randint(0, n_nodes, batch_size))][:,cols].contiguous().view(-1)
+        x, neibs = torch.randn(batch_size, dim), torch.randn(batch_size * graph_size, dim)
+        degrees.add(QuantumWalkDegree(QuantumWalkGraphs(adj, ids, batch_size, graph_size)))
+        
+        ref = None
+        for mode in sorted(walks.keys(), key=lambda mode: mode != 'sparse'):
+            walk = walks[mode]
+            out = walk(x, neibs, time_steps=3, **walk.prepare(adj, ids, batch_size, graph_size)).data.numpy()
+            ref = out if ref is None else ref
+            assert np.allclose(out, ref, atol=1e-5), mode
+    
+    assert len(degrees) > 1
+
+
+def test_model_walk_modes_across_batches():
+    rng = np.random.RandomState(654)
+    n_nodes = 40
+    adj, feats = circulant_adj(n_nodes), torch.randn(n_nodes, 5)
+    
+    for mode in walk_lookup.keys():
+        model = GSSupervised(**{
+            "input_dim" : 5,
+            "n_nodes" : n_nodes,
+            "n_classes" : 3,
+            "layer_specs" : [
+                {"n_train_samples" : 4, "n_val_samples" : 4, "output_dim" : 8, "activation" : F.relu},
+                {"n_train_samples" : 3, "n_val_samples" : 3, "output_dim" : 8, "activation" : lambda x: x},
+            ],
+            "aggregator_class" : MeanAggregator,
+            "prep_class" : IdentityPrep,
+            "sampler_class" : UniformNeighborSampler,
+            "adj" : adj,
+            "train_adj" : adj,
+            "quantum_walk" : True,
+            "quantum_walk_mode" : mode,
+            "quantum_walk_steps" : 3,
+        })
+        
+        for _ in range(8):
+            ids = torch.LongTensor(rng.choice(n_nodes, 5, replace=False))
+            preds = model(ids, feats, train=True)
+            assert preds.size() == (5, 3)
+            assert np.isfinite(preds.data.numpy()).all()
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+
+"""
+    tests/test_samplers.py
+"""
+
+from __future__ import division
+
+import numpy as np
+import torch
+
+from nn_modules import UniformNeighborSampler, RowUniformNeighborSampler
+
+# --
+# Tests
+
+def test_uniform_samples_wo_replacement():
+    n_nodes, max_degree = 20, 8
+    adj = torch.arange((n_nodes + 1) * max_degree).long().view(n_nodes + 1, max_degree)
+    ids = torch.LongTensor(np.arange(n_nodes))
+    
+    for sampler in [UniformNeighborSampler(adj), RowUniformNeighborSampler(adj)]:
+        for rng in [None, np.random.RandomState(123)]:
+            out = sampler(ids, n_samples=5, rng=rng).numpy()
+            assert out.shape == (n_nodes, 5)
+            assert ((out // max_degree) == np.arange(n_nodes).reshape(-1, 1)).all() # Neighbors of the right row
+            assert all([len(set(row)) == 5 for row in out])                       # w/o replacement
+
+
+def test_row_uniform_rows_are_independent():
+    """ column sets of different rows aren't all rotations of one set -- pairs of slots are uniform """
+    max_degree = 8
+    adj = torch.arange(2 * max_degree).long().view(2, max_degree)
+    ids = torch.zeros(20000).long()
+    
+    cols = RowUniformNeighborSampler(adj)(ids, n_samples=2, rng=np.random.RandomState(456)).numpy()
+    gaps = (cols[:,1] - cols[:,0]) % max_degree
+    counts = np.bincount(gaps, minlength=max_degree)[1:]
+    assert counts.min() > 0.8 * counts.mean()
@@ -17,23 +17,28 @@ import torch
 from torch.autograd import Variable
 from torch.nn import functional as F
 
-from models import GSSupervised
-from problem import NodeProblem
-from helpers import set_seeds, to_numpy
-from nn_modules import aggregator_lookup, prep_lookup, sampler_lookup
+from models import build_model, save_checkpoint
+from problem import NodeProblem, PrefetchLoader, MetricAccumulator
+from helpers import set_seeds, to_numpy, AsyncLogger
+from profiler import profiler
+from distributed import init_worker, launch, default_threads
+from nn_modules import aggregator_lookup, prep_lookup, walk_lookup
 from lr import LRSchedule
 
 # --
 # Helpers
 
-def evaluate(model, problem, mode='val'):
+def evaluate(model, problem, mode='val', layerwise=False, chunk_size=8192):
     assert mode in ['test', 'val']
-    preds, acts = [], []
-    for (ids, targets, _) in problem.iterate(mode=mode, shuffle=False):
-        preds.append(to_numpy(model(ids, problem.feats, train=False)))
-        acts.append(to_numpy(targets))
+    accumulator = MetricAccumulator(problem.task)
+    if layerwise:
+        ids, targets = problem.batch(problem.nodes[mode])
+        accumulator.add(targets, model.infer(ids, problem.feats, chunk_size=chunk_size))
+    else:
+        for (ids, targets, _) in problem.iterate(mode=mode, shuffle=False):
+            accumulator.add(targets, model(ids, problem.feats, train=False))
     
-    return problem.metric_fn(np.vstack(acts), np.vstack(preds))
+    return accumulator.compute()
 
 # --
 # Args
@@ -43,6 +48,7 @@ def parse_args():
     
     parser.add_argument('--problem-path', type=str, required=True)
     parser.add_argument('--no-cuda', action="store_true")
+    parser.add_argument('--mmap', action="store_true") # memory-map the problem file instead of loading it
     
     # Optimization params
     parser.add_argument('--batch-size', type=int, default=512)
@@ -51,6 +57,21 @@ def parse_args():
     parser.add_argument('--lr-schedule', type=str, default='constant')
     parser.add_argument('--weight-decay', type=float, default=0.0)
     
+    # Evaluation params
+    parser.add_argument('--layerwise-eval', action="store_true") # full-graph, layer-by-layer inference
+    parser.add_argument('--eval-chunk-size', type=int, default=8192)
+    
+    # Data loading params
+    parser.add_argument('--prefetch-workers', type=int, default=0) # 0 = sample synchronously
+    parser.add_argument('--prefetch-queue', type=int, default=4)
+    parser.add_argument('--prefetch-processes', action="store_true")
+    
+    # Data-parallel params
+    parser.add_argument('--n-procs', type=int, default=1) # > 1 = data-parallel workers (CPU, gloo)
+    parser.add_argument('--threads-per-proc', type=int) # default: cores / n_procs
+    parser.add_argument('--dist-port', type=int) # default: any free port
+    parser.add_argument('--dist-timeout', type=float, default=240) # minutes -- has to cover an eval, which the other workers wait out
+    
     # Architecture params
     parser.add_argument('--sampler-class', type=str, default='uniform_neighbor_sampler')
     parser.add_argument('--aggregator-class', type=str, default='mean')
@@ -59,14 +80,28 @@ def parse_args():
     parser.add_argument('--n-train-samples', type=str, default='25,10')
     parser.add_argument('--n-val-samples', type=str, default='25,10')
     parser.add_argument('--output-dims', type=str, default='128,128')
+    parser.add_argument('--dedupe-neighbors', action="store_true") # gather + prep each sampled node once per hop
+    parser.add_argument('--mask-dummy-neighbors', action="store_true") # attention aggregators ignore the dummy (padding) node
+    
+    # Historical embeddings params
+    parser.add_argument('--historical-embeddings', action="store_true") # train w/ one hop + stored hidden embeddings
+    parser.add_argument('--history-staleness', type=int, default=100) # steps before a stored embedding is recomputed
+    parser.add_argument('--history-mb', type=float, default=1024)
+    parser.add_argument('--history-refresh', type=int, default=1024) # max stale embeddings recomputed per step (0 = all)
     
     # Logging
     parser.add_argument('--log-interval', default=10, type=int)
+    parser.add_argument('--profile', action="store_true") # per-stage timers + counters in the log
+    parser.add_argument('--profile-cuda-sync', action="store_true") # synchronize around timers, for accurate GPU times
     parser.add_argument('--seed', default=123, type=int)
     parser.add_argument('--show-test', action="store_true")
+    parser.add_argument('--save-path', type=str) # checkpoint for `score.py`
 
     # Use quantum walk
     parser.add_argument("--quantum-walk", type=bool, default=False)
+    parser.add_argument("--quantum-walk-mode", type=str, default='dense')
+    parser.add_argument("--quantum-walk-cache-mb", type=float, default=256)
+    parser.add_argument("--quantum-walk-steps", type=int, default=4)
     
     # --
     # Validate args
@@ -75,106 +110,192 @@ def parse_args():
     args.cuda = not args.no_cuda
     assert args.prep_class in prep_lookup.keys(), 'parse_args: prep_class not in %s' % str(prep_lookup.keys())
     assert args.aggregator_class in aggregator_lookup.keys(), 'parse_args: aggregator_class not in %s' % str(aggregator_lookup.keys())
+    assert args.quantum_walk_mode in walk_lookup.keys(), 'parse_args: quantum_walk_mode not in %s' % str(walk_lookup.keys())
     assert args.batch_size > 1, 'parse_args: batch_size must be > 1'
+    assert args.log_interval > 0, 'parse_args: log_interval must be > 0'
+    assert not (args.prefetch_processes and args.cuda), 'parse_args: --prefetch-processes requires --no-cuda'
+    assert args.n_procs > 0, 'parse_args: n_procs must be > 0'
+    assert not (args.n_procs > 1 and args.cuda), 'parse_args: --n-procs > 1 requires --no-cuda'
     return args
 
 
-if __name__ == "__main__":
-    args = parse_args()
+# --
+# Train
+
+def train(args, rank=0, world_size=1):
+    """
+        train (+ evaluate, log + save) a model -- as worker `rank` of `world_size` data-parallel
+        workers, if `world_size > 1`, in which case only rank 0 evaluates, logs + saves.  The
+        other workers wait for each eval at a barrier, for up to `--dist-timeout` minutes
+    """
+    is_main = rank == 0
     set_seeds(args.seed)
     
     # --
     # Load problem
     
-    problem = NodeProblem(problem_path=args.problem_path, cuda=args.cuda)
+    # (data-parallel workers share the problem file through the page cache)
+    problem = NodeProblem(problem_path=args.problem_path, cuda=args.cuda, mmap=args.mmap or world_size > 1)
     
     # --
     # Define model
     
-    n_train_samples = map(int, args.n_train_samples.split(','))
-    n_val_samples = map(int, args.n_val_samples.split(','))
-    output_dims = map(int, args.output_dims.split(','))
-    model = GSSupervised(**{
-        "sampler_class" : sampler_lookup[args.sampler_class],
-        "adj" : problem.adj,
-        "train_adj" : problem.train_adj,
-        
-        "prep_class" : prep_lookup[args.prep_class],
-        "aggregator_class" : aggregator_lookup[args.aggregator_class],
+    config = {
+        "sampler_class" : args.sampler_class,
+        "prep_class" : args.prep_class,
+        "aggregator_class" : args.aggregator_class,
         
         "input_dim" : problem.feats_dim,
-        "n_nodes"   : problem.n_nodes,
-        "n_classes" : problem.n_classes,
-        "layer_specs" : [
-            {
-                "n_train_samples" : n_train_samples[0],
-                "n_val_samples" : n_val_samples[0],
-                "output_dim" : output_dims[0],
-                "activation" : F.relu,
-            },
-            {
-                "n_train_samples" : n_train_samples[1],
-                "n_val_samples" : n_val_samples[1],
-                "output_dim" : output_dims[1],
-                "activation" : lambda x: x,
-            },
-        ],
+        "n_nodes"   : int(problem.n_nodes),
+        "n_classes" : int(problem.n_classes),
+        
+        "n_train_samples" : map(int, args.n_train_samples.split(',')),
+        "n_val_samples" : map(int, args.n_val_samples.split(',')),
+        "output_dims" : map(int, args.output_dims.split(',')),
         
         "lr_init" : args.lr_init,
         "lr_schedule" : args.lr_schedule,
         "weight_decay" : args.weight_decay,
         "quantum_walk" : args.quantum_walk,
-    })
+        "quantum_walk_mode" : args.quantum_walk_mode,
+        "quantum_walk_cache_mb" : args.quantum_walk_cache_mb,
+        "quantum_walk_steps" : args.quantum_walk_steps,
+        "dedupe_neighbors" : args.dedupe_neighbors,
+        "mask_dummy_neighbors" : args.mask_dummy_neighbors,
+        "historical_embeddings" : args.historical_embeddings,
+        "history_staleness" : args.history_staleness,
+        "history_mb" : args.history_mb,
+        "history_refresh" : args.history_refresh,
+    }
+    model = build_model(config, adj=problem.adj, train_adj=problem.train_adj)
     
     if args.cuda:
         model = model.cuda()
     
-    print(model, file=sys.stderr)
+    if world_size > 1:
+        model.distribute(world_size)
+    
+    if is_main:
+        print(model, file=sys.stderr)
     
     # --
     # Train
     
-    set_seeds(args.seed ** 2)
+    set_seeds(args.seed ** 2 + rank)
+    shard = (rank, world_size) if world_size > 1 else None
+    
+    loader = None
+    if args.prefetch_workers > 0:
+        loader = PrefetchLoader(
+            problem=problem,
+            sample_fn=model.sample,
+            n_workers=args.prefetch_workers,
+            queue_size=args.prefetch_queue,
+            processes=args.prefetch_processes,
+            seed=args.seed,
+            shard=shard,
+        )
+    
+    logger = AsyncLogger(sys.stdout) if is_main else None
+    accumulator = MetricAccumulator(problem.task)
+    if args.profile:
+        profiler.enable(cuda_sync=args.profile_cuda_sync)
     
     start_time = time()
     val_metric = None
+    train_metric = None
     for epoch in range(args.epochs):
         
         # Train
         _ = model.train()
-        for ids, targets, epoch_progress in problem.iterate(mode='train', shuffle=True, batch_size=args.batch_size):
+        if loader is not None:
+            batches = loader.iterate(mode='train', shuffle=True, batch_size=args.batch_size)
+        else:
+            rng = np.random.RandomState([args.seed, epoch]) if shard is not None else None # Same shuffle on every worker
+            batches = ((ids, targets, epoch_progress, None) for ids, targets, epoch_progress in
+                problem.iterate(mode='train', shuffle=True, batch_size=args.batch_size, rng=rng, shard=shard))
+        
+        for step, (ids, targets, epoch_progress, samples) in enumerate(batches):
             model.set_progress((epoch + epoch_progress) / args.epochs)
             preds = model.train_step(
                 ids=ids, 
                 feats=problem.feats,
                 targets=targets,
                 loss_fn=problem.loss_fn,
+                samples=samples,
             )
-            train_metric = problem.metric_fn(to_numpy(targets), to_numpy(preds))
-            print(json.dumps({
-                "epoch" : epoch,
-                "epoch_progress" : epoch_progress,
-                "train_metric" : train_metric,
-                "val_metric" : val_metric,
-                "time" : time() - start_time,
-            }, double_precision=5))
-            sys.stdout.flush()
+            accumulator.add(targets, preds)
+            if is_main and (step + 1) % args.log_interval == 0:
+                train_metric = accumulator.compute()
+                record = {
+                    "epoch" : epoch,
+                    "epoch_progress" : epoch_progress,
+                    "train_metric" : train_metric,
+                    "val_metric" : val_metric,
+                    "time" : time() - start_time,
+                }
+                if profiler.enabled:
+                    record['profile'] = profiler.summary()
+                
+                logger.log(record)
+        
+        if accumulator.counts is not None:
+            train_metric = accumulator.compute()
         
         # Evaluate
-        _ = model.eval()
-        val_metric = evaluate(model, problem, mode='val')
+        if is_main:
+            _ = model.eval()
+            with profiler.timer('evaluate'):
+                val_metric = evaluate(model, problem, mode='val', layerwise=args.layerwise_eval, chunk_size=args.eval_chunk_size)
+        
+        if world_size > 1:
+            torch.distributed.barrier()
+    
+    if loader is not None:
+        loader.close()
+    
+    if not is_main:
+        return
     
     print('-- done --', file=sys.stderr)
-    print(json.dumps({
+    if args.save_path:
+        save_checkpoint(model, config, args.save_path)
+        print('saved -> %s' % args.save_path, file=sys.stderr)
+    
+    if args.quantum_walk and model.walk_cache is not None:
+        print(json.dumps({"quantum_walk_cache" : model.walk_cache.stats()}), file=sys.stderr)
+    
+    if model.history is not None:
+        print(json.dumps({"historical_embeddings" : model.history.stats()}), file=sys.stderr)
+    
+    record = {
         "epoch" : epoch,
         "train_metric" : train_metric,
         "val_metric" : val_metric,
         "time" : time() - start_time,
-    }, double_precision=5))
-    sys.stdout.flush()
+    }
+    if profiler.enabled:
+        record['profile'] = profiler.summary()
+    
+    logger.log(record)
     
     if args.show_test:
-        print(json.dumps({
-            "test_f1" : evaluate(model, problem, mode='test')
-        }, double_precision=5))
+        logger.log({
+            "test_f1" : evaluate(model, problem, mode='test', layerwise=args.layerwise_eval, chunk_size=args.eval_chunk_size)
+        })
+    
+    logger.close()
+
+
+def train_worker(rank, world_size, port, args):
+    init_worker(rank, world_size, port, n_threads=args.threads_per_proc or default_threads(world_size),
+        timeout_minutes=args.dist_timeout)
+    train(args, rank=rank, world_size=world_size)
 
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.n_procs > 1:
+        launch(train_worker, args.n_procs, args=(args,), port=args.dist_port)
+    else:
+        train(args)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+"""
+    adjacency.py
+    
+    Adjacency lists from edge arrays -- shared by `convert.py`, `convert-stream.py` + the
+    dataset specific converters.  Only needs numpy + scipy (no networkx).
+"""
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+# --
+# Helpers
+
+def parse_fold(x):
+    if x['test']:
+        return 'test'
+    elif x['val']:
+        return 'val'
+    else:
+        return 'train'
+
+
+def segment_rank(counts):
+    """ position of each element within its segment, for segments of length `counts` """
+    starts = np.cumsum(counts) - counts
+    return np.arange(counts.sum()) - np.repeat(starts, counts)
+
+
+def sort_edges(edges, n_nodes, directed=False):
+    """ (src, trg) of an edge array, deduped + sorted by src then trg (both ways, unless `directed`) """
+    edges = np.asarray(edges, dtype=np.int64)
+    src, trg = edges[:,0], edges[:,1]
+    if not directed:
+        src, trg = np.hstack([src, trg]), np.hstack([trg, src])
+    
+    # Dedupe (`np.unique` is much slower than sort + mask here)
+    key = src * n_nodes + trg
+    key.sort()
+    first = np.ones(key.shape[0], dtype=bool)
+    first[1:] = key[1:] != key[:-1]
+    key = key[first]
+    return key // n_nodes, key % n_nodes
+
+
+def edge_segments(edges, n_nodes, sel=None, directed=False, rng=None, n_rows=None):
+    """
+        Neighbor lists of an `[n_edges, 2]` (src, trg) edge array, as CSR-style segments:
+        `(trg, degrees, indptr)` w/ `trg` grouped by src node, in random order within each
+        node (so the first `k` of a segment are a uniform sample w/o replacement).
+        
+        Duplicate edges are dropped, and (unless `directed`) edges go both ways -- same
+        neighbors as `G.neighbors` on `nx.from_edgelist(edges)`.  If `sel` is given, only
+        keeps edges w/ both ends in `sel`.
+        
+        `n_rows` is for building a shard of rows: src has already been offset into
+        `[0, n_rows)` (and filtered by the caller), trg is still in `[0, n_nodes)`.
+    """
+    rng = rng if rng is not None else np.random
+    n_rows = n_rows if n_rows is not None else n_nodes
+    
+    src, trg = sort_edges(edges, n_nodes, directed=directed)
+    if sel is not None:
+        keep = sel[src] & sel[trg]
+        src, trg = src[keep], trg[keep]
+    
+    # Shuffle within each segment -- sort by src, random tiebreak in [0, 1)
+    order = np.argsort(src + rng.random_sample(src.shape[0]), kind='mergesort')
+    src, trg = src[order], trg[order]
+    
+    degrees = np.bincount(src, minlength=n_rows)
+    indptr = np.hstack([[0], np.cumsum(degrees)])
+    return trg, degrees, indptr
+
+
+def make_edge_adjacency(edges, n_nodes, max_degree, sel=None, directed=False, rng=None, n_rows=None):
+    """
+        `[n_nodes + 1, max_degree]` adjacency list (w/ dummy node `n_nodes`) from an edge array
+        
+        Nodes w/ more than `max_degree` neighbors keep a sample w/o replacement, nodes w/ fewer
+        are padded w/ a sample w/ replacement, nodes w/o neighbors point at the dummy node.
+        
+        If `n_rows` is given, returns just those `[n_rows, max_degree]` rows (see `edge_segments`)
+    """
+    rng = rng if rng is not None else np.random
+    trg, degrees, indptr = edge_segments(edges, n_nodes, sel=sel, directed=directed, rng=rng, n_rows=n_rows)
+    n_dummy = 1 if n_rows is None else 0
+    n_rows = degrees.shape[0]
+    
+    # Initialize w/ links to a dummy node
+    adj = np.zeros((n_rows + n_dummy, max_degree), dtype=np.int64) + n_nodes
+    
+    # Downsample -- first `max_degree` of each (shuffled) segment
+    n_keep = np.minimum(degrees, max_degree)
+    rows = np.repeat(np.arange(n_rows), n_keep)
+    cols = segment_rank(n_keep)
+    adj[rows, cols] = trg[indptr[rows] + cols]
+    
+    # Upsample -- fill remaining slots w/ random neighbors
+    n_extra = np.where(degrees > 0, max_degree - n_keep, 0)
+    rows = np.repeat(np.arange(n_rows), n_extra)
+    cols = degrees[rows] + segment_rank(n_extra)
+    offsets = (rng.random_sample(rows.shape[0]) * degrees[rows]).astype(np.int64)
+    adj[rows, cols] = trg[indptr[rows] + offsets]
+    
+    return adj
+
+
+def make_edge_sparse_adjacency(edges, n_nodes, sel=None, directed=False, rng=None):
+    """ sparse adjacency (w/ dummy node in row 0 + neighbors stored off-by-one) from an edge array """
+    trg, degrees, indptr = edge_segments(edges, n_nodes, sel=sel, directed=directed, rng=rng)
+    
+    cols = segment_rank(degrees)
+    return csr_matrix(
+        (trg + 1, cols, np.hstack([[0], indptr])), # Off-by-one
+        shape=(n_nodes + 1, max(degrees.max() if n_nodes > 0 else 0, 1)),
+    )
@@ -1,12 +1,11 @@
 # !! Need to update this
 
 import h5py
-import networkx as nx
 import numpy as np
 from scipy import sparse as sp
 import pandas as pd
 
-from convert import make_adjacency
+from adjacency import make_edge_adjacency
 
 def encode_onehot(labels):
     ulabels = set(labels)
@@ -72,10 +71,9 @@ dense_adj = sparse_adj.todense()
 dense_adj = dense_adj[:folds.shape[0]][:,:folds.shape[0]]
 dense_adj += np.identity(dense_adj.shape[0])
 edges     = np.vstack(np.where(dense_adj)).T
-G         = nx.from_edgelist(edges)
 
-train_adj = make_adjacency(G, folds, 128, train=True)
-adj = make_adjacency(G, folds, 128, train=False)
+train_adj = make_edge_adjacency(edges, folds.shape[0], 128, sel=(folds == 'train'))
+adj = make_edge_adjacency(edges, folds.shape[0], 128, sel=None)
 
 outpath = './data/cora/problem.h5'
 problem = {
@@ -3,8 +3,8 @@ import sys
 import h5py
 import numpy as np
 import pandas as pd
-import networkx as nx
-from convert import make_adjacency, make_sparse_adjacency, save_problem, spadj2edgelist
+from adjacency import make_edge_adjacency, make_edge_sparse_adjacency
+from convert import save_problem, spadj2edgelist
 
 np.random.seed(123)
 
@@ -47,12 +47,13 @@ ages = ages[['uid', 'age']]
 targets = np.array(ages.age).astype(float).reshape(-1, 1)
 folds = np.random.choice(['train', 'val'], targets.shape[0], p=[0.5, 0.5])
 
-G = nx.from_edgelist(np.array(edges))
+edges = np.array(edges)
+n_nodes = targets.shape[0]
 
 # --
 # Dense version
 
-adj = make_adjacency(G, max_degree, sel=None) # Adds dummy node
+adj = make_edge_adjacency(edges, n_nodes, max_degree, sel=None) # Adds dummy node
 
 aug_targets = np.vstack([targets, np.zeros((targets.shape[1],), dtype='float64')])
 aug_folds   = np.hstack([folds, ['dummy']])
@@ -70,7 +71,7 @@ save_problem({
 }, '../data/pokec/problem.h5')
 
 
-spadj = make_sparse_adjacency(G, sel=None)
+spadj = make_edge_sparse_adjacency(edges, n_nodes, sel=None)
 aug_targets = np.vstack([np.zeros((targets.shape[1],), dtype='float64'), targets])
 aug_folds   = np.hstack([['dummy'], folds])
 
@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+
+"""
+    convert-stream.py
+    
+    Streaming version of `convert.py`, for graphs that don't fit in memory.
+    
+    Edges + features are read in chunks of `--chunk-size` rows and written
+    incrementally to the output HDF5 file.  Only per-node vectors (node ids,
+    folds, targets, feature row index) are held in memory.
+    
+    Adjacency lists are built one shard of src nodes at a time.  One pass over the
+    edge list writes each edge to a (temporary, on disk) bucket for its src shard,
+    then each shard is built from its own bucket -- so the edges are read twice in
+    total, no matter how many shards there are.
+    
+    `ijson` is used to stream `G.json` / `id_map.json` / `class_map.json` if it's
+    installed -- otherwise they're loaded w/ `json.load`.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import h5py
+import shutil
+import argparse
+import numpy as np
+import ujson as json
+from tqdm import tqdm
+from time import time
+
+from adjacency import parse_fold, make_edge_adjacency
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# --
+# Helpers
+
+def iter_json(path, prefix):
+    """ stream items of `prefix` (ijson syntax, eg `nodes.item`) from a JSON file """
+    if ijson is not None:
+        with open(path, 'rb') as f:
+            for x in ijson.items(f, prefix):
+                yield x
+    else:
+        print('iter_json: ijson not installed -- loading %s into memory' % path, file=sys.stderr)
+        x = json.load(open(path))
+        for k in prefix.split('.'):
+            x = x if k == 'item' else x[k]
+        
+        for xx in x:
+            yield xx
+
+def iter_json_dict(path):
+    """ stream (key, value) pairs of a top-level JSON object """
+    if ijson is not None:
+        with open(path, 'rb') as f:
+            for k, v in ijson.kvitems(f, ''):
+                yield k, v
+    else:
+        print('iter_json_dict: ijson not installed -- loading %s into memory' % path, file=sys.stderr)
+        for k, v in json.load(open(path)).items():
+            yield k, v
+
+def iter_chunks(iterable, chunk_size):
+    chunk = []
+    for x in iterable:
+        chunk.append(x)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    
+    if len(chunk):
+        yield chunk
+
+
+class H5Writer(object):
+    """
+        Appends rows to an HDF5 dataset.
+        
+        If `n_rows` is known, the dataset is preallocated + contiguous (so it can be
+        memory-mapped by `NodeProblem(..., mmap=True)`), otherwise it's chunked and
+        resized on every append.
+    """
+    def __init__(self, f, key, shape, dtype, n_rows=None, chunk_size=2 ** 16):
+        if n_rows is not None:
+            self.ds = f.create_dataset(key, shape=(n_rows,) + tuple(shape), dtype=dtype)
+        else:
+            self.ds = f.create_dataset(key, shape=(0,) + tuple(shape), maxshape=(None,) + tuple(shape),
+                dtype=dtype, chunks=(min(chunk_size, 2 ** 16),) + tuple(shape))
+        
+        self.resizable = n_rows is None
+        self.offset = 0
+    
+    def append(self, x):
+        if self.resizable:
+            self.ds.resize(self.offset + x.shape[0], axis=0)
+        
+        self.ds[self.offset:self.offset + x.shape[0]] = x
+        self.offset += x.shape[0]
+
+
+class Progress(object):
+    """ tqdm progress bar + throughput summary for one stage """
+    def __init__(self, desc, total=None, unit='rows'):
+        self.desc  = desc
+        self.unit  = unit
+        self.count = 0
+        self.start = time()
+        self.pbar  = tqdm(total=total, desc=desc, unit=unit, unit_scale=True)
+    
+    def update(self, n):
+        self.count += n
+        self.pbar.update(n)
+    
+    def close(self):
+        self.pbar.close()
+        elapsed = time() - self.start
+        print(json.dumps({
+            "stage"      : self.desc,
+            self.unit    : self.count,
+            "time"       : elapsed,
+            "throughput" : self.count / max(elapsed, 1e-9),
+        }, double_precision=3), file=sys.stderr)
+
+# --
+# Stages
+
+def read_nodes(inpath, chunk_size):
+    """ node ids (in `G.json` order) + folds """
+    node_ids, folds = [], []
+    progress = Progress('nodes', unit='nodes')
+    for chunk in iter_chunks(iter_json(os.path.join(inpath, 'G.json'), 'nodes.item'), chunk_size):
+        node_ids += [str(node['id']) for node in chunk]
+        folds += [parse_fold(node) for node in chunk]
+        progress.update(len(chunk))
+    
+    progress.close()
+    return node_ids, np.array(folds)
+
+
+def read_node_map(path, node_lookup, default=None):
+    """ values of a `{node_id : value}` JSON object, in node order """
+    out = [default] * len(node_lookup)
+    for k, v in iter_json_dict(path):
+        if k in node_lookup:
+            out[node_lookup[k]] = v
+    
+    assert all([x is not None for x in out]), 'read_node_map: %s is missing nodes' % path
+    return out
+
+
+def write_edges(inpath, ef, chunk_size):
+    """
+        copy `links` from `G.json` to an on-disk `[n_edges, 2]` dataset
+        
+        `source` + `target` are node indices, as written by `networkx` 1.x `node_link_data`
+    """
+    writer = H5Writer(ef, 'edges', (2,), np.int64, chunk_size=chunk_size)
+    progress = Progress('edges', unit='edges')
+    for chunk in iter_chunks(iter_json(os.path.join(inpath, 'G.json'), 'links.item'), chunk_size):
+        writer.append(np.array([(int(l['source']), int(l['target'])) for l in chunk], dtype=np.int64))
+        progress.update(len(chunk))
+    
+    progress.close()
+    return writer.ds
+
+
+def feature_moments(feats, idx, sel, chunk_size):
+    """ streaming mean + std of `feats[idx][sel]` -- same as `StandardScaler` (std=0 -> 1) """
+    count, mean, m2 = 0, 0, 0
+    progress = Progress('feats (moments)', total=idx.shape[0])
+    for offset in range(0, idx.shape[0], chunk_size):
+        chunk_sel = sel[offset:offset + chunk_size]
+        x = np.asarray(feats[np.sort(idx[offset:offset + chunk_size][chunk_sel])], dtype=np.float64)
+        progress.update(chunk_sel.shape[0])
+        if x.shape[0] == 0:
+            continue
+        
+        # Merge chunk moments (Chan et al.)
+        x_mean = x.mean(axis=0)
+        delta = x_mean - mean
+        total = count + x.shape[0]
+        mean = mean + delta * x.shape[0] / total
+        m2 = m2 + ((x - x_mean) ** 2).sum(axis=0) + delta ** 2 * count * x.shape[0] / total
+        count = total
+    
+    progress.close()
+    
+    std = np.sqrt(m2 / count)
+    std[std == 0] = 1
+    return mean, std
+
+
+def write_feats(f, feats, idx, mean, std, chunk_size):
+    writer = H5Writer(f, 'feats', feats.shape[1:], np.float64, n_rows=idx.shape[0] + 1)
+    progress = Progress('feats (write)', total=idx.shape[0])
+    for offset in range(0, idx.shape[0], chunk_size):
+        x = np.asarray(feats[idx[offset:offset + chunk_size]], dtype=np.float64)
+        writer.append((x - mean) / std)
+        progress.update(x.shape[0])
+    
+    writer.append(np.zeros((1,) + feats.shape[1:])) # Add feat for dummy node
+    progress.close()
+
+
+def default_shard_size(n_nodes, n_edges, chunk_size):
+    """ number of src nodes per shard, so that shards hold ~`chunk_size` (directed) edges on average """
+    return int(max(1, min(n_nodes, chunk_size * n_nodes // max(2 * n_edges, 1))))
+
+
+def bucket_edges(ef, edges, n_nodes, shard_size, chunk_size):
+    """
+        one pass over `edges`: writes each edge (both ways) to the on-disk bucket of its src
+        shard, as `(src - lo, trg)` rows
+    """
+    n_shards = (n_nodes + shard_size - 1) // shard_size
+    writers = [H5Writer(ef, 'buckets/%d' % i, (2,), np.int64, chunk_size=chunk_size) for i in range(n_shards)]
+    
+    progress = Progress('edges (bucket)', total=edges.shape[0], unit='edges')
+    for offset in range(0, edges.shape[0], chunk_size):
+        e = edges[offset:offset + chunk_size]
+        src, trg = np.hstack([e[:,0], e[:,1]]), np.hstack([e[:,1], e[:,0]])
+        
+        shard = src // shard_size
+        order = np.argsort(shard, kind='mergesort')
+        src, trg, shard = src[order], trg[order], shard[order]
+        
+        bounds = np.searchsorted(shard, np.arange(n_shards + 1))
+        for i in np.nonzero(np.diff(bounds))[0]:
+            s, t = src[bounds[i]:bounds[i + 1]], trg[bounds[i]:bounds[i + 1]]
+            writers[i].append(np.column_stack([s - i * shard_size, t]))
+        
+        progress.update(e.shape[0])
+    
+    progress.close()
+    return [writer.ds for writer in writers]
+
+
+def write_adjacencies(f, keys, sels, buckets, n_nodes, max_degree, shard_size):
+    """
+        `[n_nodes + 1, max_degree]` adjacency lists (one per key, only edges w/ both ends in
+        the matching `sel`), built one shard of src nodes at a time from `bucket_edges`.
+        
+        W/ `default_shard_size`, shards hold ~`chunk_size` edges on average, so peak memory
+        is bounded by `chunk_size` (times the skew of the degree distribution).
+    """
+    writers = [H5Writer(f, key, (max_degree,), np.int64, n_rows=n_nodes + 1) for key in keys]
+    progress = Progress('adjacency (%s)' % ', '.join(keys), total=n_nodes, unit='nodes')
+    for bucket, lo in zip(buckets, range(0, n_nodes, shard_size)):
+        hi = min(lo + shard_size, n_nodes)
+        
+        shard = bucket[:]
+        for writer, sel in zip(writers, sels):
+            e = shard
+            if sel is not None:
+                e = shard[sel[shard[:,0] + lo] & sel[shard[:,1]]]
+            
+            writer.append(make_edge_adjacency(e, n_nodes, max_degree, directed=True, n_rows=hi - lo))
+        
+        progress.update(hi - lo)
+    
+    for writer in writers:
+        writer.append(np.zeros((1, max_degree), dtype=np.int64) + n_nodes) # Dummy node
+    
+    progress.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--inpath', type=str, default='./data/reddit/')
+    parser.add_argument('--outpath', type=str)
+    parser.add_argument('--max-degree', type=int, default=128)
+    parser.add_argument('--task', type=str, default='classification')
+    parser.add_argument('--chunk-size', type=int, default=2 ** 20)
+    parser.add_argument('--seed', type=int, default=123)
+    
+    args = parser.parse_args()
+    assert args.task in ['classification', 'multilabel_classification'], 'unknown args.task'
+    assert args.chunk_size > 0, 'chunk_size must be > 0'
+    if not args.outpath:
+        args.outpath = os.path.join(args.inpath, 'problem.h5')
+    
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    np.random.seed(args.seed)
+    
+    if os.path.exists(args.outpath):
+        print('backing up old problem.h5', file=sys.stderr)
+        _ = shutil.move(args.outpath, args.outpath + '.bak')
+    
+    start_time = time()
+    
+    print('loading <- %s' % args.inpath, file=sys.stderr)
+    node_ids, folds = read_nodes(args.inpath, args.chunk_size)
+    node_lookup = dict(zip(node_ids, range(len(node_ids))))
+    n_nodes = len(node_ids)
+    
+    idx = np.array(read_node_map(os.path.join(args.inpath, 'id_map.json'), node_lookup), dtype=np.int64)
+    targets = np.vstack(read_node_map(os.path.join(args.inpath, 'class_map.json'), node_lookup))
+    del node_ids, node_lookup
+    
+    if args.task == 'classification':
+        n_classes = len(np.unique(targets))
+    elif args.task == 'multilabel_classification':
+        n_classes = targets.shape[1]
+    
+    f = h5py.File(args.outpath, 'w')
+    f['task'] = args.task
+    f['n_classes'] = n_classes
+    f['targets'] = np.vstack([targets, np.zeros((targets.shape[1],), dtype='int64')])
+    f['folds'] = np.hstack([folds, ['dummy']]).astype('S')
+    del targets
+    
+    print('normalizing feats', file=sys.stderr)
+    feats = np.load(os.path.join(args.inpath, 'feats.npy'), mmap_mode='r')
+    mean, std = feature_moments(feats, idx, folds == 'train', args.chunk_size)
+    write_feats(f, feats, idx, mean, std, args.chunk_size)
+    del feats
+    
+    print('making adjacency lists', file=sys.stderr)
+    edge_path = args.outpath + '.edges.h5'
+    ef = h5py.File(edge_path, 'w')
+    edges = write_edges(args.inpath, ef, args.chunk_size)
+    size = default_shard_size(n_nodes, edges.shape[0], args.chunk_size)
+    buckets = bucket_edges(ef, edges, n_nodes, size, args.chunk_size)
+    write_adjacencies(f, ['adj', 'train_adj'], [None, (folds == 'train')], buckets, n_nodes, args.max_degree, size) # Adds dummy node
+    ef.close()
+    os.remove(edge_path)
+    
+    f.close()
+    print('saved -> %s (%fs)' % (args.outpath, time() - start_time), file=sys.stderr)
@@ -11,30 +11,20 @@ from __future__ import print_function
 import os
 import sys
 import h5py
+import ctypes
 import shutil
-import cPickle
 import argparse
 import numpy as np
 import ujson as json
 from tqdm import tqdm
-import networkx as nx
-from scipy.sparse import csr_matrix
-from networkx.readwrite import json_graph
+from multiprocessing import Pool, RawArray
 from sklearn.preprocessing import StandardScaler
 
-assert int(nx.__version__.split('.')[0]) < 2, "networkx major version > 1"
+from adjacency import parse_fold, sort_edges, make_edge_adjacency, make_edge_sparse_adjacency
 
 # --
 # Helpers
 
-def parse_fold(x):
-    if x['test']:
-        return 'test'
-    elif x['val']:
-        return 'val'
-    else:
-        return 'train'
-
 def validate_problem(problem):
     assert problem['adj'] is not None, "problem['adj'] is None"
     assert problem['train_adj'] is not None, "problem['train_adj'] is None"
@@ -69,61 +59,86 @@ def save_problem(problem, outpath):
 
 
 def make_adjacency(G, max_degree, sel=None):
-    
-    all_nodes = np.array(G.nodes())
-    
-    # Initialize w/ links to a dummy node
-    n_nodes = len(all_nodes)
-    adj = (np.zeros((n_nodes + 1, max_degree)) + n_nodes).astype(int)
-    
-    if sel is not None:
-        # only look at nodes in training set
-        all_nodes = all_nodes[sel]
-    
-    for node in tqdm(all_nodes):
-        neibs = np.array(list(G.neighbors(node)))
-        
-        if sel is not None:
-            neibs = neibs[sel[neibs]]
-        
-        if len(neibs) > 0:
-            if len(neibs) > max_degree:
-                neibs = np.random.choice(neibs, max_degree, replace=False)
-            elif len(neibs) < max_degree:
-                extra = np.random.choice(neibs, max_degree - neibs.shape[0], replace=True)
-                neibs = np.concatenate([neibs, extra])
-            
-            adj[node, :] = neibs
-    
-    return adj
+    return make_edge_adjacency(np.array(G.edges()).reshape(-1, 2), len(G.nodes()), max_degree, sel=sel)
 
 def make_sparse_adjacency(G, sel=None):
+    return make_edge_sparse_adjacency(np.array(G.edges()).reshape(-1, 2), len(G.nodes()), sel=sel)
+
+# --
+# Parallel (sharded) adjacency lists
+
+_shard_state = {}
+
+def _make_adjacency_shard(args):
+    """ rows `[lo, hi)` of one output -- runs in a worker, writes straight to shared memory """
+    key_idx, shard_idx, lo, hi = args
+    src, trg, indptr = _shard_state['src'], _shard_state['trg'], _shard_state['indptr']
+    n_nodes, max_degree, seed = _shard_state['n_nodes'], _shard_state['max_degree'], _shard_state['seed']
+    sel = _shard_state['sels'][key_idx]
+    out = np.frombuffer(_shard_state['outs'][key_idx], dtype=np.int64).reshape(n_nodes + 1, max_degree)
     
-    all_nodes = np.array(G.nodes())
-    
-    r, c, v = [], [], []
-    
+    s, t = src[indptr[lo]:indptr[hi]], trg[indptr[lo]:indptr[hi]]
     if sel is not None:
-        all_nodes = all_nodes[sel]
+        keep = sel[s] & sel[t]
+        s, t = s[keep], t[keep]
+    
+    rng = np.random.RandomState([seed, key_idx, shard_idx])
+    out[lo:hi] = make_edge_adjacency(np.column_stack([s - lo, t]), n_nodes, max_degree,
+        directed=True, rng=rng, n_rows=hi - lo)
     
-    for node in tqdm(all_nodes):
-        neibs = np.array(list(G.neighbors(node)))
+    return hi - lo
+
+
+def make_edge_adjacencies(edges, n_nodes, max_degree, sels, n_workers=1, shard_size=2 ** 16, seed=123):
+    """
+        Several adjacency lists (eg `adj` + `train_adj`, one per entry of `sels`) from the same
+        edge array, built in parallel over fixed-size shards of nodes w/ a process pool.
         
-        if sel is not None:
-            neibs = neibs[sel[neibs]]
+        Each shard has its own RandomState (seeded by `seed`, output + shard index), and
+        shards don't depend on `n_workers`, so output is the same for any number of workers.
+        Workers are forked, so inputs are inherited + outputs written to shared memory.
+    """
+    src, trg = sort_edges(edges, n_nodes)
+    indptr = np.hstack([[0], np.cumsum(np.bincount(src, minlength=n_nodes))])
+    
+    outs = [RawArray(ctypes.c_int64, (n_nodes + 1) * max_degree) for _ in sels]
+    _shard_state.update({
+        "src"        : src,
+        "trg"        : trg,
+        "indptr"     : indptr,
+        "sels"       : sels,
+        "outs"       : outs,
+        "n_nodes"    : n_nodes,
+        "max_degree" : max_degree,
+        "seed"       : seed,
+    })
+    
+    jobs = [
+        (key_idx, shard_idx, lo, min(lo + shard_size, n_nodes))
+        for key_idx in range(len(sels))
+        for shard_idx, lo in enumerate(range(0, n_nodes, shard_size))
+    ]
+    
+    pool = Pool(n_workers) if n_workers > 1 else None
+    try:
+        results = pool.imap_unordered(_make_adjacency_shard, jobs) if pool is not None else map(_make_adjacency_shard, jobs)
+        for _ in tqdm(results, total=len(jobs)):
+            pass
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
         
-        if len(neibs) > 0:
-            r.append(node + np.zeros(len(neibs)).astype(int) + 1) # Off-by-one
-            c.append(np.arange(len(neibs)))
-            v.append(neibs + 1) # Off-by-one
-    
-    return csr_matrix((
-        np.hstack(v),
-        (
-            np.hstack(r),
-            np.hstack(c),
-        )
-    ))
+        _shard_state.clear()
+    
+    adjs = []
+    for out in outs:
+        adj = np.frombuffer(out, dtype=np.int64).reshape(n_nodes + 1, max_degree)
+        adj[n_nodes] = n_nodes # Dummy node
+        adjs.append(adj)
+    
+    return adjs
+
 
 def spadj2edgelist(spadj):
     spadj_v = spadj.data
@@ -137,6 +152,8 @@ def parse_args():
     parser.add_argument('--outpath', type=str)
     parser.add_argument('--max-degree', type=int, default=128)
     parser.add_argument('--task', type=str, default='classification')
+    parser.add_argument('--n-workers', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=123)
     
     args = parser.parse_args()
     assert args.task in ['classification', 'multilabel_classification'], 'unknown args.task'
@@ -147,6 +164,11 @@ def parse_args():
 
 
 if __name__ == "__main__":
+    # Only needed to read `G.json` -- the adjacency helpers above work on edge arrays
+    import networkx as nx
+    from networkx.readwrite import json_graph
+    assert int(nx.__version__.split('.')[0]) < 2, "networkx major version > 1"
+
     args = parse_args()
 
     if os.path.exists(args.outpath):
@@ -181,8 +203,14 @@ if __name__ == "__main__":
         n_classes = None
 
     print('making adjacency lists', file=sys.stderr)
-    adj = make_adjacency(G, args.max_degree, sel=None) # Adds dummy node
-    train_adj = make_adjacency(G, args.max_degree, sel=(folds == 'train')) # Adds dummy node
+    adj, train_adj = make_edge_adjacencies( # Adds dummy node
+        edges=np.array(G.edges()).reshape(-1, 2),
+        n_nodes=len(G.nodes()),
+        max_degree=args.max_degree,
+        sels=[None, (folds == 'train')],
+        n_workers=args.n_workers,
+        seed=args.seed,
+    )
 
     aug_feats   = np.vstack([feats, np.zeros((feats.shape[1],))]) # Add feat for dummy node
     aug_targets = np.vstack([targets, np.zeros((targets.shape[1],), dtype='int64')])
@@ -206,9 +234,9 @@ if __name__ == "__main__":
     # adj = make_sparse_adjacency(G, sel=None) # Adds dummy node
     # train_adj = make_sparse_adjacency(G, sel=(folds == 'train')) # Adds dummy node
 
-    aug_feats   = np.vstack([np.zeros((feats.shape[1],)), feats]) # Add feat for dummy node
-    aug_targets = np.vstack([np.zeros((targets.shape[1],), dtype='int64'), targets])
-    aug_folds   = np.hstack([['dummy'], folds])
+    # aug_feats   = np.vstack([np.zeros((feats.shape[1],)), feats]) # Add feat for dummy node
+    # aug_targets = np.vstack([np.zeros((targets.shape[1],), dtype='int64'), targets])
+    # aug_folds   = np.hstack([['dummy'], folds])
 
     # print('saving -> %s' % args.outpath, file=sys.stderr)
     # save_problem({
@@ -9,3 +9,9 @@ python convert.py \
 python convert.py \
     --inpath ../data/reddit/ \
     --task classification
+
+# reddit (streaming -- bounded memory)
+python convert-stream.py \
+    --inpath ../data/reddit/ \
+    --task classification \
+    --chunk-size 1048576